@@ -2,6 +2,7 @@
 
 // Set up express
 const express = require('express');
+const crypto = require('crypto');
 const app = express();
 
 // Enable JSON body parsing
@@ -17,7 +18,9 @@ app.use('/static', express.static('public'));
 
 const lectureParticipants = {};
 
-const activeLectureByBuilding = {};
+// Building leases live in the backend so every instance sees them; a lease we stop
+// renewing (e.g. this process crashes) runs out after BUILDING_LEASE_TTL seconds
+const BUILDING_LEASE_TTL = 300;
 
 
 //Handle client interface on /
@@ -29,6 +32,39 @@ const BACKEND_ENDPOINT = process.env.BACKEND || 'https://groupcoursework-functio
 
 const FUNCTION_KEY = process.env.FUNCTION_KEY || 'hsuAcj6yIqFu2S-duKquK2DXhpg85E_BZjvxPqrC84HmAzFuo27TyQ==';
 
+// JSON headers, plus the session token returned by login when we have one
+function backendHeaders(sessionToken) {
+    const headers = { "Content-Type": "application/json" };
+    if (sessionToken) {
+        headers["Authorization"] = `Bearer ${sessionToken}`;
+    }
+    return headers;
+}
+
+// How long a backend write may take before it is retried
+const BACKEND_WRITE_TIMEOUT_MS = 10000;
+
+// POST a write, retrying it once after a timeout or network error. Both attempts carry the
+// same Idempotency-Key, so the backend runs the write once and answers the retry with its result
+async function idempotentPost(url, headers, body, attempts = 2) {
+    const key = crypto.randomUUID();
+    for (let attempt = 1; ; attempt++) {
+        try {
+            return await fetch(url, {
+                method: "POST",
+                headers: { ...headers, "Idempotency-Key": key },
+                body: JSON.stringify(body),
+                signal: AbortSignal.timeout(BACKEND_WRITE_TIMEOUT_MS)
+            });
+        } catch (err) {
+            if (attempt >= attempts) {
+                throw err;
+            }
+            console.warn(`Retrying ${url.split('?')[0]} after: ${err.message}`);
+        }
+    }
+}
+
 
 async function studentLogin(username, password) {
     try {
@@ -56,13 +92,10 @@ async function studentLogin(username, password) {
 
 async function studentEnroll(name, password, modules) {
     try {
-        const response = await fetch(
+        const response = await idempotentPost(
             `${BACKEND_ENDPOINT}/student/enroll?code=${FUNCTION_KEY}`,
-            {
-                method: "POST",
-                headers: { "Content-Type": "application/json" },
-                body: JSON.stringify({ name, password, modules })
-            }
+            { "Content-Type": "application/json" },
+            { name, password, modules }
         );
 
         const data = await response.json();
@@ -105,13 +138,10 @@ async function lecturerLogin(username, password) {
 
 async function lecturerHire(name, password, modules) {
     try {
-        const response = await fetch(
+        const response = await idempotentPost(
             `${BACKEND_ENDPOINT}/lecturer/hire?code=${FUNCTION_KEY}`,
-            {
-                method: "POST",
-                headers: { "Content-Type": "application/json" },
-                body: JSON.stringify({ name, password, modules })
-            }
+            { "Content-Type": "application/json" },
+            { name, password, modules }
         );
 
         const data = await response.json();
@@ -128,44 +158,155 @@ async function lecturerHire(name, password, modules) {
     }
 }
 
-async function createLecture(title, module, lecturer, building) {
+// lecture/make body for a lecture starting now
+function lectureMakeBody(title, module, lecturer, building) {
+    // Get current date and time
+    const now = new Date();
+    const date = now.toISOString().split('T')[0]; // YYYY-MM-DD
+    const time = now.toTimeString().split(' ')[0].substring(0, 5); // HH:MM
+
+    return {
+        title,
+        module,
+        lecturer,
+        date,
+        time,
+        building: building || null // Add building info if available
+    };
+}
+
+// Several backend calls in one round trip through the batch route. Returns the responses by
+// request id ({ status, body }), or { error } when the batch itself failed
+async function backendBatch(requests, sessionToken) {
     try {
-        // Get current date and time
-        const now = new Date();
-        const date = now.toISOString().split('T')[0]; // YYYY-MM-DD
-        const time = now.toTimeString().split(' ')[0].substring(0, 5); // HH:MM
+        const response = await fetch(`${BACKEND_ENDPOINT}/batch?code=${FUNCTION_KEY}`, {
+            method: "POST",
+            headers: backendHeaders(sessionToken),
+            body: JSON.stringify({ requests })
+        });
+
+        const data = await response.json();
+
+        if (!data.result) {
+            return { error: data.msg || "Batch failed" };
+        }
+
+        return Object.fromEntries(data.responses.map(r => [r.id, r]));
 
+    } catch (err) {
+        console.error("Batch API ERROR:", err);
+        return { error: "API_ERROR" };
+    }
+}
+
+async function buildingLeaseCall(action, body, sessionToken) {
+    try {
         const response = await fetch(
-            `${BACKEND_ENDPOINT}/lecture/make?code=${FUNCTION_KEY}`,
+            `${BACKEND_ENDPOINT}/building/lease/${action}?code=${FUNCTION_KEY}`,
             {
                 method: "POST",
-                headers: { "Content-Type": "application/json" },
-                body: JSON.stringify({ 
-                    title, 
-                    module, 
-                    lecturer, 
-                    date, 
-                    time,
-                    building: building || null // Add building info if available
-                })
+                headers: backendHeaders(sessionToken),
+                body: JSON.stringify(body)
             }
         );
 
         const data = await response.json();
 
         if (!data.result) {
-            return { error: data.msg || "Failed to create lecture" };
+            return { error: data.msg || `Failed to ${action} building lease`, lease: data.lease || null };
+        }
+
+        return data;
+
+    } catch (err) {
+        console.error(`Building lease ${action} API ERROR:`, err);
+        return { error: "API_ERROR" };
+    }
+}
+
+function renewBuildingLease(building, lease, sessionToken) {
+    return buildingLeaseCall("renew", { building, lease }, sessionToken);
+}
+
+function releaseBuildingLease(building, lease, sessionToken) {
+    return buildingLeaseCall("release", { building, lease }, sessionToken);
+}
+
+// Chat messages and board snapshots are kept by the backend, which batches the writes;
+// we send each one as it happens and don't wait for it before broadcasting
+async function historyCall(route, body) {
+    try {
+        const response = await fetch(`${BACKEND_ENDPOINT}/${route}?code=${FUNCTION_KEY}`, {
+            method: "POST",
+            headers: { "Content-Type": "application/json" },
+            body: JSON.stringify(body)
+        });
+
+        const data = await response.json();
+
+        if (!data.result) {
+            console.error(`${route} failed:`, data.msg);
+        }
+
+    } catch (err) {
+        console.error(`${route} API ERROR:`, err);
+    }
+}
+
+function appendChatMessage(lectureTitle, chatMessage) {
+    return historyCall("chat/append", { lecture: lectureTitle, ...chatMessage });
+}
+
+function saveBoard(lectureTitle, content, user) {
+    return historyCall("board/save", { lecture: lectureTitle, content, user });
+}
+
+// Last body and ETag of backend GETs, so repeated reads send If-None-Match and a 304 reuses
+// the body we already have
+const CONDITIONAL_CACHE_SIZE = 200;
+const conditionalCache = new Map();
+
+async function conditionalGet(url) {
+    const cached = conditionalCache.get(url);
+    const response = await fetch(url, {
+        headers: cached ? { "If-None-Match": cached.etag } : {}
+    });
+
+    if (response.status === 304 && cached) {
+        return cached.data;
+    }
+
+    const data = await response.json();
+    const etag = response.headers.get("ETag");
+    conditionalCache.delete(url);
+    if (etag && response.ok) {
+        conditionalCache.set(url, { etag, data });
+        if (conditionalCache.size > CONDITIONAL_CACHE_SIZE) {
+            conditionalCache.delete(conditionalCache.keys().next().value);
+        }
+    }
+    return data;
+}
+
+// Current board and latest chat page for a joining user, in one request
+async function fetchLectureHistory(lectureTitle) {
+    try {
+        const params = new URLSearchParams({ code: FUNCTION_KEY, lecture: lectureTitle, limit: 50 });
+        const data = await conditionalGet(`${BACKEND_ENDPOINT}/lecture/history?${params}`);
+
+        if (!data.result) {
+            return { error: data.msg || "Failed to load lecture history" };
         }
 
         return data;
 
     } catch (err) {
-        console.error("Create lecture API ERROR:", err);
+        console.error("Lecture history API ERROR:", err);
         return { error: "API_ERROR" };
     }
 }
 
-async function updateUserModules(userId, modules, isLecturer) {
+async function updateUserModules(userId, modules, isLecturer, sessionToken) {
     try {
         // Note: This endpoint may need to be created in the backend
         // For now, we'll use a placeholder approach
@@ -177,7 +318,7 @@ async function updateUserModules(userId, modules, isLecturer) {
 
         const response = await fetch(endpoint, {
             method: "POST",
-            headers: { "Content-Type": "application/json" },
+            headers: backendHeaders(sessionToken),
             body: JSON.stringify({ 
                 id: userId,
                 modules: modules
@@ -200,13 +341,22 @@ async function updateUserModules(userId, modules, isLecturer) {
 }
 
 
-// Store lecture data (board content and chat messages)
-const lectureData = {};
-
 // Socket.io
 io.on('connection', socket => {
     console.log('New connection');
     let currentLecture = null;
+    let buildingLease = null;
+
+    // Give up this socket's building lease, if it holds one
+    async function dropBuildingLease() {
+        if (!buildingLease) {
+            return;
+        }
+        const { building, lease, timer } = buildingLease;
+        buildingLease = null;
+        clearInterval(timer);
+        await releaseBuildingLease(building, lease, socket.sessionToken);
+    }
 
     // Student Login
     socket.on('student:login', async (data) => {
@@ -222,6 +372,7 @@ io.on('connection', socket => {
 
         // Store user name for chat
         socket.userName = result.student?.name || result.name || username;
+        socket.sessionToken = result.token || null;
         
         // Successful login
         socket.emit('student:login:result', result);
@@ -255,6 +406,7 @@ io.on('connection', socket => {
 
         // Store user name for chat
         socket.userName = result.lecturer?.name || result.name || username;
+        socket.sessionToken = result.token || null;
         
         socket.emit('lecturer:login:result', result);
         console.log('Lecturer logged in:', result);
@@ -278,48 +430,80 @@ io.on('connection', socket => {
     socket.on('lecture:start', async (data) => {
         const { title, module, lecturer, building } = data;
 
-            // Block starting a lecture if the building already has an active lecture
-    if (building && activeLectureByBuilding[building]) {
-        const existing = activeLectureByBuilding[building];
+        // Lock the building first; a different lecturer holding it blocks the start. Both
+        // calls go in one batch, the lecture is only made once the lease is ours
+        const requests = [];
+        if (building) {
+            requests.push({
+                id: "lease",
+                route: "building/lease/acquire",
+                method: "POST",
+                body: { building, lecturer, title, module, ttl: BUILDING_LEASE_TTL }
+            });
+        }
+        requests.push({
+            id: "lecture",
+            route: "lecture/make",
+            method: "POST",
+            body: lectureMakeBody(title, module, lecturer, building),
+            dependsOn: building ? ["lease"] : []
+        });
 
-        // If a different lecturer is trying to start in the same building, reject
-        if (existing.lecturer !== lecturer) {
-            socket.emit(
-                'lecture:start:error',
-                `Building is already in use by ${existing.lecturer} for ${existing.module} (${existing.title}).`
-            );
+        const responses = await backendBatch(requests, socket.sessionToken);
+        if (responses.error) {
+            socket.emit('lecture:start:error', responses.error);
             return;
         }
-    }
 
+        let lease = null;
+        if (building) {
+            lease = responses.lease.body;
+
+            if (!lease.result) {
+                const existing = lease.lease;
+                socket.emit(
+                    'lecture:start:error',
+                    existing
+                        ? `Building is already in use by ${existing.lecturer} for ${existing.module} (${existing.title}).`
+                        : lease.msg || "Failed to acquire building lease"
+                );
+                return;
+            }
+        }
 
-        const result = await createLecture(title, module, lecturer, building);
+        const result = responses.lecture.body;
 
-        if (result.error) {
-            socket.emit('lecture:start:error', result.error);
+        if (!result.result) {
+            if (lease) {
+                await releaseBuildingLease(building, lease.lease.lease, socket.sessionToken);
+            }
+            socket.emit('lecture:start:error', result.msg || "Failed to create lecture");
             return;
         }
 
-                // Lock the building to this lecture
-        if (building) {
-            activeLectureByBuilding[building] = {
-                title,
-                module,
-                lecturer,
-                startedAt: Date.now()
-            };
+        // Keep the lease alive while this socket runs the lecture
+        if (lease) {
+            if (buildingLease && buildingLease.building !== building) {
+                await dropBuildingLease();
+            }
+            if (buildingLease) {
+                clearInterval(buildingLease.timer);
+            }
+            const held = { building, lease: lease.lease.lease, timer: null };
+            held.timer = setInterval(async () => {
+                const renewed = await renewBuildingLease(held.building, held.lease, socket.sessionToken);
+                if (renewed.error && renewed.error !== "API_ERROR") {
+                    console.log(`Lost building lease for ${held.building}: ${renewed.error}`);
+                    clearInterval(held.timer);
+                    if (buildingLease === held) {
+                        buildingLease = null;
+                    }
+                }
+            }, (BUILDING_LEASE_TTL / 3) * 1000);
+            buildingLease = held;
         }
 
 
-        // Initialise lecture data if not exists
-        if (!lectureData[title]) {
-            lectureData[title] = {
-                boardContent: '',
-                chatMessages: [],
-                building: building || null
-            };
-        }
-
         // Broadcast lecture start to all clients so students can see available lectures
         if (building) {
             io.emit('lecture:building:update', {
@@ -336,18 +520,10 @@ io.on('connection', socket => {
     });
 
     // Join Lecture
-    socket.on('lecture:join', (data) => {
+    socket.on('lecture:join', async (data) => {
         const { lectureTitle, userType } = data;
         currentLecture = lectureTitle;
 
-        // Initialise if not exists
-        if (!lectureData[lectureTitle]) {
-            lectureData[lectureTitle] = {
-                boardContent: '',
-                chatMessages: []
-            };
-        }
-        
         if (!lectureParticipants[lectureTitle]) {
             lectureParticipants[lectureTitle] = {};
         }
@@ -366,20 +542,28 @@ io.on('connection', socket => {
             studentCount
         });
 
-        // Send current board content and chat messages to the user
+        // Send current board content and the latest chat messages to the user
+        const history = await fetchLectureHistory(lectureTitle);
+
+        if (history.error) {
+            console.log(`No history for ${lectureTitle}: ${history.error}`);
+            return;
+        }
+
         socket.emit('board:update', {
-            content: lectureData[lectureTitle].boardContent,
+            content: history.board,
+            revision: history.boardRevision,
             lectureTitle: lectureTitle
         });
 
-        // Send chat history
-        lectureData[lectureTitle].chatMessages.forEach(msg => {
-            socket.emit('chat:message', {
+        socket.emit('chat:history', {
+            messages: history.messages.map(msg => ({
                 user: msg.user,
                 message: msg.message,
-                time: msg.time,
-                lectureTitle: lectureTitle
-            });
+                time: msg.time
+            })),
+            cursor: history.cursor,
+            lectureTitle: lectureTitle
         });
     });
 
@@ -387,9 +571,9 @@ io.on('connection', socket => {
     socket.on('board:update', (data) => {
         const { content, lectureTitle } = data;
 
-        if (lectureTitle && lectureData[lectureTitle]) {
-            lectureData[lectureTitle].boardContent = content;
-            
+        if (lectureTitle && lectureParticipants[lectureTitle]) {
+            saveBoard(lectureTitle, content, socket.userName || 'Anonymous');
+
             // Broadcast to all clients in this lecture
             io.emit('board:update', {
                 content: content,
@@ -402,14 +586,14 @@ io.on('connection', socket => {
     socket.on('chat:message', (data) => {
         const { message, lectureTitle } = data;
         
-        if (lectureTitle && lectureData[lectureTitle]) {
+        if (lectureTitle && lectureParticipants[lectureTitle]) {
             const chatMessage = {
                 user: socket.userName || 'Anonymous',
                 message: message,
                 time: new Date().toLocaleTimeString()
             };
 
-            lectureData[lectureTitle].chatMessages.push(chatMessage);
+            appendChatMessage(lectureTitle, chatMessage);
 
             // Broadcast to all clients in this lecture
             io.emit('chat:message', {
@@ -428,7 +612,7 @@ io.on('connection', socket => {
     socket.on('modules:update', async (data) => {
         const { modules, userId, isLecturer } = data;
 
-        const result = await updateUserModules(userId, modules, isLecturer);
+        const result = await updateUserModules(userId, modules, isLecturer, socket.sessionToken);
 
         if (result.error) {
             socket.emit('modules:update:error', result.error);
@@ -457,6 +641,8 @@ io.on('connection', socket => {
     }
 
     currentLecture = null;
+
+    dropBuildingLease();
     });
 
 });
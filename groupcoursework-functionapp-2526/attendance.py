@@ -0,0 +1,47 @@
+# Attendance of auto-rostered lectures.
+# The roster is the sorted list of the module's students taken when the lecture is set up, and
+# attendance is one bit per roster position, stored base64-encoded: marking a student present
+# rewrites a few bytes instead of appending their name, and a 500-seat lecture needs 63 bytes.
+import base64
+import bisect
+
+
+def empty(size: int) -> str:
+    return encode(bytearray((size + 7) // 8))
+
+
+def decode(bitmap) -> bytearray:
+    return bytearray(base64.b64decode(bitmap or ""))
+
+
+def encode(bits: bytearray) -> str:
+    return base64.b64encode(bytes(bits)).decode()
+
+
+# Position of name in the sorted roster, or None
+def position(roster: list, name: str):
+    i = bisect.bisect_left(roster, name)
+    return i if i < len(roster) and roster[i] == name else None
+
+
+def get(bits: bytearray, i: int) -> bool:
+    return i // 8 < len(bits) and bool(bits[i // 8] >> (i % 8) & 1)
+
+
+def put(bits: bytearray, i: int, present: bool):
+    if i // 8 >= len(bits):
+        bits.extend(bytes(i // 8 + 1 - len(bits)))
+    if present:
+        bits[i // 8] |= 1 << (i % 8)
+    else:
+        bits[i // 8] &= ~(1 << (i % 8)) & 0xFF
+
+
+def present(roster: list, bitmap) -> list:
+    bits = decode(bitmap)
+    return [name for i, name in enumerate(roster) if get(bits, i)]
+
+
+def absent(roster: list, bitmap) -> list:
+    bits = decode(bitmap)
+    return [name for i, name in enumerate(roster) if not get(bits, i)]
@@ -0,0 +1,173 @@
+# Several HTTP calls in one invocation.
+# The batch route takes {"requests": [...], "ordered": false}, each entry
+#   {"id": "a", "route": "student/login", "method": "POST", "body": {...},
+#    "params": {...}, "headers": {...}, "dependsOn": ["earlier id", ...]}
+# and hands every entry to the handler registered for its route, in this process. Entries
+# start as soon as the entries they depend on are done, so independent ones run concurrently;
+# with "ordered" each one depends on the one before. An entry whose dependency didn't succeed
+# (status >= 400) isn't run and gets 424. Entries share the batch's headers (session token,
+# Idempotency-Key is per entry) and are recorded under their own route in the metrics.
+import asyncio
+import logging
+
+import azure.functions as func
+
+import codec
+
+ROUTE = "batch"
+# Headers of the batch request that don't apply to its entries (entry bodies are decoded here)
+BATCH_ONLY_HEADERS = ("content-length", "idempotency-key", "accept-encoding", "if-none-match")
+# Entry response headers worth handing back
+KEPT_HEADERS = ("x-request-charge", "idempotent-replayed", "retry-after", "etag")
+
+
+class BatchError(ValueError):
+    pass
+
+
+class Entry:
+    def __init__(self, index: int, data):
+        if not isinstance(data, dict):
+            raise BatchError(f"request {index} must be an object")
+        self.id = str(data.get("id") or index)
+        self.route = (data.get("route") or "").strip().strip("/")
+        self.method = (data.get("method") or "GET").upper()
+        self.body = data.get("body")
+        self.params = data.get("params") or {}
+        self.headers = data.get("headers") or {}
+        self.depends_on = data.get("dependsOn") or []
+        if not self.route:
+            raise BatchError(f"request {self.id} must have a route")
+        if not isinstance(self.params, dict) or not isinstance(self.headers, dict):
+            raise BatchError(f"request {self.id}: params and headers must be objects")
+        if not isinstance(self.depends_on, list):
+            raise BatchError(f"request {self.id}: dependsOn must be a list of ids")
+
+
+# Entries of a batch body, checked; dependencies must name earlier entries
+def parse(data, max_requests: int) -> list:
+    if not isinstance(data, dict) or not isinstance(data.get("requests"), list):
+        raise BatchError("requests must be a list")
+    items = data["requests"]
+    if not items:
+        raise BatchError("requests must not be empty")
+    if len(items) > max_requests:
+        raise BatchError(f"at most {max_requests} requests per batch")
+
+    entries = []
+    seen = set()
+    for index, item in enumerate(items):
+        entry = Entry(index, item)
+        if entry.id in seen:
+            raise BatchError(f"duplicate request id {entry.id}")
+        if data.get("ordered") and entries:
+            entry.depends_on = [entries[-1].id]
+        unknown = [d for d in entry.depends_on if str(d) not in seen]
+        if unknown:
+            raise BatchError(f"request {entry.id} depends on unknown or later requests {unknown}")
+        entry.depends_on = [str(d) for d in entry.depends_on]
+        seen.add(entry.id)
+        entries.append(entry)
+    return entries
+
+
+# route -> (methods, handler) of every route of a MetricsFunctionApp
+def handler_table(app) -> dict:
+    return {route: (r.methods, r.handler) for route, r in app.routes.items()}
+
+
+def _json(payload: dict, status: int) -> func.HttpResponse:
+    return func.HttpResponse(codec.dumps(payload), status_code=status, mimetype="application/json")
+
+
+# The entry as an HttpRequest for its handler, or the response to give instead
+def build_request(entry: Entry, req: func.HttpRequest, table: dict):
+    if entry.route == ROUTE:
+        return None, _json({"result": False, "msg": "batches can't be nested"}, 400)
+    if entry.route not in table:
+        return None, _json({"result": False, "msg": f"no route {entry.route}"}, 404)
+    methods, _ = table[entry.route]
+    if methods and entry.method not in methods:
+        return None, _json({"result": False, "msg": f"{entry.method} not allowed on {entry.route}"}, 405)
+
+    headers = {k: v for k, v in req.headers.items() if k.lower() not in BATCH_ONLY_HEADERS}
+    headers.update({str(k): str(v) for k, v in entry.headers.items()})
+    body = b"" if entry.body is None else codec.dumps(entry.body)
+    url = req.url.split("?")[0].rstrip("/").rsplit("/", 1)[0] + "/" + entry.route
+    return func.HttpRequest(
+        entry.method, url, headers=headers,
+        params={str(k): str(v) for k, v in entry.params.items()},
+        route_params={}, body=body
+    ), None
+
+
+def outcome(entry: Entry, resp) -> dict:
+    if resp is None:
+        resp = _json({"result": False, "msg": "internal error"}, 500)
+    raw = resp.get_body() or b""
+    try:
+        body = codec.loads(raw) if raw else None
+    except ValueError:
+        body = raw.decode("utf-8", errors="replace")
+    return {
+        "id": entry.id,
+        "route": entry.route,
+        "status": resp.status_code,
+        "headers": {k: v for k, v in resp.headers.items() if k.lower() in KEPT_HEADERS},
+        "body": body,
+    }
+
+
+def skipped(entry: Entry, failed: list) -> dict:
+    return outcome(entry, _json({"result": False, "msg": f"not run, {', '.join(failed)} failed"}, 424))
+
+
+# Runs the entries on a thread pool; submit(fn) must keep the caller's context. Entries are
+# submitted in order and only wait on earlier ones, so the pool can't deadlock.
+def run(entries: list, req: func.HttpRequest, table: dict, submit) -> list:
+    futures = {}
+
+    def run_entry(entry):
+        failed = [d for d in entry.depends_on if futures[d].result()["status"] >= 400]
+        if failed:
+            return skipped(entry, failed)
+        sub, refused = build_request(entry, req, table)
+        if refused is not None:
+            return outcome(entry, refused)
+        _, handler = table[entry.route]
+        try:
+            return outcome(entry, handler(sub))
+        except Exception:
+            logging.exception(f"batch request {entry.id} ({entry.route}) failed")
+            return outcome(entry, None)
+
+    for entry in entries:
+        futures[entry.id] = submit(run_entry, entry)
+    return [futures[e.id].result() for e in entries]
+
+
+# Same for the async app: coroutine handlers run as tasks, sync ones on threads
+async def run_async(entries: list, req: func.HttpRequest, table: dict) -> list:
+    tasks = {}
+
+    async def run_entry(entry):
+        results = [await tasks[d] for d in entry.depends_on]
+        failed = [d for d, r in zip(entry.depends_on, results) if r["status"] >= 400]
+        if failed:
+            return skipped(entry, failed)
+        sub, refused = build_request(entry, req, table)
+        if refused is not None:
+            return outcome(entry, refused)
+        _, handler = table[entry.route]
+        try:
+            if asyncio.iscoroutinefunction(handler):
+                return outcome(entry, await handler(sub))
+            return outcome(entry, await asyncio.to_thread(handler, sub))
+        except Exception:
+            logging.exception(f"batch request {entry.id} ({entry.route}) failed")
+            return outcome(entry, None)
+
+    for entry in entries:
+        tasks[entry.id] = asyncio.ensure_future(run_entry(entry))
+    return list(await asyncio.gather(*(tasks[e.id] for e in entries)))
+
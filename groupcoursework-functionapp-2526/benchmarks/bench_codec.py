@@ -0,0 +1,265 @@
+# Benchmarks the JSON codec layer (codec.py) against the stdlib json helpers it replaced
+# Usage:
+#   python benchmarks/bench_codec.py --sizes 100,10000 --iterations 300 --output codec.json
+#   python benchmarks/bench_codec.py --cases roster_response,bulk_parse
+# Every case runs the old helper and the one function_app.py uses now on the same input and
+# checks they decode to the same data. Results are JSON: per dataset size and case, latency
+# percentiles (microseconds) and peak allocation per call of both, and the p50 speedup.
+# The JSON backend in use (orjson or json) is recorded with the results.
+import argparse
+import datetime
+import json
+import os
+import platform
+import sys
+import time
+import tracemalloc
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, APP_DIR)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+os.environ.setdefault("AdmissionRate", "0")
+
+import azure.functions as func
+
+import codec
+import function_app
+from bench_routes import git_commit, percentile
+
+
+# The helpers as they were before codec.py
+def old_json_resp(payload: dict, status: int = 200) -> func.HttpResponse:
+    return func.HttpResponse(body=json.dumps(payload), status_code=status, mimetype="application/json")
+
+
+def old_parse_json(req: func.HttpRequest):
+    try:
+        return req.get_json(), None
+    except Exception:
+        return None, old_json_resp({"result": False, "msg": "not a correct json"}, status=400)
+
+
+def old_iter_ndjson(body: bytes):
+    start = 0
+    line_no = 0
+    while start < len(body):
+        end = body.find(b"\n", start)
+        if end == -1:
+            end = len(body)
+        line_no += 1
+        raw = body[start:end].strip()
+        start = end + 1
+        if not raw:
+            continue
+        try:
+            data = json.loads(raw)
+        except ValueError:
+            data = None
+        yield line_no, data
+
+
+def old_ndjson_resp(records) -> func.HttpResponse:
+    return func.HttpResponse(
+        body="".join(json.dumps(r) + "\n" for r in records),
+        status_code=200,
+        mimetype="application/x-ndjson"
+    )
+
+
+def post(body: bytes) -> func.HttpRequest:
+    return func.HttpRequest("POST", "http://localhost/api/bench", headers={}, params={}, route_params={}, body=body)
+
+
+def roster(size: int) -> dict:
+    return {
+        "result": True,
+        "module": "CS101",
+        "students": [f"Student {i:06d}" for i in range(size)],
+        "cursor": None,
+    }
+
+
+def history(size: int) -> dict:
+    return {
+        "result": True,
+        "lecture": "Cloud Computing",
+        "entries": [
+            {"user": f"Student {i % 50:06d}", "text": f"message {i} about the lecture, café", "at": 1700000000 + i}
+            for i in range(size)
+        ],
+        "cursor": "eyJhIjoxfQ",
+    }
+
+
+def enroll_records(size: int) -> list:
+    return [
+        {"name": f"Student {i:06d}", "password": "Password1", "modules": ["CS101", "CS102", "CS103", "CS104"]}
+        for i in range(size)
+    ]
+
+
+def bulk_results(size: int) -> list:
+    return [
+        {"line": i + 1, "name": f"Student {i:06d}", "status": 201, "result": True, "msg": "OK"}
+        for i in range(size)
+    ]
+
+
+def response_data(resp: func.HttpResponse):
+    body = resp.get_body()
+    if resp.mimetype == "application/x-ndjson":
+        return [json.loads(line) for line in body.splitlines()]
+    return json.loads(body)
+
+
+def parsed_data(result):
+    data, err = result
+    return err.status_code if err is not None else data
+
+
+# case name -> function(size) returning (input, old, new, check); check maps a result to
+# comparable data
+def codec_cases() -> dict:
+    def small_response(size):
+        return {"result": True, "msg": "OK"}, old_json_resp, function_app.json_resp, response_data
+
+    def roster_response(size):
+        return (roster(size), old_json_resp,
+                lambda p: function_app.json_list_resp(p, "students"), response_data)
+
+    def history_response(size):
+        return (history(size), old_json_resp,
+                lambda p: function_app.json_list_resp(p, "entries"), response_data)
+
+    def small_request(size):
+        body = json.dumps({"name": "Student 000001", "password": "Password1"}).encode()
+        return body, lambda b: old_parse_json(post(b)), lambda b: function_app.parse_json(post(b)), parsed_data
+
+    def large_request(size):
+        body = json.dumps({"name": "Dr. Alwash", "modules": [f"CS{i:05d}" for i in range(size)],
+                           "students": enroll_records(size)}).encode()
+        return body, lambda b: old_parse_json(post(b)), lambda b: function_app.parse_json(post(b)), parsed_data
+
+    def bulk_parse(size):
+        body = "".join(json.dumps(r) + "\n" for r in enroll_records(size)).encode()
+        new = lambda b: [(n, d) for n, d, _ in codec.iter_ndjson(
+            b, function_app.NDJSON_LINE_MAX_BYTES, max(size, function_app.NDJSON_MAX_RECORDS))]
+        return body, lambda b: list(old_iter_ndjson(b)), new, lambda r: r
+
+    def bulk_response(size):
+        return bulk_results(size), old_ndjson_resp, function_app.ndjson_resp, response_data
+
+    return {
+        "small_response": small_response,
+        "roster_response": roster_response,
+        "history_response": history_response,
+        "small_request": small_request,
+        "large_request": large_request,
+        "bulk_parse": bulk_parse,
+        "bulk_response": bulk_response,
+    }
+
+
+def bench_fn(fn, arg, iterations: int, warmup: int, alloc_samples: int) -> dict:
+    for _ in range(warmup):
+        fn(arg)
+
+    latencies = []
+    for _ in range(iterations):
+        start = time.perf_counter_ns()
+        fn(arg)
+        latencies.append((time.perf_counter_ns() - start) / 1000)
+
+    # Allocation pass, separate so tracing overhead doesn't skew latencies
+    peaks = []
+    tracemalloc.start()
+    try:
+        for _ in range(alloc_samples):
+            tracemalloc.reset_peak()
+            current, _ = tracemalloc.get_traced_memory()
+            fn(arg)
+            peaks.append(tracemalloc.get_traced_memory()[1] - current)
+    finally:
+        tracemalloc.stop()
+
+    latencies.sort()
+    return {
+        "iterations": iterations,
+        "latency_us": {
+            "p50": round(percentile(latencies, 50), 2),
+            "p90": round(percentile(latencies, 90), 2),
+            "p99": round(percentile(latencies, 99), 2),
+            "mean": round(sum(latencies) / len(latencies), 2),
+            "max": round(latencies[-1], 2),
+        },
+        "alloc_peak_bytes": {
+            "mean": round(sum(peaks) / len(peaks)) if peaks else 0,
+            "max": max(peaks) if peaks else 0,
+        },
+    }
+
+
+def run(sizes: list, iterations: int, warmup: int, alloc_samples: int, only: list) -> dict:
+    cases = codec_cases()
+    unknown = sorted(set(only) - set(cases))
+    if unknown:
+        sys.exit(f"unknown cases: {', '.join(unknown)}")
+
+    results = {}
+    for size in sizes:
+        per_size = results[str(size)] = {}
+        for name, build in cases.items():
+            if only and name not in only:
+                continue
+            arg, old, new, check = build(size)
+            if check(old(arg)) != check(new(arg)):
+                sys.exit(f"{name}: old and new helpers disagree at size {size}")
+
+            result = {
+                "old": bench_fn(old, arg, iterations, warmup, alloc_samples),
+                "new": bench_fn(new, arg, iterations, warmup, alloc_samples),
+            }
+            new_p50 = result["new"]["latency_us"]["p50"]
+            result["speedup_p50"] = round(result["old"]["latency_us"]["p50"] / new_p50, 2) if new_p50 else None
+            per_size[name] = result
+            print(f"size={size:<7} {name:<18} old p50={result['old']['latency_us']['p50']:>10.1f}us "
+                  f"new p50={new_p50:>10.1f}us  x{result['speedup_p50']}")
+
+    return {
+        "meta": {
+            "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "backend": codec.BACKEND,
+            "sizes": sizes,
+            "iterations": iterations,
+            "warmup": warmup,
+            "alloc_samples": alloc_samples,
+        },
+        "results": results,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark codec.py against the stdlib json helpers")
+    parser.add_argument("--sizes", default="100,10000", help="comma separated list lengths")
+    parser.add_argument("--iterations", type=int, default=200)
+    parser.add_argument("--warmup", type=int, default=20)
+    parser.add_argument("--alloc-samples", type=int, default=20)
+    parser.add_argument("--cases", default="", help="comma separated cases to run, default all")
+    parser.add_argument("--output", help="write results JSON here")
+    args = parser.parse_args()
+
+    sizes = [int(s) for s in args.sizes.split(",") if s.strip()]
+    only = [c.strip() for c in args.cases.split(",") if c.strip()]
+    report = run(sizes, args.iterations, args.warmup, args.alloc_samples, only)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+        print(f"wrote {args.output}")
+
+
+if __name__ == "__main__":
+    main()
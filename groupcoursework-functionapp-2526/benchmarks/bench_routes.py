@@ -0,0 +1,515 @@
+# Benchmarks every HTTP route in function_app.py against a local storage backend (see storage/)
+# Usage:
+#   python benchmarks/bench_routes.py --sizes 100,10000 --iterations 300 --output bench.json
+#   python benchmarks/bench_routes.py --backend sqlite --sizes 100000
+#   python benchmarks/bench_routes.py --routes student/login,lecture/student/add
+#   python benchmarks/bench_routes.py --compare before.json after.json
+# Results are JSON: per dataset size and route, latency percentiles (microseconds), peak
+# allocation per call, backend calls and request charge per call, and response status counts.
+import argparse
+import datetime
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import Counter
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, APP_DIR)
+# Routes are called back to back, faster than admission control would let them through
+os.environ.setdefault("AdmissionRate", "0")
+
+import azure.functions as func
+from azure.cosmos.exceptions import CosmosResourceNotFoundError
+
+import function_app
+from storage.memory import drop_databases
+
+STUDENT_MODULES = [
+    ["COMP1", "COMP2", "COMP3", "MATH1"],
+    ["BIOM1", "BIOM2", "ELEC1", "MATH2"],
+    ["ELEC2", "ELEC3", "MATH3", "COMP1"],
+]
+LECTURER_MODULES = [["COMP1", "COMP2", "COMP3"], ["MATH1", "MATH2", "MATH3"], ["BIOM1", "ELEC1", "ELEC2"]]
+PASSWORD = "Password1"
+LECTURE_IDS = [str(i) for i in range(1, 13)]
+BENCH_LEASE = "bench-lease"
+BENCH_TERM_START = datetime.date(2025, 1, 6)
+BENCH_LECTURE = "Bench lecture"
+
+
+# Fresh database on the chosen local backend, seeded with a dataset of the given size
+class Dataset:
+    def __init__(self, size: int, backend: str, workdir: str):
+        self.size = size
+        self.students = [f"student-{i}" for i in range(size)]
+        self.lecturers = [f"lecturer-{i}" for i in range(max(10, size // 20))]
+
+        # Write out the previous run's queued history first, so it isn't counted against this one
+        for buffer in function_app.history_buffers.values():
+            buffer.flush_all()
+        function_app.reset_storage_clients()
+        drop_databases()
+        if backend == "sqlite":
+            fd, path = tempfile.mkstemp(suffix=".db", dir=workdir)
+            os.close(fd)
+            os.environ["DatabaseName"] = f"sqlite://{path}"
+        else:
+            os.environ["DatabaseName"] = f"memory:bench-{size}"
+        function_app.profile_cache.clear()
+
+        self.student = function_app.get_student_container()
+        self.lecturer = function_app.get_lecturer_container()
+        self.lecture = function_app.get_lecture_container()
+        self.building = function_app.get_building_container()
+        self.module = function_app.get_module_container()
+        self.view = function_app.get_view_container()
+        self.history = function_app.get_history_container()
+
+        self.student.load(
+            function_app.new_student_doc({"name": n, "password": PASSWORD, "modules": STUDENT_MODULES[i % 3]})
+            for i, n in enumerate(self.students)
+        )
+        self.lecturer.load(
+            function_app.new_lecturer_doc({"name": n, "password": PASSWORD, "modules": LECTURER_MODULES[i % 3]})
+            for i, n in enumerate(self.lecturers)
+        )
+        self.lecture.load(
+            {
+                "id": lid, "title": "", "module": "", "lecturer": "", "date": "", "time": "",
+                "students": self.students[:min(size, 30)]
+            }
+            for lid in LECTURE_IDS
+        )
+
+        changes = function_app.module_index_changes((n, [], STUDENT_MODULES[i % 3]) for i, n in enumerate(self.students))
+        self.module.load(
+            {
+                "id": function_app.module_index_id(module, shard), "type": "moduleStudents",
+                "module": module, "shard": shard, "students": sorted(added)
+            }
+            for (module, shard), (added, _) in changes.items()
+        )
+
+        function_app.sync_views()
+
+        for batch in range(20):
+            function_app.write_history_batch("chat", BENCH_LECTURE, [
+                {"user": self.students[j % size], "message": f"message {batch}-{j}", "time": "10:00:00", "at": 0}
+                for j in range(50)
+            ])
+        board = ""
+        for revision in range(40):
+            board += f"<p>line {revision}</p>" * 10
+            function_app.write_board_revision(BENCH_LECTURE, [{"content": board, "user": "", "at": 0}])
+
+    def containers(self):
+        return [self.student, self.lecturer, self.lecture, self.building, self.module, self.view, self.history]
+
+    def backend_snapshot(self):
+        calls = Counter()
+        for c in self.containers():
+            for op, n in c.calls.items():
+                calls[f"{c.id}.{op}"] += n
+        return calls, sum(c.request_charge for c in self.containers())
+
+
+def make_request(method: str, route: str, body=None, params=None, headers=None, raw: bytes = None):
+    if raw is None:
+        raw = json.dumps(body).encode() if body is not None else b""
+    return func.HttpRequest(
+        method=method,
+        url=f"http://localhost/api/{route}",
+        headers=headers or {},
+        params=params or {},
+        body=raw
+    )
+
+
+def ndjson(records) -> bytes:
+    return "".join(json.dumps(r) + "\n" for r in records).encode()
+
+
+def ensure_in_lecture(ds: Dataset, lecture_id: str, names):
+    lecture = ds.lecture.read_item(lecture_id, lecture_id)
+    missing = [n for n in names if n not in lecture["students"]]
+    if missing:
+        lecture["students"].extend(missing)
+        ds.lecture.replace_item(lecture_id, lecture)
+
+
+def ensure_not_in_lecture(ds: Dataset, lecture_id: str, names):
+    lecture = ds.lecture.read_item(lecture_id, lecture_id)
+    kept = [n for n in lecture["students"] if n not in names]
+    if len(kept) != len(lecture["students"]):
+        lecture["students"] = kept
+        ds.lecture.replace_item(lecture_id, lecture)
+
+
+# Empty a lecture slot and list it as free, so lecture/make runs alternate between
+# claiming a listed slot and adding a new one
+def free_lecture_slot(ds: Dataset, lecture_id: str):
+    ds.lecture.patch_item(lecture_id, lecture_id, [
+        {"op": "set", "path": "/title", "value": ""},
+        {"op": "set", "path": "/lecturer", "value": ""}
+    ])
+    function_app.release_lecture_slot(ds.lecture, lecture_id)
+
+
+# Leave the building with no lease, or with a live lease the renew/release cases can name
+def clear_building_lease(ds: Dataset, building: str):
+    try:
+        ds.building.delete_item(building, building)
+    except CosmosResourceNotFoundError:
+        pass
+
+
+def hold_building_lease(ds: Dataset, building: str, lecturer: str):
+    ds.building.upsert_item({
+        "id": building, "type": "buildingLease", "building": building, "lease": BENCH_LEASE,
+        "lecturer": lecturer, "title": "", "module": "", "acquired": time.time(),
+        "expires": time.time() + 300, "ttl": 300
+    })
+
+
+# Route name -> (method, build(i, ds) -> request, prepare(i, ds) run untimed before the call or None)
+def route_cases(run_id: str):
+    def student(ds, i):
+        return ds.students[i % len(ds.students)]
+
+    def lecturer(ds, i):
+        return ds.lecturers[i % len(ds.lecturers)]
+
+    def lecture_id(i):
+        return LECTURE_IDS[i % len(LECTURE_IDS)]
+
+    # A different day per call, so bookings don't clash
+    def day(i):
+        return (BENCH_TERM_START + datetime.timedelta(days=i)).isoformat()
+
+    def building(i):
+        return f"hall-{i % 20}"
+
+    def roster_pick(ds, i):
+        return ds.students[(i // len(LECTURE_IDS)) % len(ds.students)]
+
+    return {
+        "student/enroll": ("POST", lambda i, ds: make_request("POST", "student/enroll", {
+            "name": f"new-student-{run_id}-{i}", "password": PASSWORD, "modules": STUDENT_MODULES[0]
+        }), None),
+        "student/enroll/bulk": ("POST", lambda i, ds: make_request("POST", "student/enroll/bulk", raw=ndjson(
+            {"name": f"bulk-student-{run_id}-{i}-{j}", "password": PASSWORD, "modules": STUDENT_MODULES[j % 3]}
+            for j in range(20)
+        )), None),
+        "student/login": ("POST", lambda i, ds: make_request("POST", "student/login", {
+            "name": student(ds, i), "password": PASSWORD
+        }), None),
+        "lecturer/hire": ("POST", lambda i, ds: make_request("POST", "lecturer/hire", {
+            "name": f"new-lecturer-{run_id}-{i}", "password": PASSWORD, "modules": LECTURER_MODULES[0]
+        }), None),
+        "lecturer/hire/bulk": ("POST", lambda i, ds: make_request("POST", "lecturer/hire/bulk", raw=ndjson(
+            {"name": f"bulk-lecturer-{run_id}-{i}-{j}", "password": PASSWORD, "modules": LECTURER_MODULES[j % 3]}
+            for j in range(20)
+        )), None),
+        "lecturer/login": ("POST", lambda i, ds: make_request("POST", "lecturer/login", {
+            "name": lecturer(ds, i), "password": PASSWORD
+        }), None),
+        "lecture/setModule": ("POST", lambda i, ds: make_request("POST", "lecture/setModule", {
+            "id": lecture_id(i), "title": f"Lecture {i}", "module": "COMP1"
+        }), None),
+        "lecture/setLecturer": ("POST", lambda i, ds: make_request("POST", "lecture/setLecturer", {
+            "id": lecture_id(i), "lecturer": lecturer(ds, i), "date": day(i), "time": "10:00"
+        }), None),
+        "lecture/student/add": ("POST", lambda i, ds: make_request("POST", "lecture/student/add", {
+            "id": lecture_id(i), "student": roster_pick(ds, i)
+        }), lambda i, ds: ensure_not_in_lecture(ds, lecture_id(i), [roster_pick(ds, i)])),
+        "lecture/student/remove": ("POST", lambda i, ds: make_request("POST", "lecture/student/remove", {
+            "id": lecture_id(i), "student": roster_pick(ds, i)
+        }), lambda i, ds: ensure_in_lecture(ds, lecture_id(i), [roster_pick(ds, i)])),
+        "lecture/students/batch": ("POST", lambda i, ds: make_request("POST", "lecture/students/batch", {
+            "id": lecture_id(i),
+            "add": [student(ds, i * 10 + j) for j in range(10)],
+            "remove": [student(ds, i * 10 + 10 + j) for j in range(10)]
+        }), lambda i, ds: ensure_in_lecture(ds, lecture_id(i), [student(ds, i * 10 + 10 + j) for j in range(10)])),
+        "lecture/attendance": ("GET", lambda i, ds: make_request("GET", "lecture/attendance", params={
+            "id": lecture_id(i)
+        }), None),
+        "lecture/end": ("POST", lambda i, ds: make_request("POST", "lecture/end", {"id": lecture_id(i)}), None),
+        "lecture/make": ("POST", lambda i, ds: make_request("POST", "lecture/make", {
+            "title": f"Lecture {i}", "module": "COMP1", "lecturer": lecturer(ds, i),
+            "date": day(i), "time": "14:00", "building": "Main"
+        }), lambda i, ds: free_lecture_slot(ds, lecture_id(i)) if i % 2 == 0 else None),
+        "building/lease/acquire": ("POST", lambda i, ds: make_request("POST", "building/lease/acquire", {
+            "building": building(i), "lecturer": lecturer(ds, i), "title": f"Lecture {i}", "module": "COMP1"
+        }), lambda i, ds: clear_building_lease(ds, building(i)) if i % 2 == 0 else None),
+        "building/lease/renew": ("POST", lambda i, ds: make_request("POST", "building/lease/renew", {
+            "building": building(i), "lease": BENCH_LEASE
+        }), lambda i, ds: hold_building_lease(ds, building(i), lecturer(ds, i))),
+        "building/lease/release": ("POST", lambda i, ds: make_request("POST", "building/lease/release", {
+            "building": building(i), "lease": BENCH_LEASE
+        }), lambda i, ds: hold_building_lease(ds, building(i), lecturer(ds, i))),
+        "booking/free": ("GET", lambda i, ds: make_request("GET", "booking/free", params={
+            "date": day(i % 5), "lecturer": lecturer(ds, i), "building": "Main"
+        }), None),
+        "booking/timetable/import": ("POST", lambda i, ds: make_request("POST", "booking/timetable/import", {
+            "bookings": [
+                {"lecturer": lecturer(ds, i), "building": f"room-{i}", "date": day(100000 + i * 20 + j), "time": "09:00"}
+                for j in range(20)
+            ]
+        }), None),
+        "module/students": ("GET", lambda i, ds: make_request("GET", "module/students", params={
+            "module": STUDENT_MODULES[i % 3][0], "limit": "100"
+        }), None),
+        "views/sync": ("POST", lambda i, ds: make_request("POST", "views/sync"),
+                       lambda i, ds: ds.lecture.patch_item(lecture_id(i), lecture_id(i), [
+                           {"op": "set", "path": "/title", "value": f"Lecture {i}"}
+                       ])),
+        "lecturer/timetable": ("GET", lambda i, ds: make_request("GET", "lecturer/timetable", params={
+            "name": lecturer(ds, i)
+        }), None),
+        "building/current": ("GET", lambda i, ds: make_request("GET", "building/current", params={
+            "building": "Main"
+        }), None),
+        "module/counts": ("GET", lambda i, ds: make_request("GET", "module/counts"), None),
+        "chat/append": ("POST", lambda i, ds: make_request("POST", "chat/append", {
+            "lecture": BENCH_LECTURE, "user": student(ds, i), "message": f"message {i}", "time": "10:00:00"
+        }), None),
+        "board/save": ("POST", lambda i, ds: make_request("POST", "board/save", {
+            "lecture": BENCH_LECTURE, "user": lecturer(ds, i), "content": f"<p>board {i}</p>" * 200
+        }), None),
+        "board/changes": ("GET", lambda i, ds: make_request("GET", "board/changes", params={
+            "lecture": BENCH_LECTURE, "since": str(30 + i % 10)
+        }), None),
+        "board/revision": ("GET", lambda i, ds: make_request("GET", "board/revision", params={
+            "lecture": BENCH_LECTURE, "revision": str(i % 40)
+        }), None),
+        "chat/history": ("GET", lambda i, ds: make_request("GET", "chat/history", params={
+            "lecture": BENCH_LECTURE, "limit": "50", **({"cursor": function_app.encode_history_cursor(i % 20, None)} if i % 2 else {})
+        }), None),
+        "lecture/history": ("GET", lambda i, ds: make_request("GET", "lecture/history", params={
+            "lecture": BENCH_LECTURE, "limit": "50"
+        }), None),
+        "student/modules/get": ("GET", lambda i, ds: make_request("GET", "student/modules/get", params={
+            "name": student(ds, i)
+        }), None),
+        "student/modules/replace": ("POST", lambda i, ds: make_request("POST", "student/modules/replace", {
+            "name": student(ds, i), "modules": STUDENT_MODULES[i % 3]
+        }), None),
+        "lecturer/modules/get": ("GET", lambda i, ds: make_request("GET", "lecturer/modules/get", params={
+            "name": lecturer(ds, i)
+        }), None),
+        "lecturer/modules/replace": ("POST", lambda i, ds: make_request("POST", "lecturer/modules/replace", {
+            "name": lecturer(ds, i), "modules": LECTURER_MODULES[i % 3]
+        }), None),
+        # Login and the module lookups a client makes right after it, in one call
+        "batch": ("POST", lambda i, ds: make_request("POST", "batch", {"requests": [
+            {"id": "login", "route": "student/login", "method": "POST",
+             "body": {"name": student(ds, i), "password": PASSWORD}},
+            {"id": "modules", "route": "student/modules/get", "params": {"name": student(ds, i)}},
+            {"id": "lecture", "route": "lecture/attendance", "params": {"id": lecture_id(i)}},
+        ]}), None),
+        "cache/stats": ("GET", lambda i, ds: make_request("GET", "cache/stats"), None),
+        "metrics": ("GET", lambda i, ds: make_request("GET", "metrics"), None),
+    }
+
+
+# route -> handler function, from the app's route registry
+def route_handlers() -> dict:
+    return {route: r.handler for route, r in function_app.app.routes.items()}
+
+
+def percentile(sorted_values: list, pct: float) -> float:
+    if not sorted_values:
+        return 0.0
+    k = (len(sorted_values) - 1) * pct / 100
+    lo = int(k)
+    hi = min(lo + 1, len(sorted_values) - 1)
+    return sorted_values[lo] + (sorted_values[hi] - sorted_values[lo]) * (k - lo)
+
+
+def bench_route(handler, build, prepare, ds: Dataset, iterations: int, warmup: int, alloc_samples: int) -> dict:
+    for i in range(warmup):
+        if prepare:
+            prepare(i, ds)
+        handler(build(i, ds))
+
+    latencies = []
+    statuses = Counter()
+    calls = Counter()
+    charge = 0.0
+
+    for i in range(warmup, warmup + iterations):
+        if prepare:
+            prepare(i, ds)
+        req = build(i, ds)
+        calls_before, charge_before = ds.backend_snapshot()
+
+        start = time.perf_counter_ns()
+        resp = handler(req)
+        latencies.append((time.perf_counter_ns() - start) / 1000)
+
+        calls_after, charge_after = ds.backend_snapshot()
+        calls.update(calls_after - calls_before)
+        charge += charge_after - charge_before
+        statuses[str(resp.status_code)] += 1
+
+    # Allocation pass, separate so tracing overhead doesn't skew latencies
+    peaks = []
+    tracemalloc.start()
+    try:
+        base = warmup + iterations
+        for i in range(base, base + alloc_samples):
+            if prepare:
+                prepare(i, ds)
+            req = build(i, ds)
+            tracemalloc.reset_peak()
+            current, _ = tracemalloc.get_traced_memory()
+            handler(req)
+            peaks.append(tracemalloc.get_traced_memory()[1] - current)
+    finally:
+        tracemalloc.stop()
+
+    latencies.sort()
+    return {
+        "iterations": iterations,
+        "latency_us": {
+            "p50": round(percentile(latencies, 50), 2),
+            "p90": round(percentile(latencies, 90), 2),
+            "p99": round(percentile(latencies, 99), 2),
+            "mean": round(sum(latencies) / len(latencies), 2),
+            "max": round(latencies[-1], 2),
+        },
+        "alloc_peak_bytes": {
+            "mean": round(sum(peaks) / len(peaks)) if peaks else 0,
+            "max": max(peaks) if peaks else 0,
+        },
+        "backend_calls_per_request": {op: round(n / iterations, 3) for op, n in sorted(calls.items())},
+        "request_charge_per_request": round(charge / iterations, 3),
+        "status": dict(statuses),
+    }
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=APP_DIR, stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+
+def run(sizes: list, iterations: int, warmup: int, alloc_samples: int, only: list, backend: str) -> dict:
+    handlers = route_handlers()
+    run_id = str(int(time.time()))
+    cases = route_cases(run_id)
+
+    uncovered = sorted(set(handlers) - set(cases))
+    if uncovered:
+        print(f"warning: no benchmark case for {', '.join(uncovered)}", file=sys.stderr)
+
+    results = {}
+    workdir = tempfile.mkdtemp(prefix="bench-routes-")
+    try:
+        for size in sizes:
+            results[str(size)] = {}
+            for route, (method, build, prepare) in cases.items():
+                if only and route not in only:
+                    continue
+                if route not in handlers:
+                    print(f"warning: route {route} is not registered, skipped", file=sys.stderr)
+                    continue
+
+                ds = Dataset(size, backend, workdir)
+                result = bench_route(handlers[route], build, prepare, ds, iterations, warmup, alloc_samples)
+                results[str(size)][route] = result
+                lat = result["latency_us"]
+                print(
+                    f"size={size:<7} {route:<28} p50={lat['p50']:>9.1f}us p99={lat['p99']:>9.1f}us "
+                    f"calls={sum(result['backend_calls_per_request'].values()):.2f} "
+                    f"RU={result['request_charge_per_request']:.2f}"
+                )
+    finally:
+        function_app.reset_storage_clients()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    return {
+        "meta": {
+            "commit": git_commit(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "iterations": iterations,
+            "warmup": warmup,
+            "backend": backend,
+        },
+        "results": results,
+    }
+
+
+# Print per-route changes between two result files; exit 1 if any p50/p99 grew past threshold
+def compare(old_path: str, new_path: str, threshold: float) -> int:
+    with open(old_path) as f:
+        old = json.load(f)
+    with open(new_path) as f:
+        new = json.load(f)
+
+    regressions = 0
+    print(f"{old['meta'].get('commit') or old_path} -> {new['meta'].get('commit') or new_path}")
+    for size, routes in new["results"].items():
+        for route, result in routes.items():
+            before = old["results"].get(size, {}).get(route)
+            if before is None:
+                print(f"size={size:<7} {route:<28} new")
+                continue
+
+            flags = []
+            for pct in ("p50", "p99"):
+                a, b = before["latency_us"][pct], result["latency_us"][pct]
+                ratio = b / a if a else 1.0
+                flags.append(f"{pct} {a:.1f}->{b:.1f}us ({ratio:.2f}x)")
+                if ratio > threshold:
+                    regressions += 1
+            calls_a = sum(before["backend_calls_per_request"].values())
+            calls_b = sum(result["backend_calls_per_request"].values())
+            if calls_b > calls_a:
+                regressions += 1
+            flags.append(f"calls {calls_a:.2f}->{calls_b:.2f}")
+            flags.append(f"RU {before['request_charge_per_request']:.2f}->{result['request_charge_per_request']:.2f}")
+            print(f"size={size:<7} {route:<28} " + "  ".join(flags))
+
+    return 1 if regressions else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark function_app routes against in-memory containers")
+    parser.add_argument("--sizes", default="100,1000", help="comma separated dataset sizes (students)")
+    parser.add_argument("--iterations", type=int, default=200)
+    parser.add_argument("--warmup", type=int, default=20)
+    parser.add_argument("--alloc-samples", type=int, default=20)
+    parser.add_argument("--backend", choices=["memory", "sqlite"], default="memory")
+    parser.add_argument("--routes", default="", help="comma separated routes to run, default all")
+    parser.add_argument("--output", help="write results JSON here")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"), help="diff two result files")
+    parser.add_argument("--threshold", type=float, default=1.2, help="latency ratio counted as a regression")
+    args = parser.parse_args()
+
+    if args.compare:
+        sys.exit(compare(args.compare[0], args.compare[1], args.threshold))
+
+    sizes = [int(s) for s in args.sizes.split(",") if s.strip()]
+    only = [r.strip() for r in args.routes.split(",") if r.strip()]
+    report = run(sizes, args.iterations, args.warmup, args.alloc_samples, only, args.backend)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+        print(f"wrote {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,36 @@
+# Whiteboard revisions as deltas.
+# A delta is [start, removed, inserted]: replace the `removed` characters at `start` with the
+# text `inserted`. Board edits are typing, pasting or deleting in one place between two saves,
+# so trimming the common prefix and suffix finds the change in one pass; anything else is a
+# delta that replaces the middle, never more than the new content itself.
+
+
+def diff(old: str, new: str) -> list:
+    limit = min(len(old), len(new))
+    start = 0
+    while start < limit and old[start] == new[start]:
+        start += 1
+
+    end = 0
+    while end < limit - start and old[len(old) - 1 - end] == new[len(new) - 1 - end]:
+        end += 1
+
+    return [start, len(old) - start - end, new[start:len(new) - end]]
+
+
+def apply(text: str, delta: list) -> str:
+    start, removed, inserted = delta
+    if not 0 <= start <= len(text) or start + removed > len(text):
+        raise ValueError("delta does not fit the text")
+    return text[:start] + inserted + text[start + removed:]
+
+
+def replay(text: str, deltas) -> str:
+    for delta in deltas:
+        text = apply(text, delta)
+    return text
+
+
+# Characters a delta carries; compaction compares this with the size of a snapshot
+def weight(delta: list) -> int:
+    return len(delta[2]) + 16
@@ -0,0 +1,102 @@
+# Interval indexes for lecturer and building bookings.
+# A resource's bookings are one list of [start, end, id] entries sorted by start, where start
+# and end are "YYYY-MM-DDTHH:MM" strings (they sort like the times they name). No booking is
+# longer than MAX_DURATION, so a clash check or a day's bookings is a binary search plus the
+# few entries it lands on, never a scan of the term. Bookings of one resource don't overlap,
+# except for a moment while a lecture moves within its own time and holds both.
+import bisect
+import datetime
+
+TIME_FORMAT = "%Y-%m-%dT%H:%M"
+DEFAULT_DURATION = 60
+MIN_DURATION = 5
+MAX_DURATION = 8 * 60
+DAY_START = "08:00"
+DAY_END = "18:00"
+
+
+def _parse(stamp: str) -> datetime.datetime:
+    return datetime.datetime.strptime(stamp, TIME_FORMAT)
+
+
+def minutes_between(start: str, end: str) -> int:
+    return int((_parse(end) - _parse(start)).total_seconds() // 60)
+
+
+# [start, end) of a booking on date at time lasting duration minutes; None unless it ends that day
+def interval(date: str, time: str, duration: int):
+    start = f"{date}T{time}"
+    end = (_parse(start) + datetime.timedelta(minutes=duration)).strftime(TIME_FORMAT)
+    if not end.startswith(date):
+        return None
+    return start, end
+
+
+# The entry overlapping [start, end), or None; bookings with an id in ignore don't count
+def find_clash(entries: list, start: str, end: str, ignore=()):
+    # Nothing starting this long before start can reach it
+    earliest = (_parse(start) - datetime.timedelta(minutes=MAX_DURATION)).strftime(TIME_FORMAT)
+    i = bisect.bisect_left(entries, [end])
+    while i > 0:
+        i -= 1
+        entry = entries[i]
+        if entry[0] <= earliest:
+            return None
+        if entry[1] > start and entry[2] not in ignore:
+            return entry
+    return None
+
+
+def add(entries: list, entry: list):
+    bisect.insort(entries, list(entry))
+
+
+# Drop the booking [start, end, id]; True if it was there
+def remove(entries: list, entry: list) -> bool:
+    i = bisect.bisect_left(entries, [entry[0]])
+    while i < len(entries) and entries[i][0] == entry[0]:
+        if entries[i][2] == entry[2]:
+            del entries[i]
+            return True
+        i += 1
+    return False
+
+
+# Entries starting on date
+def on_day(entries: list, date: str) -> list:
+    lo = bisect.bisect_left(entries, [f"{date}T"])
+    hi = bisect.bisect_left(entries, [f"{date}T~"])
+    return entries[lo:hi]
+
+
+# Gaps of at least duration minutes between day_start and day_end on date that are free in
+# every one of the given indexes
+def free_slots(indexes, date: str, duration: int, day_start: str = DAY_START, day_end: str = DAY_END) -> list:
+    cursor, close = f"{date}T{day_start}", f"{date}T{day_end}"
+    busy = sorted(entry for entries in indexes for entry in on_day(entries, date))
+
+    free = []
+    for start, end, _ in busy:
+        if start >= close:
+            break
+        if end <= cursor:
+            continue
+        if start > cursor and minutes_between(cursor, start) >= duration:
+            free.append([cursor, start])
+        cursor = max(cursor, end)
+
+    if cursor < close and minutes_between(cursor, close) >= duration:
+        free.append([cursor, close])
+    return free
+
+
+# Pairs of overlapping entries within one batch of new bookings for the same resource
+def batch_clashes(entries: list) -> list:
+    clashes = []
+    latest = None
+    for entry in sorted(entries):
+        if latest is not None and entry[0] < latest[1]:
+            clashes.append((latest, entry))
+        if latest is None or entry[1] > latest[1]:
+            latest = entry
+    return clashes
@@ -0,0 +1,121 @@
+# JSON encoding and decoding of request and response bodies.
+# orjson is used when it is installed (bytes in and out, several times faster on large
+# payloads), otherwise the stdlib json module with the same compact separators.
+# Size limits are checked before anything is decoded: a JSON body against its byte limit, an
+# NDJSON body line by line as it is read, so an oversized request costs a length check and
+# records past the limit are never parsed.
+# Large list responses are encoded in chunks straight from their items (json_list_chunks,
+# ndjson_chunks), so no single intermediate copy of the whole document is built.
+# The Python worker's HttpResponse takes a complete body, so the chunks are joined once.
+import itertools
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+BACKEND = "orjson" if orjson is not None else "json"
+CHUNK_BYTES = 64 * 1024
+CHUNK_ITEMS = 1000
+NOT_JSON = "not a correct json"
+
+
+class BodyTooLarge(ValueError):
+    def __init__(self, msg: str):
+        super().__init__(msg)
+
+
+# Raised by iter_ndjson at the first record over max_records
+class TooManyRecords(ValueError):
+    def __init__(self, line: int, limit: int):
+        super().__init__(f"at most {limit} records per request")
+        self.line = line
+        self.limit = limit
+
+
+if orjson is not None:
+    def dumps(obj) -> bytes:
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+
+    def loads(data):
+        return orjson.loads(data)
+else:
+    _encoder = json.JSONEncoder(separators=(",", ":"))
+
+    def dumps(obj) -> bytes:
+        return _encoder.encode(obj).encode("utf-8")
+
+    def loads(data):
+        return json.loads(data)
+
+
+# Decoded JSON body; BodyTooLarge over max_bytes, ValueError when it isn't JSON
+def parse(body: bytes, max_bytes: int = None):
+    if max_bytes is not None and len(body) > max_bytes:
+        raise BodyTooLarge(f"body must be at most {max_bytes} bytes")
+    return loads(body)
+
+
+# Yield (line_number, data, error) for each non-blank NDJSON line. error is None, or why the
+# line wasn't decoded (data is None then): not JSON, or longer than max_line_bytes, in which
+# case it isn't even copied out of the body.
+def iter_ndjson(body: bytes, max_line_bytes: int = None, max_records: int = None):
+    start = 0
+    line_no = 0
+    records = 0
+    while start < len(body):
+        end = body.find(b"\n", start)
+        if end == -1:
+            end = len(body)
+        line_no += 1
+        line_start, start = start, end + 1
+
+        oversized = max_line_bytes is not None and end - line_start > max_line_bytes
+        raw = b"" if oversized else body[line_start:end].strip()
+        if not oversized and not raw:
+            continue
+        records += 1
+        if max_records is not None and records > max_records:
+            raise TooManyRecords(line_no, max_records)
+
+        if oversized:
+            yield line_no, None, f"record must be at most {max_line_bytes} bytes"
+            continue
+        try:
+            data, error = loads(raw), None
+        except ValueError:
+            data, error = None, NOT_JSON
+        yield line_no, data, error
+
+
+def ndjson_chunks(records, chunk_bytes: int = CHUNK_BYTES):
+    buf = []
+    size = 0
+    for record in records:
+        line = dumps(record) + b"\n"
+        buf.append(line)
+        size += len(line)
+        if size >= chunk_bytes:
+            yield b"".join(buf)
+            buf = []
+            size = 0
+    if buf:
+        yield b"".join(buf)
+
+
+# payload as a JSON object whose key member (the list items, last in the object) is encoded
+# chunk_items items at a time
+def json_list_chunks(payload: dict, key: str, items, chunk_items: int = CHUNK_ITEMS):
+    head = dumps({k: v for k, v in payload.items() if k != key})
+    yield head[:-1] + (b"," if len(head) > 2 else b"") + dumps(key) + b":["
+
+    items = iter(items)
+    separator = b""
+    while True:
+        part = list(itertools.islice(items, chunk_items))
+        if not part:
+            break
+        yield separator + dumps(part)[1:-1]
+        separator = b","
+    yield b"]}"
@@ -1,58 +1,289 @@
+import attendance
 import azure.functions as func
+import base64
+import batch
+import bisect
+import board_delta
+import bookings
+import codec
+import contextvars
+import copy
 import datetime
+import heapq
+import http_encoding
+import idempotency
 import json
 import logging
 import os
+import random
+import threading
+import time
+import unicodedata
 import uuid
-from azure.cosmos import CosmosClient
-
-app = func.FunctionApp()
+import zoneinfo
+from concurrent.futures import ThreadPoolExecutor
+from azure.core import MatchConditions
+from azure.cosmos.exceptions import (
+    CosmosAccessConditionFailedError,
+    CosmosResourceExistsError,
+    CosmosResourceNotFoundError
+)
+from metrics import MetricsFunctionApp, in_current_context, instrument_container, registry as metrics_registry
+from profile_cache import ProfileCache
+from profiling import phase, span
+from session_tokens import issue_token, verify_token
+from storage import backend_kind, open_backend
+from throttling import AdmissionController, RetryingContainer, RetryPolicy, admit, is_throttle
+from write_behind import WriteBehindBuffer
+
+# Retries of throttled (429) container calls, within a per-request budget (see throttling.py)
+retry_policy = RetryPolicy(
+    retries=int(os.environ.get("RequestRetryBudget", "3")),
+    max_wait=int(os.environ.get("RequestRetryMaxWaitMs", "2000")) / 1000
+)
+
+# Requests a second this worker admits (AdmissionRate, 0 admits everything) and the burst
+# above that; the rate backs off while the database is throttling
+admission = AdmissionController(
+    rate=float(os.environ.get("AdmissionRate", "200")),
+    burst=float(os.environ.get("AdmissionBurst", "400")),
+    exempt=("metrics", "cache/stats")
+)
+retry_policy.admission = admission
+
+# Responses of at least CompressMinBytes are compressed for clients that accept it
+COMPRESS_MIN_BYTES = int(os.environ.get("CompressMinBytes", "1024"))
+
+# Largest JSON request body parse_json decodes (JsonBodyMaxBytes), bigger ones get 413
+JSON_BODY_MAX_BYTES = int(os.environ.get("JsonBodyMaxBytes", str(4 * 1024 * 1024)))
+
+# Every route: admission control, then ETag / 304 handling and compression (http_encoding.py)
+def route_guard(route: str, fn):
+    return admit(route, http_encoding.negotiated(fn, COMPRESS_MIN_BYTES), admission, retry_policy)
+
+app = MetricsFunctionApp(guard=route_guard)
 
 # Helpers
 # Return JSON with propper content type and status code
-def json_resp(payload: dict, status: int = 200) -> func.HttpResponse:
+def json_resp(payload: dict, status: int = 200, headers: dict = None) -> func.HttpResponse:
+    return func.HttpResponse(
+        body=codec.dumps(payload),
+        status_code=status,
+        headers=headers,
+        mimetype="application/json"
+    )
+
+# Same for a payload with a large list under key, encoded item by item (see codec.py)
+def json_list_resp(payload: dict, key: str, status: int = 200, headers: dict = None) -> func.HttpResponse:
     return func.HttpResponse(
-        body=json.dumps(payload),
+        body=b"".join(codec.json_list_chunks(payload, key, payload[key])),
         status_code=status,
+        headers=headers,
         mimetype="application/json"
     )
 
+# Return NDJSON, one record per line
+def ndjson_resp(records, status: int = 200) -> func.HttpResponse:
+    return func.HttpResponse(
+        body=b"".join(codec.ndjson_chunks(records)),
+        status_code=status,
+        mimetype="application/x-ndjson"
+    )
+
 # Safely parse JSON body
 # Return (data, error_response)
 def parse_json(req: func.HttpRequest):
     try:
-        return req.get_json(), None
+        with span("parse_json"):
+            return codec.parse(req.get_body() or b"", JSON_BODY_MAX_BYTES), None
+    except codec.BodyTooLarge as e:
+        return None, json_resp({"result": False, "msg": str(e)}, status=413)
     except Exception as e:
         logging.error(f"JSON parse error: {e}")
         return None, json_resp({"result": False, "msg": "not a correct json"}, status=400)
      
-def get_cosmos_db():
-    cosmos_conn = os.environ.get("AzureCosmosDBConnectionString")
-    if not cosmos_conn:
-        raise ValueError("Missing AzureCosmosDBConnectionString in environment")
-
-    db_name = os.environ.get("DatabaseName", "university-database")
-
-    cosmos = CosmosClient.from_connection_string(cosmos_conn)
-    return cosmos.get_database_client(db_name)
+# Process-wide storage backend, opened lazily on first use and reused across invocations.
+# DatabaseName selects it: a Cosmos database name, "memory:" or "sqlite:///path" (see storage/)
+_storage_lock = threading.Lock()
+_storage_backend = None
+_container_clients = {}
+
+def database_setting() -> str:
+    return os.environ.get("DatabaseName", "university-database")
+
+def get_storage_backend():
+    global _storage_backend
+
+    if _storage_backend is not None:
+        return _storage_backend
+
+    with _storage_lock:
+        if _storage_backend is None:
+            with span("client_construction"):
+                _storage_backend = open_backend(database_setting())
+
+    return _storage_backend
+
+# Gets a container client, cached per container name
+def get_container(env_name: str, default_name: str):
+    container_name = os.environ.get(env_name, default_name)
+
+    container = _container_clients.get(container_name)
+    if container is None:
+        backend = get_storage_backend()
+        with _storage_lock:
+            container = _container_clients.get(container_name)
+            if container is None:
+                with span("client_construction"):
+                    container = RetryingContainer(instrument_container(backend.get_container(container_name)), retry_policy)
+                _container_clients[container_name] = container
+    return container
+
+# Drops the shared backend so the next call opens a fresh one (e.g. after a transport fault)
+def reset_storage_clients():
+    global _storage_backend
+
+    with _storage_lock:
+        backend = _storage_backend
+        _storage_backend = None
+        _container_clients.clear()
+
+    if backend is not None:
+        backend.close()
 
 # Gets the lecture container
 def get_lecture_container():
-    db = get_cosmos_db()
-    lecture_container_name = os.environ.get("LectureContainerName", "lecture")
-    return db.get_container_client(lecture_container_name)
+    return get_container("LectureContainerName", "lecture")
 
 # Gets the lecturer container
 def get_lecturer_container():
-    db = get_cosmos_db()
-    lecturer_container_name = os.environ.get("LecturerContainerName", "lecturer")
-    return db.get_container_client(lecturer_container_name)
+    return get_container("LecturerContainerName", "lecturer")
 
 # Gets the student container
 def get_student_container():
-    db = get_cosmos_db()
-    student_container_name = os.environ.get("StudentContainerName", "student")
-    return db.get_container_client(student_container_name)
+    return get_container("StudentContainerName", "student")
+
+# Gets the buildings container
+def get_building_container():
+    return get_container("BuildingContainerName", "buildings")
+
+# Gets the module enrolment index container
+def get_module_container():
+    return get_container("ModuleContainerName", "modules")
+
+# Gets the container of kept Idempotency-Key responses
+def get_idempotency_container():
+    return get_container("IdempotencyContainerName", "idempotency")
+
+# Idempotency-Key handling for write routes (see idempotency.py). Responses are kept in memory
+# for IdempotencyTtlSeconds; IdempotencyStore=container also keeps them in the idempotency
+# container, so retries that reach another worker are answered too. A worker's claim on a key
+# there lasts IdempotencyLeaseSeconds, which must outlast the slowest handler (Azure gives up
+# on an HTTP request after 230 seconds); duplicates wait IdempotencyWaitSeconds for it.
+idempotency_keys = idempotency.IdempotencyKeys(
+    ttl_seconds=float(os.environ.get("IdempotencyTtlSeconds", "86400")),
+    max_size=int(os.environ.get("IdempotencyCacheSize", "10000")),
+    wait_seconds=float(os.environ.get("IdempotencyWaitSeconds", "10")),
+    lease_seconds=float(os.environ.get("IdempotencyLeaseSeconds", "240")),
+    store=idempotency.ContainerResultStore(get_idempotency_container)
+    if os.environ.get("IdempotencyStore", "memory") == "container" else None
+)
+
+def idempotent(fn):
+    return idempotency.idempotent(idempotency_keys, fn)
+
+# Name-keyed documents
+# Student and lecturer ids are derived from the normalized name, and the containers are
+# partitioned on /id like the lecture container, so a lookup by name is a single point read.
+NAME_KEY_NAMESPACE = uuid.UUID("6f1c2a7e-3d4b-5c8e-9a10-b2c3d4e5f607")
+
+def normalize_name(name: str) -> str:
+    return unicodedata.normalize("NFC", (name or "").strip())
+
+def student_doc_id(name: str) -> str:
+    return str(uuid.uuid5(NAME_KEY_NAMESPACE, "student:" + normalize_name(name)))
+
+def lecturer_doc_id(name: str) -> str:
+    return str(uuid.uuid5(NAME_KEY_NAMESPACE, "lecturer:" + normalize_name(name)))
+
+# Documents created before name keys still have uuid4 ids. On a database from before them, set
+# LegacyNameLookup=true until scripts/migrate_name_keys.py has re-keyed them: lookups that miss
+# the point read then fall back to the old cross-partition query, and enroll/hire check it too
+def legacy_name_lookup_enabled() -> bool:
+    return os.environ.get("LegacyNameLookup", "false").strip().lower() in ("1", "true", "yes")
+
+def query_by_name(container, alias: str, name: str):
+    docs = list(container.query_items(
+        query=f"SELECT * FROM {alias} WHERE {alias}.name = @name",
+        parameters=[{"name": "@name", "value": name}],
+        enable_cross_partition_query=True
+    ))
+    return docs[0] if docs else None
+
+def find_by_name(container, alias: str, doc_id: str, name: str):
+    try:
+        return container.read_item(item=doc_id, partition_key=doc_id)
+    except CosmosResourceNotFoundError:
+        pass
+
+    if not legacy_name_lookup_enabled():
+        return None
+
+    return query_by_name(container, alias, name)
+
+# Gets a student document by name, or None
+def get_student_by_name(name: str):
+    return find_by_name(get_student_container(), "s", student_doc_id(name), name)
+
+# Gets a lecturer document by name, or None
+def get_lecturer_by_name(name: str):
+    return find_by_name(get_lecturer_container(), "l", lecturer_doc_id(name), name)
+
+# Read-through profile cache shared by every invocation on this worker
+profile_cache = ProfileCache(
+    max_size=int(os.environ.get("ProfileCacheSize", "1024")),
+    ttl_seconds=float(os.environ.get("ProfileCacheTtlSeconds", "30"))
+)
+
+# Lookup memo of the batch the running request belongs to (see the batch route), else None.
+# Inside a batch, profile lookups go through it first so every sub-request sees the same copy.
+batch_memo = contextvars.ContextVar("batch_memo", default=None)
+
+def cached_profile(key, loader):
+    memo = batch_memo.get()
+    if memo is None:
+        return profile_cache.get_or_load(key, loader)
+    return memo.get_or_load(key, lambda: profile_cache.get_or_load(key, loader))
+
+async def cached_profile_async(key, loader):
+    memo = batch_memo.get()
+    if memo is None:
+        return await profile_cache.get_or_load_async(key, loader)
+    return await memo.get_or_load_async(key, lambda: profile_cache.get_or_load_async(key, loader))
+
+# Refresh the cached (and memoized) copy after a write
+def remember_profile(key, doc: dict):
+    profile_cache.put(key, doc)
+    memo = batch_memo.get()
+    if memo is not None:
+        memo.put(key, doc)
+
+# Cached student document by name, or None. Returns a copy so callers can edit it.
+def get_student_profile(name: str):
+    doc = cached_profile(("student", student_doc_id(name)), lambda: get_student_by_name(name))
+    return copy.deepcopy(doc)
+
+# Cached lecturer document by name, or None. Returns a copy so callers can edit it.
+def get_lecturer_profile(name: str):
+    doc = cached_profile(("lecturer", lecturer_doc_id(name)), lambda: get_lecturer_by_name(name))
+    return copy.deepcopy(doc)
+
+# Refresh the cached copy after a write
+def cache_student(doc: dict):
+    remember_profile(("student", student_doc_id(doc["name"])), doc)
+
+def cache_lecturer(doc: dict):
+    remember_profile(("lecturer", lecturer_doc_id(doc["name"])), doc)
 
 # Fixed uni modules
 ALLOWED_MODULES = {
@@ -70,110 +301,218 @@ ALLOWED_MODULES = {
         "MATH3"
     }
 
-# enroll a student. json: {"name": "string", "password": "string", "modules": ["MODL1","MODL2"]}
-@app.route(route="student/enroll", auth_level=func.AuthLevel.FUNCTION, methods=["POST"])
-def student_enroll(req: func.HttpRequest) -> func.HttpResponse:
-    logging.info('student/enroll')
+# Session tokens
+# Logins return a signed token; later calls send it as "Authorization: Bearer <token>"
+# so routes can trust the caller's identity without reading their document again.
+
+# Verified session claims for role, or None
+def get_session(req: func.HttpRequest, role: str = None):
+    scheme, _, token = (req.headers.get("Authorization") or "").partition(" ")
+    if scheme.lower() != "bearer":
+        return None
+
+    claims = verify_token(token.strip())
+    if claims is None or (role is not None and claims.get("role") != role):
+        return None
+    return claims
+
+# True when the request carries a valid session for this name and role
+def has_session_for(req: func.HttpRequest, role: str, name: str) -> bool:
+    claims = get_session(req, role)
+    return claims is not None and claims.get("name") == name
+
+# Add a fresh session token to a response payload, when signing keys are configured
+def with_session_token(payload: dict, doc: dict, role: str) -> dict:
+    token = issue_token(doc.get("id"), doc.get("name"), role, doc.get("modules", []))
+    if token:
+        payload["token"] = token
+    return payload
+
+# Login, shared by both login routes here and in function_app_async.py
+# Return (name, password, error_response)
+def login_fields(data: dict):
+    name = (data.get("name") or "").strip()
+    password = (data.get("password") or "").strip()
+
+    if not name:
+        return None, None, json_resp({"result": False, "msg": "name is required"}, status=400)
+
+    if not password:
+        return None, None, json_resp({"result": False, "msg": "password is required"}, status=400)
+
+    return name, password, None
+
+# The refusal for a login with this document (None when not found), or None to let it in
+def login_refused(doc, password: str, role: str):
+    if not doc:
+        return json_resp({"result": False, "msg": f"{role} not found"}, status=404)
+
+    if doc.get("password") != password:
+        return json_resp({"result": False, "msg": "password or name incorrect"}, status=401)
+
+    return None
+
+# Lecturer documents from before bookings get the field on their first login
+def needs_bookings_field(doc: dict, role: str) -> bool:
+    return role == "lecturer" and "bookings" not in doc
+
+# Successful login: write the fresh document through to the cache, answer with a session token
+def login_response(doc: dict, role: str) -> func.HttpResponse:
+    if role == "student":
+        cache_student(doc)
+    else:
+        cache_lecturer(doc)
+
+    return json_resp(
+        with_session_token(
+            {
+                "result": True,
+                "msg": "OK",
+                role: {
+                    "id": doc.get("id"),
+                    "name": doc.get("name"),
+                    "modules": doc.get("modules", [])
+                }
+            },
+            doc,
+            role
+        ),
+        status=200
+    )
 
+def login(req: func.HttpRequest, role: str) -> func.HttpResponse:
     data, err = parse_json(req)
     if err:
         return err
 
-    student_name = (data.get("name") or "").strip()
-    student_password = (data.get("password") or "").strip()
-    student_modules = data.get("modules") or []
+    name, password, err = login_fields(data)
+    if err:
+        return err
 
-    # Validate student name
-    if not student_name:
-        return json_resp(
-            {"result": False, "msg": "student must have a name"},
-            status=400
-        )
+    doc = get_student_by_name(name) if role == "student" else get_lecturer_by_name(name)
 
-    # Validate student password
-    if not student_password:
-        return json_resp(
-            {"result": False, "msg": "student must have a password"},
-            status=400
-        )
+    err = login_refused(doc, password, role)
+    if err:
+        return err
 
-    if len(student_password) < 8 or len(student_password) > 12:
-        return json_resp(
-            {
-                "result": False,
-                "msg": "password must be between 8 and 12 characters long"
-            },
-            status=400
-        )
+    # Ensure bookings array exists
+    if needs_bookings_field(doc, role):
+        doc["bookings"] = []
+        doc = get_lecturer_container().replace_item(item=doc["id"], body=doc)
+
+    return login_response(doc, role)
+
+# Enroll/hire validation, shared by the single and bulk routes
+MEMBER_RULES = {
+    "student": {"module_count": 4, "module_msg": "students must have 4 modules"},
+    "lecturer": {"module_count": 3, "module_msg": "lecturers must have exactly 3 modules"},
+}
+
+# Validate an enroll/hire body
+# Return (member, error_payload), member is {"name", "password", "modules"}
+@phase("validate")
+def validate_member(data, role: str):
+    rules = MEMBER_RULES[role]
+
+    if not isinstance(data, dict):
+        return None, {"result": False, "msg": "not a correct json"}
+
+    member_name = (data.get("name") or "").strip()
+    member_password = (data.get("password") or "").strip()
+    member_modules = data.get("modules") or []
+
+    # Validate name
+    if not member_name:
+        return None, {"result": False, "msg": f"{role} must have a name"}
+
+    # Validate password
+    if not member_password:
+        return None, {"result": False, "msg": f"{role} must have a password"}
+
+    if len(member_password) < 8 or len(member_password) > 12:
+        return None, {
+            "result": False,
+            "msg": "password must be between 8 and 12 characters long"
+        }
 
     # Validate modules list exist
-    if not isinstance(student_modules, list) or len(student_modules) == 0:
-        return json_resp(
-            {"result": False, "msg": "student must provide modules"},
-            status=400
-        )
+    if not isinstance(member_modules, list) or len(member_modules) == 0:
+        return None, {"result": False, "msg": f"{role} must provide modules"}
 
     # Clean modules, remove duplicates
-    cleaned_modules = []
-    seen = set()
-
-    for m in student_modules:
-        if isinstance(m, str):
-            mm = m.strip()
-            if mm and mm not in seen:
-                seen.add(mm)
-                cleaned_modules.append(mm)
+    cleaned_modules = clean_unique_modules(member_modules)
 
     if not cleaned_modules:
-        return json_resp(
-            {"result": False, "msg": "modules must be valid strings"},
-            status=400
-        )
+        return None, {"result": False, "msg": "modules must be valid strings"}
 
-    # Exactly 4 modules
-    if len(cleaned_modules) != 4:
-        return json_resp(
-            {"result": False, "msg": "students must have 4 modules"},
-            status=400
-        )
+    # Exactly 4 (students) or 3 (lecturers) modules
+    if len(cleaned_modules) != rules["module_count"]:
+        return None, {"result": False, "msg": rules["module_msg"]}
 
     # Validate modules
     invalid_modules = [m for m in cleaned_modules if m not in ALLOWED_MODULES]
     if invalid_modules:
-        return json_resp(
-            {
-                "result": False,
-                "msg": "invalid module(s)",
-                "invalid": invalid_modules,
-                "allowed": sorted(ALLOWED_MODULES)
-            },
-            status=400
-        )
+        return None, {
+            "result": False,
+            "msg": "invalid module(s)",
+            "invalid": invalid_modules,
+            "allowed": sorted(ALLOWED_MODULES)
+        }
+
+    return {"name": member_name, "password": member_password, "modules": cleaned_modules}, None
+
+def new_student_doc(member: dict) -> dict:
+    return {
+        "id": student_doc_id(member["name"]),
+        "name": member["name"],
+        "password": member["password"],
+        "modules": member["modules"],
+    }
 
-    StudentContainer = get_student_container()
+def new_lecturer_doc(member: dict) -> dict:
+    return {
+        "id": lecturer_doc_id(member["name"]),
+        "name": member["name"],
+        "password": member["password"],
+        "modules": member["modules"],
+        "lectures": [],
+        "bookings": []
+    }
 
-    # Check if student already exists
-    students = list(StudentContainer.query_items(
-        query="SELECT * FROM s WHERE s.name = @name",
-        parameters=[{"name": "@name", "value": student_name}],
-        enable_cross_partition_query=True
-    ))
+# enroll a student. json: {"name": "string", "password": "string", "modules": ["MODL1","MODL2"]}
+@app.route(route="student/enroll", auth_level=func.AuthLevel.FUNCTION, methods=["POST"])
+@idempotent
+def student_enroll(req: func.HttpRequest) -> func.HttpResponse:
+    logging.info('student/enroll')
+
+    data, err = parse_json(req)
+    if err:
+        return err
+
+    member, invalid = validate_member(data, "student")
+    if invalid:
+        return json_resp(invalid, status=400)
+
+    StudentContainer = get_student_container()
 
-    if students:
+    # Check if an un-migrated student already exists
+    if legacy_name_lookup_enabled() and query_by_name(StudentContainer, "s", member["name"]):
         return json_resp(
             {"result": False, "msg": "student already exists"},
             status=409
         )
 
-    # Create student document
-    new_student = {
-        "id": str(uuid.uuid4()),
-        "name": student_name,
-        "password": student_password,
-        "modules": cleaned_modules,
-    }
+    # Create student document, the name-derived id makes a duplicate name a conflict
+    try:
+        created = StudentContainer.create_item(body=new_student_doc(member))
+    except CosmosResourceExistsError:
+        return json_resp(
+            {"result": False, "msg": "student already exists"},
+            status=409
+        )
 
-    StudentContainer.create_item(body=new_student)
+    cache_student(created)
+    update_module_index(module_index_changes([(created["name"], [], created["modules"])]))
 
     return json_resp({"result": True, "msg": "OK"}, status=201)
 
@@ -182,610 +521,2681 @@ def student_enroll(req: func.HttpRequest) -> func.HttpResponse:
 @app.route(route="student/login", auth_level=func.AuthLevel.FUNCTION, methods=["POST"])
 def student_login(req: func.HttpRequest) -> func.HttpResponse:
     logging.info("student/login")
+    return login(req, "student")
+
+
+# hire a lecturer
+# json: {"name": "string", "password": "string", "modules": ["MOD1","MOD2","MOD3"]}
+@app.route(route="lecturer/hire", auth_level=func.AuthLevel.FUNCTION, methods=["POST"])
+@idempotent
+def lecturer_hire(req: func.HttpRequest) -> func.HttpResponse:
+    logging.info("lecturer/hire")
 
     data, err = parse_json(req)
     if err:
         return err
 
-    student_name = (data.get("name") or "").strip()
-    student_password = (data.get("password") or "").strip()
+    member, invalid = validate_member(data, "lecturer")
+    if invalid:
+        return json_resp(invalid, status=400)
 
-    # Validate student name
-    if not student_name:
+    LecturerContainer = get_lecturer_container()
+
+    # Check if an un-migrated lecturer already exists
+    if legacy_name_lookup_enabled() and query_by_name(LecturerContainer, "l", member["name"]):
         return json_resp(
-            {"result": False, "msg": "name is required"},
-            status=400
+            {"result": False, "msg": "lecturer already exists"},
+            status=409
         )
 
-    # Validate student password
-    if not student_password:
+    # Create lecturer document, the name-derived id makes a duplicate name a conflict
+    try:
+        created = LecturerContainer.create_item(body=new_lecturer_doc(member))
+    except CosmosResourceExistsError:
         return json_resp(
-            {"result": False, "msg": "password is required"},
-            status=400
+            {"result": False, "msg": "lecturer already exists"},
+            status=409
         )
 
-    StudentContainer = get_student_container()
+    cache_lecturer(created)
 
-    students = list(StudentContainer.query_items(
-        query="SELECT * FROM s WHERE s.name = @name",
-        parameters=[{"name": "@name", "value": student_name}],
-        enable_cross_partition_query=True
-    ))
+    return json_resp({"result": True, "msg": "OK"}, status=201)
 
-    if not students:
+# Bulk enroll / hire
+# Body is NDJSON, one enroll/hire json per line. Response is NDJSON with one result per input line:
+# {"line": 1, "name": "string", "status": 201, "result": true, "msg": "OK"}
+# Past NdjsonMaxRecords the last result is a 413 for that line and the rest isn't read.
+# The Python worker hands over the whole request body and takes a whole response body, so
+# neither side is streamed: lines are decoded and written batch by batch as they are read, and
+# the body (NdjsonBodyMaxBytes) and record count are capped so one upload has bounded memory.
+BULK_BATCH_SIZE = int(os.environ.get("BulkBatchSize", "100"))
+BULK_WRITE_CONCURRENCY = int(os.environ.get("BulkWriteConcurrency", "8"))
+
+# Largest body (NdjsonBodyMaxBytes), longest record (NdjsonLineMaxBytes) and most records
+# (NdjsonMaxRecords) per bulk request
+NDJSON_BODY_MAX_BYTES = int(os.environ.get("NdjsonBodyMaxBytes", str(8 * 1024 * 1024)))
+NDJSON_LINE_MAX_BYTES = int(os.environ.get("NdjsonLineMaxBytes", "16384"))
+NDJSON_MAX_RECORDS = int(os.environ.get("NdjsonMaxRecords", "10000"))
+
+# Ids and legacy names in a batch that already exist, checked with one read-many and at most one query
+def find_existing_members(container, alias: str, docs: list):
+    ids = [d["id"] for d in docs]
+    existing_ids = {d["id"] for d in container.read_items(items=[(i, i) for i in ids])}
+
+    existing_names = set()
+    if legacy_name_lookup_enabled():
+        existing_names = set(container.query_items(
+            query=f"SELECT VALUE {alias}.name FROM {alias} WHERE ARRAY_CONTAINS(@names, {alias}.name)",
+            parameters=[{"name": "@names", "value": [d["name"] for d in docs]}],
+            enable_cross_partition_query=True
+        ))
+
+    return existing_ids, existing_names
+
+def bulk_create_members(req: func.HttpRequest, role: str) -> func.HttpResponse:
+    body = req.get_body() or b""
+    if len(body) > NDJSON_BODY_MAX_BYTES:
         return json_resp(
-            {"result": False, "msg": "student not found"},
-            status=404
+            {"result": False, "msg": f"body must be at most {NDJSON_BODY_MAX_BYTES} bytes"},
+            status=413
         )
 
-    student = students[0]
+    if role == "student":
+        container, alias, build_doc, cache_doc = get_student_container(), "s", new_student_doc, cache_student
+    else:
+        container, alias, build_doc, cache_doc = get_lecturer_container(), "l", new_lecturer_doc, cache_lecturer
+
+    exists_msg = f"{role} already exists"
+    busy_msg = "server busy, try again later"
+    results = []
+    pending = []        # (result, doc) waiting for the next batch write
+    seen_names = set()
+
+    def create_one(doc):
+        try:
+            return container.create_item(body=doc), None
+        except CosmosResourceExistsError:
+            return None, exists_msg
+        except Exception as e:
+            if is_throttle(e):
+                return None, busy_msg
+            logging.error(f"bulk create failed for {doc['name']}: {e}")
+            return None, "write failed"
+
+    def flush(pool):
+        docs = [doc for _, doc in pending]
+        existing_ids, existing_names = find_existing_members(container, alias, docs)
+
+        to_write = []
+        for result, doc in pending:
+            if doc["id"] in existing_ids or doc["name"] in existing_names:
+                result.update({"status": 409, "result": False, "msg": exists_msg})
+            else:
+                to_write.append((result, doc))
+
+        enrolled = []
+        for (result, doc), (created, error) in zip(to_write, pool.map(in_current_context(create_one), [d for _, d in to_write])):
+            if created is not None:
+                cache_doc(created)
+                enrolled.append((created["name"], [], created["modules"]))
+                result.update({"status": 201, "result": True, "msg": "OK"})
+            else:
+                status = {exists_msg: 409, busy_msg: 429}.get(error, 500)
+                result.update({"status": status, "result": False, "msg": error})
+
+        # One index write per module shard for the whole batch
+        if role == "student":
+            update_module_index(module_index_changes(enrolled), pool)
+
+        pending.clear()
+
+    with ThreadPoolExecutor(max_workers=BULK_WRITE_CONCURRENCY) as pool:
+        records = codec.iter_ndjson(body, NDJSON_LINE_MAX_BYTES, NDJSON_MAX_RECORDS)
+        while True:
+            try:
+                with span("parse_json"):
+                    line_no, data, error = next(records)
+            except StopIteration:
+                break
+            except codec.TooManyRecords as e:
+                # Records before the limit are still written, the rest of the body is left unread
+                results.append({"line": e.line, "name": "", "status": 413, "result": False, "msg": str(e)})
+                break
+
+            if error:
+                status = 400 if error == codec.NOT_JSON else 413
+                results.append({"line": line_no, "name": "", "status": status, "result": False, "msg": error})
+                continue
+
+            member, invalid = validate_member(data, role)
+            if invalid:
+                name = (data.get("name") or "") if isinstance(data, dict) else ""
+                results.append({"line": line_no, "name": name, "status": 400, **invalid})
+                continue
+
+            result = {"line": line_no, "name": member["name"]}
+            results.append(result)
+
+            if member["name"] in seen_names:
+                result.update({"status": 409, "result": False, "msg": "duplicate name in request"})
+                continue
+            seen_names.add(member["name"])
+
+            pending.append((result, build_doc(member)))
+            if len(pending) >= BULK_BATCH_SIZE:
+                flush(pool)
+
+        if pending:
+            flush(pool)
+
+    if not results:
+        return json_resp({"result": False, "msg": "body must contain NDJSON records"}, status=400)
+
+    return ndjson_resp(results)
+
+# Bulk enroll students, NDJSON body of student/enroll jsons
+@app.route(route="student/enroll/bulk", auth_level=func.AuthLevel.FUNCTION, methods=["POST"])
+def student_enroll_bulk(req: func.HttpRequest) -> func.HttpResponse:
+    logging.info("student/enroll/bulk")
+    return bulk_create_members(req, "student")
+
+# Bulk hire lecturers, NDJSON body of lecturer/hire jsons
+@app.route(route="lecturer/hire/bulk", auth_level=func.AuthLevel.FUNCTION, methods=["POST"])
+def lecturer_hire_bulk(req: func.HttpRequest) -> func.HttpResponse:
+    logging.info("lecturer/hire/bulk")
+    return bulk_create_members(req, "lecturer")
 
-    # Check password
-    if student.get("password") != student_password:
-        return json_resp(
-            {"result": False, "msg": "password or name incorrect"},
-            status=401
-        )
-
-    return json_resp(
-        {
-            "result": True,
-            "msg": "OK",
-            "student": {
-                "id": student.get("id"),
-                "name": student.get("name"),
-                "modules": student.get("modules", [])
-            }
-        },
-        status=200
-    )
+# Lecturer login
+# JSON body example: { "name": "Dr. Alwash", "password": "Password1" }
+@app.route(route="lecturer/login", auth_level=func.AuthLevel.FUNCTION, methods=["POST"])
+def lecturer_login(req: func.HttpRequest) -> func.HttpResponse:
+    logging.info("lecturer/login")
+    return login(req, "lecturer")
 
 
-# hire a lecturer
-# json: {"name": "string", "password": "string", "modules": ["MOD1","MOD2","MOD3"]}
-@app.route(route="lecturer/hire", auth_level=func.AuthLevel.FUNCTION, methods=["POST"])
-def lecturer_hire(req: func.HttpRequest) -> func.HttpResponse:
-    logging.info("lecturer/hire")
+# Validate a lecture/setModule body
+# Return (fields, error_payload)
+@phase("validate")
+def validate_lecture_module(data: dict, require_id: bool = True):
+    lecture_id = (data.get("id") or "").strip()
+    lecture_title = (data.get("title") or "").strip()
+    lecture_module = (data.get("module") or "").strip()
 
-    data, err = parse_json(req)
-    if err:
-        return err
+    # Validate required fields
+    if require_id and not lecture_id:
+        return None, {"result": False, "msg": "id is required"}
 
-    lecturer_name = (data.get("name") or "").strip()
-    lecturer_password = (data.get("password") or "").strip()
-    lecturer_modules = data.get("modules") or []
+    if not lecture_title:
+        return None, {"result": False, "msg": "title is required"}
 
-    # Validate name
-    if not lecturer_name:
-        return json_resp(
-            {"result": False, "msg": "lecturer must have a name"},
-            status=400
-        )
+    if not lecture_module:
+        return None, {"result": False, "msg": "module is required"}
 
-    # Validate password
-    if not lecturer_password:
-        return json_resp(
-            {"result": False, "msg": "lecturer must have a password"},
-            status=400
-        )
+    # Validate module
+    if lecture_module not in ALLOWED_MODULES:
+        return None, {
+            "result": False,
+            "msg": "invalid module",
+            "allowed": sorted(ALLOWED_MODULES)
+        }
+
+    return {"id": lecture_id, "title": lecture_title, "module": lecture_module}, None
+
+# Validate a lecture/setLecturer body
+# Return (fields, error_payload)
+@phase("validate")
+def validate_lecture_schedule(data: dict, require_id: bool = True):
+    lecture_id = (data.get("id") or "").strip()
+    lecture_lecturer = (data.get("lecturer") or "").strip()
+    lecture_date = (data.get("date") or "").strip()   # YYYY-MM-DD
+    lecture_time = (data.get("time") or "").strip()   # HH:MM
 
-    if len(lecturer_password) < 8 or len(lecturer_password) > 12:
-        return json_resp(
-            {"result": False, "msg": "password must be between 8 and 12 characters long"},
-            status=400
-        )
+    # Validate required fields
+    if require_id and not lecture_id:
+        return None, {"result": False, "msg": "id is required"}
 
-    # Validate modules list
-    if not isinstance(lecturer_modules, list) or len(lecturer_modules) == 0:
-        return json_resp(
-            {"result": False, "msg": "lecturer must provide modules"},
-            status=400
-        )
+    if not lecture_lecturer:
+        return None, {"result": False, "msg": "lecturer is required"}
 
-    # Clean modules (remove duplicates)
-    cleaned_modules = []
-    seen = set()
+    if not lecture_date:
+        return None, {"result": False, "msg": "date is required"}
 
-    for m in lecturer_modules:
-        if isinstance(m, str):
-            mm = m.strip()
-            if mm and mm not in seen:
-                seen.add(mm)
-                cleaned_modules.append(mm)
+    if not lecture_time:
+        return None, {"result": False, "msg": "time is required"}
 
-    if not cleaned_modules:
-        return json_resp(
-            {"result": False, "msg": "modules must be valid strings"},
-            status=400
-        )
+    # Validate date format
+    try:
+        datetime.datetime.strptime(lecture_date, "%Y-%m-%d")
+    except ValueError:
+        return None, {"result": False, "msg": "date format must be YYYY-MM-DD"}
 
-    # Exactly 3 modules
-    if len(cleaned_modules) != 3:
-        return json_resp(
-            {"result": False, "msg": "lecturers must have exactly 3 modules"},
-            status=400
-        )
+    # Validate time format
+    try:
+        datetime.datetime.strptime(lecture_time, "%H:%M")
+    except ValueError:
+        return None, {"result": False, "msg": "time format must be HH:MM"}
+
+    # Validate duration (minutes), the lecture has to end the same day
+    lecture_duration = data.get("duration", bookings.DEFAULT_DURATION)
+    if (not isinstance(lecture_duration, int) or isinstance(lecture_duration, bool)
+            or not bookings.MIN_DURATION <= lecture_duration <= bookings.MAX_DURATION):
+        return None, {
+            "result": False,
+            "msg": f"duration must be between {bookings.MIN_DURATION} and {bookings.MAX_DURATION} minutes"
+        }
+
+    if bookings.interval(lecture_date, lecture_time, lecture_duration) is None:
+        return None, {"result": False, "msg": "lecture must end on the same day"}
+
+    return {
+        "id": lecture_id,
+        "lecturer": lecture_lecturer,
+        "date": lecture_date,
+        "time": lecture_time,
+        "duration": lecture_duration
+    }, None
+
+# { "id": "string", "title": "string", "module": "string", "autoRoster": false }
+@app.route(route="lecture/setModule", auth_level=func.AuthLevel.FUNCTION, methods=["POST"])
+def lecture_set_module(req: func.HttpRequest) -> func.HttpResponse:
+    logging.info("lecture/setModule")
 
-    # Validate allowed modules
-    invalid_modules = [m for m in cleaned_modules if m not in ALLOWED_MODULES]
-    if invalid_modules:
-        return json_resp(
-            {
-                "result": False,
-                "msg": "invalid module(s)",
-                "invalid": invalid_modules,
-                "allowed": sorted(ALLOWED_MODULES)
-            },
-            status=400
-        )
+    data, err = parse_json(req)
+    if err:
+        return err
 
-    LecturerContainer = get_lecturer_container()
+    fields, invalid = validate_lecture_module(data)
+    if invalid:
+        return json_resp(invalid, status=400)
 
-    # Check if lecturer already exists
-    lecturers = list(LecturerContainer.query_items(
-        query="SELECT * FROM l WHERE l.name = @name",
-        parameters=[{"name": "@name", "value": lecturer_name}],
-        enable_cross_partition_query=True
-    ))
+    auto_roster, invalid = validate_auto_roster(data)
+    if invalid:
+        return json_resp(invalid, status=400)
 
-    if lecturers:
-        return json_resp(
-            {"result": False, "msg": "lecturer already exists"},
-            status=409
-        )
+    lecture_id = fields["id"]
+    lecture_title = fields["title"]
+    lecture_module = fields["module"]
 
-    # Create lecturer document
-    new_lecturer = {
-        "id": str(uuid.uuid4()),
-        "name": lecturer_name,
-        "password": lecturer_password,
-        "modules": cleaned_modules,
-        "lectures": [],
-        "bookings": []
-    }
+    # The module's students go on the roster in the same write as the module
+    roster = module_roster(lecture_module) if auto_roster else None
 
-    LecturerContainer.create_item(body=new_lecturer)
+    err = patch_lecture(
+        get_lecture_container(),
+        lecture_id,
+        lambda lecture: (set_module_ops(lecture, lecture_title, lecture_module, roster), None)
+    )
+    if err:
+        return err
 
-    return json_resp({"result": True, "msg": "OK"}, status=201)
+    payload = {"result": True, "msg": "lecture module updated"}
+    if roster is not None:
+        payload["rostered"] = len(roster)
+    return json_resp(payload, status=200)
 
-# Lecturer login
-# JSON body example: { "name": "Dr. Alwash", "password": "Password1" }
-@app.route(route="lecturer/login", auth_level=func.AuthLevel.FUNCTION, methods=["POST"])
-def lecturer_login(req: func.HttpRequest) -> func.HttpResponse:
-    logging.info("lecturer/login")
+# The lecture has to end on the day it starts, so with the default duration (60 minutes) a
+# time after 23:00 is refused; pass a shorter duration for a late lecture
+# { "id": "string", "lecturer": "string" , "date": "string", "time": "string", "duration": 60 }
+@app.route(route="lecture/setLecturer", auth_level=func.AuthLevel.FUNCTION, methods=["POST"])
+def lecture_set_lecturer(req: func.HttpRequest) -> func.HttpResponse:
+    logging.info("lecture/setLecturer")
 
     data, err = parse_json(req)
     if err:
         return err
 
-    lecturer_name = (data.get("name") or "").strip()
-    lecturer_password = (data.get("password") or "").strip()
+    fields, invalid = validate_lecture_schedule(data)
+    if invalid:
+        return json_resp(invalid, status=400)
 
-    # Validate name
-    if not lecturer_name:
+    lecture_lecturer = fields["lecturer"]
+
+    # Check if lecturer exists, a session for that lecturer already proves it
+    if not has_session_for(req, "lecturer", lecture_lecturer) and not get_lecturer_profile(lecture_lecturer):
         return json_resp(
-            {"result": False, "msg": "name is required"},
-            status=400
+            {"result": False, "msg": "lecturer not found"},
+            status=404
         )
 
-    # Validate password
-    if not lecturer_password:
-        return json_resp(
-            {"result": False, "msg": "password is required"},
-            status=400
+    # Update, as a patch so roster changes made since the read aren't overwritten
+    scheduled = {}
+    err = patch_lecture(get_lecture_container(), fields["id"], schedule_ops(fields, scheduled))
+    if err:
+        release_booking(scheduled.get("booking"))
+        return err
+
+    release_booking(scheduled.get("previous"))
+
+    return json_resp(
+        {"result": True, "msg": "lecture updated", "booking": scheduled["booking"]},
+        status=200
+    )
+
+# lecture/setLecturer's build_ops for patch_lecture, shared with function_app_async.py. Each
+# attempt books the new time against the booking and building of the lecture as that attempt
+# read it, the lecture's own current booking not counting as a clash; a booking made against
+# an earlier read that no longer matches is released and made again. scheduled ends up with
+# "booking", the one patched in, and "previous", the one it replaces
+def schedule_ops(fields: dict, scheduled: dict):
+    def set_schedule(lecture):
+        previous = lecture.get("booking")
+        building = lecture.get("building") or ""
+        booking = scheduled.get("booking")
+
+        if booking is None or scheduled.get("previous") != previous or booking["building"] != building:
+            release_booking(booking)
+            scheduled.clear()
+            booking, err = book_lecture(fields, building, ignore={previous["id"]} if previous else ())
+            if err:
+                return None, err
+            scheduled.update(booking=booking, previous=previous)
+
+        return [
+            {"op": "set", "path": "/lecturer", "value": fields["lecturer"]},
+            {"op": "set", "path": "/date", "value": fields["date"]},
+            {"op": "set", "path": "/time", "value": fields["time"]},
+            {"op": "set", "path": "/duration", "value": fields["duration"]},
+            {"op": "set", "path": "/booking", "value": booking}
+        ], None
+
+    return set_schedule
+
+# Roster changes are partial-document patches guarded by the lecture's ETag
+ROSTER_PATCH_RETRIES = int(os.environ.get("RosterPatchRetries", "5"))
+MAX_PATCH_OPERATIONS = 10   # Cosmos limit per patch request
+
+# Read the lecture, let build_ops(lecture) return (patch_operations, error_response), then apply
+# the patch only if nobody wrote the lecture since our read. Retries when a concurrent write wins.
+# Return an error response, or None on success
+def patch_lecture(LectureContainer, lecture_id: str, build_ops):
+    for _ in range(ROSTER_PATCH_RETRIES):
+        # Get lecture by id (1-12)
+        try:
+            lecture = LectureContainer.read_item(
+                item=lecture_id,
+                partition_key=lecture_id
+            )
+        except CosmosResourceNotFoundError:
+            return json_resp(
+                {"result": False, "msg": "lecture not found"},
+                status=404
+            )
+
+        ops, err = build_ops(lecture)
+        if err:
+            return err
+
+        # Nothing to change
+        if not ops:
+            return None
+
+        try:
+            LectureContainer.patch_item(
+                item=lecture_id,
+                partition_key=lecture_id,
+                patch_operations=ops,
+                etag=lecture["_etag"],
+                match_condition=MatchConditions.IfNotModified
+            )
+            return None
+        except CosmosAccessConditionFailedError:
+            logging.info(f"lecture {lecture_id} changed during patch, retrying")
+
+    return lecture_busy_resp()
+
+# Answer when every patch attempt lost to another write, shared with function_app_async.py
+def lecture_busy_resp() -> func.HttpResponse:
+    return json_resp(
+        {"result": False, "msg": "lecture is busy, try again"},
+        status=409
+    )
+
+# One "set" op per field, for a single patch request
+def set_field_ops(fields: dict) -> list:
+    ops = [{"op": "set", "path": f"/{k}", "value": v} for k, v in fields.items()]
+    if len(ops) > MAX_PATCH_OPERATIONS:
+        raise ValueError(f"{len(ops)} patch operations, Cosmos takes at most {MAX_PATCH_OPERATIONS}")
+    return ops
+
+# Patch ops that put a lecture slot back to empty (lecture/end), shared with function_app_async.py.
+# That is the Cosmos limit of ops already; "duration" is left as it is, it only means something
+# next to a date and time, and a claim (lecture/make) or lecture/setLecturer writes it again.
+def lecture_reset_ops() -> list:
+    return set_field_ops({
+        "title": "",
+        "module": "",
+        "lecturer": "",
+        "students": [],
+        "date": "",
+        "time": "",
+        "building": "",
+        "roster": [],
+        "attendance": "",
+        "booking": None
+    })
+
+# Roster op builders, shared with function_app_async.py. A lecture set up with autoRoster has
+# its module's students as "roster" with an "attendance" bitmap over it (see attendance.py);
+# students from outside the roster are listed in "students" as before.
+
+def add_student_ops(lecture: dict, student_name: str):
+    i = attendance.position(lecture.get("roster") or [], student_name)
+    if i is not None:
+        bits = attendance.decode(lecture.get("attendance"))
+        if attendance.get(bits, i):
+            return None, json_resp(
+                {"result": False, "msg": "student already in lecture"},
+                status=409
+            )
+        attendance.put(bits, i, True)
+        return [{"op": "set", "path": "/attendance", "value": attendance.encode(bits)}], None
+
+    # CHeck students list exists
+    lecture_students = lecture.get("students")
+
+    # No duplicates
+    if student_name in (lecture_students or []):
+        return None, json_resp(
+            {"result": False, "msg": "student already in lecture"},
+            status=409
         )
 
-    LecturerContainer = get_lecturer_container()
+    if isinstance(lecture_students, list):
+        return [{"op": "add", "path": "/students/-", "value": student_name}], None
+    return [{"op": "set", "path": "/students", "value": [student_name]}], None
 
-    lecturers = list(LecturerContainer.query_items(
-        query="SELECT * FROM l WHERE l.name = @name",
-        parameters=[{"name": "@name", "value": lecturer_name}],
-        enable_cross_partition_query=True
-    ))
+def remove_student_ops(lecture: dict, student_name: str):
+    i = attendance.position(lecture.get("roster") or [], student_name)
+    if i is not None:
+        bits = attendance.decode(lecture.get("attendance"))
+        if attendance.get(bits, i):
+            attendance.put(bits, i, False)
+            return [{"op": "set", "path": "/attendance", "value": attendance.encode(bits)}], None
 
-    if not lecturers:
-        return json_resp(
-            {"result": False, "msg": "lecturer not found"},
+    lecture_students = lecture.get("students") or []
+
+    if student_name not in lecture_students:
+        return None, json_resp(
+            {"result": False, "msg": "student not in lecture"},
             status=404
         )
 
-    lecturer = lecturers[0]
+    # Remove student by its position in the list we read
+    return [{"op": "remove", "path": f"/students/{lecture_students.index(student_name)}"}], None
+
+# Work out the new attendance and per-name outcomes of a batch from the lecture we read
+def roster_batch_ops(lecture: dict, add_names: list, remove_names: list, known: set, outcomes: list):
+    roster = lecture.get("roster") or []
+    bits = attendance.decode(lecture.get("attendance"))
+    students = list(lecture.get("students") or [])
+    outcomes.clear()
+
+    for name in add_names:
+        i = attendance.position(roster, name) if name else None
+        if not name:
+            outcomes.append({"student": name, "action": "add", "result": False, "msg": "student is required"})
+        elif name not in known:
+            outcomes.append({"student": name, "action": "add", "result": False, "msg": "student not found"})
+        elif (i is not None and attendance.get(bits, i)) or name in students:
+            outcomes.append({"student": name, "action": "add", "result": False, "msg": "student already in lecture"})
+        else:
+            if i is not None:
+                attendance.put(bits, i, True)
+            else:
+                students.append(name)
+            outcomes.append({"student": name, "action": "add", "result": True, "msg": "student added to lecture"})
+
+    for name in remove_names:
+        i = attendance.position(roster, name) if name else None
+        if not name:
+            outcomes.append({"student": name, "action": "remove", "result": False, "msg": "student is required"})
+        elif i is not None and attendance.get(bits, i):
+            attendance.put(bits, i, False)
+            outcomes.append({"student": name, "action": "remove", "result": True, "msg": "student removed from lecture"})
+        elif name in students:
+            students.remove(name)
+            outcomes.append({"student": name, "action": "remove", "result": True, "msg": "student removed from lecture"})
+        else:
+            outcomes.append({"student": name, "action": "remove", "result": False, "msg": "student not in lecture"})
+
+    ops = []
+    if bits != attendance.decode(lecture.get("attendance")):
+        ops.append({"op": "set", "path": "/attendance", "value": attendance.encode(bits)})
+    if students != (lecture.get("students") or []):
+        ops.append({"op": "set", "path": "/students", "value": students})
+    return ops, None
+
+# Patch for lecture/setModule. roster is the module's students when auto-rostering, else None.
+def set_module_ops(lecture: dict, title: str, module: str, roster):
+    ops = [
+        {"op": "set", "path": "/title", "value": title},
+        {"op": "set", "path": "/module", "value": module}
+    ]
+
+    # Everyone already in the lecture
+    joined = list(lecture.get("students") or [])
+    joined += attendance.present(lecture.get("roster") or [], lecture.get("attendance"))
+
+    if roster is not None:
+        # Whoever already joined is marked present if they're on the new roster
+        bits = attendance.decode(attendance.empty(len(roster)))
+        walk_ins = []
+        for name in joined:
+            i = attendance.position(roster, name)
+            if i is None:
+                walk_ins.append(name)
+            else:
+                attendance.put(bits, i, True)
+        ops += [
+            {"op": "set", "path": "/roster", "value": roster},
+            {"op": "set", "path": "/attendance", "value": attendance.encode(bits)},
+            {"op": "set", "path": "/students", "value": walk_ins}
+        ]
+    elif lecture.get("roster") and lecture.get("module") != module:
+        # The roster was the old module's, keep who attended as plain students
+        ops += [
+            {"op": "set", "path": "/roster", "value": []},
+            {"op": "set", "path": "/attendance", "value": ""},
+            {"op": "set", "path": "/students", "value": joined}
+        ]
+    return ops
+
+# The module's students in name order, from the module index in one read
+def module_roster(module: str) -> list:
+    ids = [module_index_id(module, shard) for shard in range(MODULE_INDEX_SHARDS)]
+    docs = get_module_container().read_items(items=[(i, i) for i in ids])
+    return list(heapq.merge(*(d.get("students") or [] for d in docs)))
+
+@phase("validate")
+def validate_auto_roster(data: dict):
+    auto_roster = data.get("autoRoster", False)
+    if not isinstance(auto_roster, bool):
+        return None, {"result": False, "msg": "autoRoster must be true or false"}
+    return auto_roster, None
+
+# Validate a lecture/student/add or remove body, shared with function_app_async.py
+# Return (fields, error_payload)
+@phase("validate")
+def validate_lecture_student(data: dict):
+    lecture_id = (data.get("id") or "").strip()
+    student_name = (data.get("student") or "").strip()
 
-    # Check password
-    if lecturer.get("password") != lecturer_password:
-        return json_resp(
-            {"result": False, "msg": "password or name incorrect"},
-            status=401
-        )
+    if not lecture_id:
+        return None, {"result": False, "msg": "id is required"}
 
-    # Ensure bookings array exists
-    if "bookings" not in lecturer:
-        lecturer["bookings"] = []
-        LecturerContainer.replace_item(
-            item=lecturer["id"],
-            body=lecturer
-        )
+    if not student_name:
+        return None, {"result": False, "msg": "student is required"}
 
+    return {"id": lecture_id, "student": student_name}, None
+
+# Validate a lecture/students/batch body; names that aren't strings become "" and are refused
+# per entry by roster_batch_ops
+# Return (fields, error_payload)
+@phase("validate")
+def validate_roster_batch(data: dict):
+    lecture_id = (data.get("id") or "").strip()
+    to_add = data.get("add") or []
+    to_remove = data.get("remove") or []
+
+    if not lecture_id:
+        return None, {"result": False, "msg": "id is required"}
+
+    if not isinstance(to_add, list) or not isinstance(to_remove, list):
+        return None, {"result": False, "msg": "add and remove must be lists"}
+
+    if not to_add and not to_remove:
+        return None, {"result": False, "msg": "add or remove is required"}
+
+    return {
+        "id": lecture_id,
+        "add": [n.strip() if isinstance(n, str) else "" for n in to_add],
+        "remove": [n.strip() if isinstance(n, str) else "" for n in to_remove]
+    }, None
+
+# Roster batch answer, from the outcomes roster_batch_ops recorded
+def roster_batch_response(outcomes: list) -> func.HttpResponse:
     return json_resp(
         {
             "result": True,
-            "msg": "OK",
-            "lecturer": {
-                "id": lecturer.get("id"),
-                "name": lecturer.get("name"),
-                "modules": lecturer.get("modules", [])
-            }
+            "msg": "lecture roster updated",
+            "added": sum(1 for o in outcomes if o["action"] == "add" and o["result"]),
+            "removed": sum(1 for o in outcomes if o["action"] == "remove" and o["result"]),
+            "results": outcomes
         },
         status=200
     )
 
+# {"id": "string", "student" : "string" }
+@app.route(route="lecture/student/add", auth_level=func.AuthLevel.FUNCTION, methods=["POST"])
+@idempotent
+def lecture_student_add(req: func.HttpRequest) -> func.HttpResponse:
+    logging.info("lecture/student/add")
 
-# { "id": "string", "title": "string", "module": "string" } 
-@app.route(route="lecture/setModule", auth_level=func.AuthLevel.FUNCTION, methods=["POST"])
-def lecture_set_module(req: func.HttpRequest) -> func.HttpResponse:
-    logging.info("lecture/setModule")
+    data, err = parse_json(req)
+    if err:
+        return err
+
+    fields, invalid = validate_lecture_student(data)
+    if invalid:
+        return json_resp(invalid, status=400)
+
+    lecture_id, student_name = fields["id"], fields["student"]
+    LectureContainer = get_lecture_container()
+
+    # Check student exists, a session for that student already proves it
+    if not has_session_for(req, "student", student_name) and not get_student_profile(student_name):
+        return json_resp(
+            {"result": False, "msg": "student not found"},
+            status=404
+        )
+
+    # Add student, unless already in the lecture
+    err = patch_lecture(LectureContainer, lecture_id, lambda lecture: add_student_ops(lecture, student_name))
+    if err:
+        return err
+
+    return json_resp(
+        {"result": True, "msg": "student added to lecture"},
+        status=200
+    )
+
+# Add and remove many students in one call
+# { "id": "string", "add": ["string"], "remove": ["string"] }
+@app.route(route="lecture/students/batch", auth_level=func.AuthLevel.FUNCTION, methods=["POST"])
+def lecture_students_batch(req: func.HttpRequest) -> func.HttpResponse:
+    logging.info("lecture/students/batch")
 
     data, err = parse_json(req)
     if err:
         return err
 
-    lecture_id = (data.get("id") or "").strip()
-    lecture_title = (data.get("title") or "").strip()
-    lecture_module = (data.get("module") or "").strip()
+    fields, invalid = validate_roster_batch(data)
+    if invalid:
+        return json_resp(invalid, status=400)
+
+    lecture_id, add_names, remove_names = fields["id"], fields["add"], fields["remove"]
+
+    # Check every student to add exists, in one batched read
+    known = set()
+    candidates = list({n for n in add_names if n})
+    if candidates:
+        existing_ids, existing_names = find_existing_members(
+            get_student_container(),
+            "s",
+            [{"id": student_doc_id(n), "name": n} for n in candidates]
+        )
+        known = {n for n in candidates if student_doc_id(n) in existing_ids or n in existing_names}
 
-    # Validate required fields
+    outcomes = []
+
+    err = patch_lecture(
+        get_lecture_container(),
+        lecture_id,
+        lambda lecture: roster_batch_ops(lecture, add_names, remove_names, known, outcomes)
+    )
+    if err:
+        return err
+
+    return roster_batch_response(outcomes)
+
+# { "id": "string", "studnt": "string" } 
+@app.route(route="lecture/student/remove", auth_level=func.AuthLevel.FUNCTION, methods=["POST"])
+def lecture_student_remove(req: func.HttpRequest) -> func.HttpResponse:
+    logging.info("lecture/student/remove")
+
+    data, err = parse_json(req)
+    if err:
+        return err
+
+    fields, invalid = validate_lecture_student(data)
+    if invalid:
+        return json_resp(invalid, status=400)
+
+    lecture_id, student_name = fields["id"], fields["student"]
+    LectureContainer = get_lecture_container()
+
+    err = patch_lecture(LectureContainer, lecture_id, lambda lecture: remove_student_ops(lecture, student_name))
+    if err:
+        return err
+
+    return json_resp(
+        {"result": True, "msg": "student removed from lecture"},
+        status=200
+    )
+
+# Who is in a lecture: roster students present and absent, plus students from outside the roster
+# GET ?id=string
+@app.route(route="lecture/attendance", auth_level=func.AuthLevel.FUNCTION, methods=["GET"])
+def lecture_attendance(req: func.HttpRequest) -> func.HttpResponse:
+    logging.info("lecture/attendance")
+
+    lecture_id = (req.params.get("id") or "").strip()
     if not lecture_id:
         return json_resp({"result": False, "msg": "id is required"}, status=400)
 
-    if not lecture_title:
-        return json_resp({"result": False, "msg": "title is required"}, status=400)
+    try:
+        lecture = get_lecture_container().read_item(item=lecture_id, partition_key=lecture_id)
+    except CosmosResourceNotFoundError:
+        return json_resp({"result": False, "msg": "lecture not found"}, status=404)
 
-    if not lecture_module:
-        return json_resp({"result": False, "msg": "module is required"}, status=400)
+    roster = lecture.get("roster") or []
+    present = attendance.present(roster, lecture.get("attendance"))
+    walk_ins = lecture.get("students") or []
 
-    # Validate module
-    if lecture_module not in ALLOWED_MODULES:
+    return json_resp(
+        {
+            "result": True,
+            "id": lecture_id,
+            "module": lecture.get("module", ""),
+            "rostered": len(roster),
+            "present": present,
+            "absent": attendance.absent(roster, lecture.get("attendance")),
+            "walkIns": walk_ins,
+            "count": len(present) + len(walk_ins)
+        },
+        status=200
+    )
+
+# { "id": "string"} 
+@app.route(route="lecture/end", auth_level=func.AuthLevel.FUNCTION, methods=["POST"])
+def lecture_end(req: func.HttpRequest) -> func.HttpResponse:
+    logging.info("lecture/end")
+
+    data, err = parse_json(req)
+    if err:
+        return err
+
+    lecture_id = (data.get("id") or "").strip()
+
+    # Validate input
+    if not lecture_id:
         return json_resp(
-            {
-                "result": False,
-                "msg": "invalid module",
-                "allowed": sorted(ALLOWED_MODULES)
-            },
+            {"result": False, "msg": "id is required"},
             status=400
         )
 
     LectureContainer = get_lecture_container()
 
-    # Get lecture by id (1-12)
+    # Reset lecture in one patch, remembering the booking it clears from the same read
+    ended = {}
+
+    def reset(lecture):
+        ended["booking"] = lecture.get("booking")
+        return lecture_reset_ops(), None
+
+    err = patch_lecture(LectureContainer, lecture_id, reset)
+    if err:
+        return err
+
+    # The slot is free again for lecture/make, and its time for other bookings
+    release_lecture_slot(LectureContainer, lecture_id)
+    release_booking(ended.get("booking"))
+
+    return json_resp(
+        {"result": True, "msg": "lecture reset successfully"},
+        status=200
+    )
+
+# Free lecture slots
+# Lectures live in slot documents "1", "2", ... of the lecture container. The "lecture-slots"
+# document next to them lists the free ones, so lecture/make claims a slot with point operations
+# instead of scanning, and adds slot "next" when none is free. The claim itself is the
+# conditional write on the slot, so the list is only a hint: a slot filled some other way
+# (lecture/setLecturer) fails the claim and is dropped from the list, lecture/end puts it back.
+LECTURE_SLOTS_ID = "lecture-slots"
+LECTURE_CLAIM_RETRIES = int(os.environ.get("LectureClaimRetries", "8"))
+
+def lecture_slot_free(slot: dict) -> bool:
+    return not slot.get("title") and not slot.get("lecturer")
+
+# Gets the free-slot index, building it from the slot documents the first time
+def read_lecture_slots(LectureContainer):
+    try:
+        return LectureContainer.read_item(item=LECTURE_SLOTS_ID, partition_key=LECTURE_SLOTS_ID)
+    except CosmosResourceNotFoundError:
+        pass
+
+    slots = [
+        s for s in LectureContainer.query_items(
+            query="SELECT c.id, c.title, c.lecturer FROM c WHERE NOT IS_DEFINED(c.type)",
+            enable_cross_partition_query=True
+        )
+        if isinstance(s.get("id"), str) and s["id"].isdigit()
+    ]
+    free = sorted((s["id"] for s in slots if lecture_slot_free(s)), key=int)
+
+    try:
+        return LectureContainer.create_item(body={
+            "id": LECTURE_SLOTS_ID,
+            "type": "lectureSlots",
+            "free": free,
+            "next": max((int(s["id"]) for s in slots), default=0) + 1
+        })
+    except CosmosResourceExistsError:
+        return LectureContainer.read_item(item=LECTURE_SLOTS_ID, partition_key=LECTURE_SLOTS_ID)
+
+# Drop a slot from the free list, if it is still there
+def unlist_lecture_slot(LectureContainer, slots: dict, slot_id: str):
+    for _ in range(LECTURE_CLAIM_RETRIES):
+        free = slots.get("free") or []
+        if slot_id not in free:
+            return
+        try:
+            LectureContainer.patch_item(
+                item=LECTURE_SLOTS_ID,
+                partition_key=LECTURE_SLOTS_ID,
+                patch_operations=[{"op": "remove", "path": f"/free/{free.index(slot_id)}"}],
+                etag=slots["_etag"],
+                match_condition=MatchConditions.IfNotModified
+            )
+            return
+        except CosmosAccessConditionFailedError:
+            slots = read_lecture_slots(LectureContainer)
+
+# Put a slot back on the free list, once
+def release_lecture_slot(LectureContainer, slot_id: str):
+    if not slot_id.isdigit():
+        return
     try:
-        lecture = LectureContainer.read_item(
-            item=lecture_id,
-            partition_key=lecture_id
+        LectureContainer.patch_item(
+            item=LECTURE_SLOTS_ID,
+            partition_key=LECTURE_SLOTS_ID,
+            patch_operations=[{"op": "add", "path": "/free/-", "value": slot_id}],
+            filter_predicate=f'FROM c WHERE NOT ARRAY_CONTAINS(c.free, "{slot_id}")'
         )
-    except Exception:
+    except CosmosAccessConditionFailedError:
+        pass    # already listed
+    except CosmosResourceNotFoundError:
+        pass    # the index is built from the slots on the next lecture/make
+
+# Claim a free slot (or a new one) for the lecture fields in one conditional write
+# Return (lecture document, error_response)
+def claim_lecture_slot(LectureContainer, lecture: dict):
+    for _ in range(LECTURE_CLAIM_RETRIES):
+        slots = read_lecture_slots(LectureContainer)
+        free = slots.get("free") or []
+
+        if free:
+            # Spread concurrent claims over the free slots
+            slot_id = random.choice(free)
+            try:
+                slot = LectureContainer.read_item(item=slot_id, partition_key=slot_id)
+            except CosmosResourceNotFoundError:
+                slot = None
+
+            if slot is None or not lecture_slot_free(slot):
+                # Taken since it was listed, or gone
+                unlist_lecture_slot(LectureContainer, slots, slot_id)
+                continue
+
+            # The lecture has more fields than one patch takes (MAX_PATCH_OPERATIONS), so the
+            # claim replaces the slot, only if nobody wrote it since the read
+            body = {k: v for k, v in slot.items() if not k.startswith("_")}
+            body.update(lecture)
+            try:
+                doc = LectureContainer.replace_item(
+                    item=slot_id,
+                    body=body,
+                    etag=slot["_etag"],
+                    match_condition=MatchConditions.IfNotModified
+                )
+            except (CosmosAccessConditionFailedError, CosmosResourceNotFoundError):
+                continue    # written since the read, look again
+
+            unlist_lecture_slot(LectureContainer, slots, slot_id)
+            return doc, None
+
+        # No free slot: reserve the next id, then create that slot already claimed
+        try:
+            slots = LectureContainer.patch_item(
+                item=LECTURE_SLOTS_ID,
+                partition_key=LECTURE_SLOTS_ID,
+                patch_operations=[{"op": "incr", "path": "/next", "value": 1}],
+                etag=slots["_etag"],
+                match_condition=MatchConditions.IfNotModified
+            )
+        except CosmosAccessConditionFailedError:
+            continue
+
+        slot_id = str(slots["next"] - 1)
+        try:
+            return LectureContainer.create_item(body={"id": slot_id, **lecture}), None
+        except CosmosResourceExistsError:
+            logging.warning(f"lecture slot {slot_id} already exists, skipping it")
+
+    return None, json_resp(
+        {"result": False, "msg": "no lecture slot available, try again"},
+        status=409
+    )
+
+# { "title": "string", "module": "string", "lecturer": "string", "date": "string", "time": "string", "duration": 60, "building": "string", "autoRoster": false }
+@app.route(route="lecture/make", auth_level=func.AuthLevel.FUNCTION, methods=["POST"])
+def lecture_make(req: func.HttpRequest) -> func.HttpResponse:
+    logging.info("lecture/make")
+
+    data, err = parse_json(req)
+    if err:
+        return err
+
+    module_fields, invalid = validate_lecture_module(data, require_id=False)
+    if invalid:
+        return json_resp(invalid, status=400)
+
+    schedule_fields, invalid = validate_lecture_schedule(data, require_id=False)
+    if invalid:
+        return json_resp(invalid, status=400)
+
+    auto_roster, invalid = validate_auto_roster(data)
+    if invalid:
+        return json_resp(invalid, status=400)
+
+    building = data.get("building") or ""
+    if not isinstance(building, str):
+        return json_resp({"result": False, "msg": "building must be a string"}, status=400)
+    building = building.strip()
+    if building and not valid_building_name(building):
+        return json_resp({"result": False, "msg": "invalid building name"}, status=400)
+
+    lecturer = schedule_fields["lecturer"]
+
+    # Check if lecturer exists, a session for that lecturer already proves it
+    if not has_session_for(req, "lecturer", lecturer) and not get_lecturer_profile(lecturer):
         return json_resp(
-            {"result": False, "msg": "lecture not found"},
+            {"result": False, "msg": "lecturer not found"},
             status=404
         )
 
-    lecture["title"] = lecture_title
-    lecture["module"] = lecture_module
+    booking, err = book_lecture(schedule_fields, building)
+    if err:
+        return err
+
+    roster = module_roster(module_fields["module"]) if auto_roster else []
 
-    LectureContainer.replace_item(
-        item=lecture["id"],
-        body=lecture
-    )
+    lecture, err = claim_lecture_slot(get_lecture_container(), {
+        "title": module_fields["title"],
+        "module": module_fields["module"],
+        "lecturer": lecturer,
+        "date": schedule_fields["date"],
+        "time": schedule_fields["time"],
+        "duration": schedule_fields["duration"],
+        "building": building,
+        "students": [],
+        "booking": booking,
+        "roster": roster,
+        "attendance": attendance.empty(len(roster)) if roster else ""
+    })
+    if err:
+        release_booking(booking)
+        return err
 
     return json_resp(
-        {"result": True, "msg": "lecture module updated"},
-        status=200
+        {
+            "result": True,
+            "msg": "lecture created",
+            "id": lecture["id"],
+            "lecture": {k: v for k, v in lecture.items() if not k.startswith("_")}
+        },
+        status=201
     )
 
-# { "id": "string", "lecturer": "string" , "date": "string", "time": "string" }
-@app.route(route="lecture/setLecturer", auth_level=func.AuthLevel.FUNCTION, methods=["POST"])
-def lecture_set_lecturer(req: func.HttpRequest) -> func.HttpResponse:
-    logging.info("lecture/setLecturer")
+
+# helpers for new lecture APIs
+def clean_unique_modules(mods):
+    if not isinstance(mods, list):
+        return []
+    cleaned = []
+    seen = set()
+    for m in mods:
+        if isinstance(m, str):
+            mm = m.strip()
+            if mm and mm not in seen:
+                seen.add(mm)
+                cleaned.append(mm)
+    return cleaned
+
+# Building leases
+# A lecture holds its building through a lease document in the buildings container, keyed by
+# building name. Leases are taken, renewed and released with point reads and etag-conditional
+# writes, so any number of Node instances can share them, and they run out on their own: a lease
+# past "expires" may be taken over, and its "ttl" lets Cosmos delete it (switch Time to Live on
+# for the container, with no default). The lease id returned by acquire is the holder's proof
+# for renew and release.
+BUILDING_LEASE_TTL = int(os.environ.get("BuildingLeaseTtlSeconds", "300"))
+BUILDING_LEASE_MIN_TTL = 15
+BUILDING_LEASE_MAX_TTL = 3600
+BUILDING_LEASE_RETRIES = int(os.environ.get("BuildingLeaseRetries", "5"))
+INVALID_ID_CHARS = set("/\\?#")
+
+# Building names are document ids in the buildings container
+def valid_building_name(building: str) -> bool:
+    return (
+        len(building) <= 255
+        and not any(ch in INVALID_ID_CHARS for ch in building)
+        and not building.startswith(BUILDING_CALENDAR_PREFIX)
+    )
+
+def read_building_lease(BuildingContainer, building: str):
+    try:
+        return BuildingContainer.read_item(item=building, partition_key=building)
+    except CosmosResourceNotFoundError:
+        return None
+
+def lease_active(lease, now: float) -> bool:
+    return lease is not None and lease.get("expires", 0) > now
+
+# Lease fields for responses; the lease id only goes to its holder
+def lease_view(lease: dict, holder: bool) -> dict:
+    fields = ["building", "lecturer", "title", "module", "acquired", "expires"]
+    if holder:
+        fields.append("lease")
+    return {k: lease.get(k) for k in fields}
+
+# Return (fields, error_payload) for the named string fields plus the optional ttl
+@phase("validate")
+def validate_building_lease(data: dict, required):
+    fields = {}
+    for name in required:
+        value = data.get(name)
+        value = value.strip() if isinstance(value, str) else ""
+        if not value:
+            return None, {"result": False, "msg": f"{name} is required"}
+        fields[name] = value
+
+    if not valid_building_name(fields["building"]):
+        return None, {"result": False, "msg": "invalid building name"}
+
+    ttl = data.get("ttl")
+    if ttl is not None:
+        if not isinstance(ttl, int) or isinstance(ttl, bool) or not BUILDING_LEASE_MIN_TTL <= ttl <= BUILDING_LEASE_MAX_TTL:
+            return None, {
+                "result": False,
+                "msg": f"ttl must be between {BUILDING_LEASE_MIN_TTL} and {BUILDING_LEASE_MAX_TTL} seconds"
+            }
+    fields["ttl"] = ttl
+
+    return fields, None
+
+# { "building": "string", "lecturer": "string", "title": "string", "module": "string", "ttl": 300 }
+@app.route(route="building/lease/acquire", auth_level=func.AuthLevel.FUNCTION, methods=["POST"])
+def building_lease_acquire(req: func.HttpRequest) -> func.HttpResponse:
+    logging.info("building/lease/acquire")
 
     data, err = parse_json(req)
     if err:
         return err
 
-    lecture_id = (data.get("id") or "").strip()
-    lecture_lecturer = (data.get("lecturer") or "").strip()
-    lecture_date = (data.get("date") or "").strip()   # YYYY-MM-DD
-    lecture_time = (data.get("time") or "").strip()   # HH:MM
+    fields, invalid = validate_building_lease(data, ("building", "lecturer"))
+    if invalid:
+        return json_resp(invalid, status=400)
 
-    # Validate required fields
-    if not lecture_id:
-        return json_resp({"result": False, "msg": "id is required"}, status=400)
+    building, lecturer = fields["building"], fields["lecturer"]
+    ttl = fields["ttl"] or BUILDING_LEASE_TTL
 
-    if not lecture_lecturer:
-        return json_resp({"result": False, "msg": "lecturer is required"}, status=400)
+    # Check if lecturer exists, a session for that lecturer already proves it
+    if not has_session_for(req, "lecturer", lecturer) and not get_lecturer_profile(lecturer):
+        return json_resp({"result": False, "msg": "lecturer not found"}, status=404)
 
-    if not lecture_date:
+    BuildingContainer = get_building_container()
+
+    for _ in range(BUILDING_LEASE_RETRIES):
+        now = time.time()
+        current = read_building_lease(BuildingContainer, building)
+
+        held = lease_active(current, now)
+        if held and current.get("lecturer") != lecturer:
+            return json_resp(
+                {"result": False, "msg": "building in use", "lease": lease_view(current, holder=False)},
+                status=409
+            )
+
+        # The same lecturer acquiring again keeps (and extends) their lease
+        doc = {
+            "id": building,
+            "type": "buildingLease",
+            "building": building,
+            "lease": current["lease"] if held else uuid.uuid4().hex,
+            "lecturer": lecturer,
+            "title": str(data.get("title") or ""),
+            "module": str(data.get("module") or ""),
+            "acquired": current["acquired"] if held else now,
+            "expires": now + ttl,
+            "ttl": ttl
+        }
+        try:
+            if current is None:
+                saved = BuildingContainer.create_item(body=doc)
+            else:
+                saved = BuildingContainer.upsert_item(
+                    body=doc,
+                    etag=current["_etag"],
+                    match_condition=MatchConditions.IfNotModified
+                )
+        except (CosmosResourceExistsError, CosmosAccessConditionFailedError):
+            continue    # someone else wrote the lease first, look again
+
+        return json_resp(
+            {"result": True, "msg": "building lease acquired", "lease": lease_view(saved, holder=True)},
+            status=200
+        )
+
+    return json_resp({"result": False, "msg": "building lease busy, try again"}, status=409)
+
+# { "building": "string", "lease": "string", "ttl": 300 }
+@app.route(route="building/lease/renew", auth_level=func.AuthLevel.FUNCTION, methods=["POST"])
+def building_lease_renew(req: func.HttpRequest) -> func.HttpResponse:
+    logging.info("building/lease/renew")
+
+    data, err = parse_json(req)
+    if err:
+        return err
+
+    fields, invalid = validate_building_lease(data, ("building", "lease"))
+    if invalid:
+        return json_resp(invalid, status=400)
+
+    BuildingContainer = get_building_container()
+
+    for _ in range(BUILDING_LEASE_RETRIES):
+        now = time.time()
+        current = read_building_lease(BuildingContainer, fields["building"])
+
+        # Once expired the lease may already be someone else's, so it has to be acquired again
+        if not lease_active(current, now) or current.get("lease") != fields["lease"]:
+            return json_resp({"result": False, "msg": "building lease lost"}, status=409)
+
+        ttl = fields["ttl"] or current.get("ttl") or BUILDING_LEASE_TTL
+        doc = {k: v for k, v in current.items() if not k.startswith("_")}
+        doc["expires"] = now + ttl
+        doc["ttl"] = ttl
+        try:
+            saved = BuildingContainer.upsert_item(
+                body=doc,
+                etag=current["_etag"],
+                match_condition=MatchConditions.IfNotModified
+            )
+        except CosmosAccessConditionFailedError:
+            continue
+
+        return json_resp(
+            {"result": True, "msg": "building lease renewed", "lease": lease_view(saved, holder=True)},
+            status=200
+        )
+
+    return json_resp({"result": False, "msg": "building lease busy, try again"}, status=409)
+
+# { "building": "string", "lease": "string" }
+@app.route(route="building/lease/release", auth_level=func.AuthLevel.FUNCTION, methods=["POST"])
+def building_lease_release(req: func.HttpRequest) -> func.HttpResponse:
+    logging.info("building/lease/release")
+
+    data, err = parse_json(req)
+    if err:
+        return err
+
+    fields, invalid = validate_building_lease(data, ("building", "lease"))
+    if invalid:
+        return json_resp(invalid, status=400)
+
+    BuildingContainer = get_building_container()
+
+    for _ in range(BUILDING_LEASE_RETRIES):
+        current = read_building_lease(BuildingContainer, fields["building"])
+
+        # Releasing twice, or after the lease ran out and was taken over, is not an error
+        if current is None or current.get("lease") != fields["lease"]:
+            return json_resp({"result": True, "msg": "building lease already released"}, status=200)
+
+        try:
+            BuildingContainer.delete_item(
+                item=fields["building"],
+                partition_key=fields["building"],
+                etag=current["_etag"],
+                match_condition=MatchConditions.IfNotModified
+            )
+        except CosmosResourceNotFoundError:
+            pass
+        except CosmosAccessConditionFailedError:
+            continue
+
+        return json_resp({"result": True, "msg": "building lease released"}, status=200)
+
+    return json_resp({"result": False, "msg": "building lease busy, try again"}, status=409)
+
+# Bookings
+# Every lecturer and building has an interval index of its bookings (see bookings.py), one
+# document per day in the buildings container: "calendar:lecturer:<lecturer id>:<date>" and
+# "calendar:building:<building>:<date>". A booking ends on the day it starts, so it sits in
+# exactly one day document, and booking or freeing a time reads and rewrites that day only,
+# never the whole term. Bookings are added with etag-conditional writes that re-check for
+# clashes against the day being written, so two requests can't take the same time; when a
+# later index clashes, the ones already written are undone. Lectures keep their booking
+# (id, lecturer, building, start, end) in "booking". Bookings made before the day documents
+# (a "bookings" list per lecturer document or "calendar:<building>" document) are moved into
+# them by scripts/migrate_booking_days.py.
+BUILDING_CALENDAR_PREFIX = "calendar:"
+BOOKING_RETRIES = int(os.environ.get("BookingRetries", "5"))
+MAX_TIMETABLE_BOOKINGS = int(os.environ.get("MaxTimetableBookings", "5000"))
+
+# Lecture dates and times are wall-clock times where the lectures are held, in the IANA zone
+# LectureTimeZone. The worker's own clock is UTC on Azure, so "now" is taken in that zone.
+LECTURE_TIME_ZONE = os.environ.get("LectureTimeZone", "Europe/London")
+try:
+    LECTURE_ZONE = zoneinfo.ZoneInfo(LECTURE_TIME_ZONE)
+except (zoneinfo.ZoneInfoNotFoundError, ValueError):
+    logging.warning(f"unknown LectureTimeZone {LECTURE_TIME_ZONE!r}, using UTC")
+    LECTURE_ZONE = datetime.timezone.utc
+
+# Current date and time in the lectures' zone, naive like the stored dates and times
+def lecture_now() -> datetime.datetime:
+    return datetime.datetime.now(LECTURE_ZONE).replace(tzinfo=None)
+
+def booking_indexes(lecturer: str, building: str, date: str):
+    indexes = [("lecturer", lecturer, date)]
+    if building:
+        indexes.append(("building", building, date))
+    return indexes
+
+# Lecturer names go through lecturer_doc_id, building names are valid ids already
+def booking_day_id(kind: str, key: str, date: str) -> str:
+    if kind == "lecturer":
+        key = lecturer_doc_id(key)
+    return f"{BUILDING_CALENDAR_PREFIX}{kind}:{key}:{date}"
+
+def read_booking_index(kind: str, key: str, date: str):
+    day_id = booking_day_id(kind, key, date)
+    try:
+        return get_building_container().read_item(item=day_id, partition_key=day_id)
+    except CosmosResourceNotFoundError:
+        return None
+
+# Entries of one index on date
+def booked_on(kind: str, key: str, date: str) -> list:
+    return (read_booking_index(kind, key, date) or {}).get("bookings") or []
+
+# Apply change(entries) to one index's day under its etag. change edits the entries in place,
+# or returns a clashing entry to leave the index as it is.
+# Return (clash, error_response)
+def update_booking_index(kind: str, key: str, date: str, change):
+    container = get_building_container()
+
+    for _ in range(BOOKING_RETRIES):
+        doc = read_booking_index(kind, key, date)
+
+        before = (doc or {}).get("bookings") or []
+        entries = list(before)
+        clash = change(entries)
+        if clash is not None:
+            return clash, None
+        if entries == before:
+            return None, None
+
+        try:
+            if doc is None:
+                container.create_item(body={
+                    "id": booking_day_id(kind, key, date),
+                    "type": "bookingDay",
+                    "kind": kind,
+                    "key": key,
+                    "date": date,
+                    "bookings": entries
+                })
+            else:
+                container.patch_item(
+                    item=doc["id"],
+                    partition_key=doc["id"],
+                    patch_operations=[{"op": "set", "path": "/bookings", "value": entries}],
+                    etag=doc["_etag"],
+                    match_condition=MatchConditions.IfNotModified
+                )
+        except (CosmosAccessConditionFailedError, CosmosResourceExistsError):
+            continue    # the index changed since it was read, check again
+
+        return None, None
+
+    return None, json_resp({"result": False, "msg": "booking busy, try again"}, status=409)
+
+def clash_view(clash: list) -> dict:
+    return {"start": clash[0], "end": clash[1], "id": clash[2]}
+
+# Take entries off one index's day
+def remove_bookings(kind: str, key: str, date: str, entries: list):
+    def change(current):
+        for entry in entries:
+            bookings.remove(current, entry)
+    update_booking_index(kind, key, date, change)
+
+# Add entry to every index in turn. Bookings with an id in ignore don't count as clashes, so a
+# lecture can move within its own booked time; the booking it moves from stays until the move
+# is written, and is released after.
+# Return error_response or None
+def add_booking(indexes, entry: list, ignore=()):
+    written = []
+    for index in indexes:
+        def change(current):
+            clash = bookings.find_clash(current, entry[0], entry[1], ignore)
+            if clash is not None:
+                return clash
+            bookings.add(current, entry)
+
+        clash, err = update_booking_index(*index, change)
+        if clash is not None or err is not None:
+            # Take the entry back off the indexes already written
+            for done in written:
+                remove_bookings(*done, [entry])
+            if err is not None:
+                return err
+            return json_resp(
+                {"result": False, "msg": f"{index[0]} already booked", "clash": clash_view(clash)},
+                status=409
+            )
+
+        written.append(index)
+
+    return None
+
+# Book a lecture's time for its lecturer and building
+# Return (booking, error_response)
+def book_lecture(schedule: dict, building: str, ignore=()):
+    start, end = bookings.interval(schedule["date"], schedule["time"], schedule["duration"])
+    booking = {
+        "id": uuid.uuid4().hex,
+        "lecturer": schedule["lecturer"],
+        "building": building,
+        "start": start,
+        "end": end
+    }
+    err = add_booking(
+        booking_indexes(booking["lecturer"], building, schedule["date"]),
+        [start, end, booking["id"]],
+        ignore=ignore
+    )
+    if err:
+        return None, err
+    return booking, None
+
+# Take a lecture's booking off its indexes; releasing twice is harmless
+def release_booking(booking):
+    if not booking:
+        return
+    for index in booking_indexes(booking["lecturer"], booking["building"], booking["start"][:10]):
+        remove_bookings(*index, [[booking["start"], booking["end"], booking["id"]]])
+
+# Free times on a date for a lecturer, a building, or both together
+# GET ?date=YYYY-MM-DD&lecturer=string&building=string&duration=60&from=08:00&to=18:00
+@app.route(route="booking/free", auth_level=func.AuthLevel.FUNCTION, methods=["GET"])
+def booking_free(req: func.HttpRequest) -> func.HttpResponse:
+    logging.info("booking/free")
+
+    date = (req.params.get("date") or "").strip()
+    lecturer = (req.params.get("lecturer") or "").strip()
+    building = (req.params.get("building") or "").strip()
+    day_start = (req.params.get("from") or bookings.DAY_START).strip()
+    day_end = (req.params.get("to") or bookings.DAY_END).strip()
+
+    # Validate input
+    if not date:
         return json_resp({"result": False, "msg": "date is required"}, status=400)
 
-    if not lecture_time:
-        return json_resp({"result": False, "msg": "time is required"}, status=400)
+    if not lecturer and not building:
+        return json_resp({"result": False, "msg": "lecturer or building is required"}, status=400)
+
+    try:
+        datetime.datetime.strptime(date, "%Y-%m-%d")
+    except ValueError:
+        return json_resp({"result": False, "msg": "date format must be YYYY-MM-DD"}, status=400)
+
+    try:
+        datetime.datetime.strptime(day_start, "%H:%M")
+        datetime.datetime.strptime(day_end, "%H:%M")
+    except ValueError:
+        return json_resp({"result": False, "msg": "from and to format must be HH:MM"}, status=400)
+
+    if day_start >= day_end:
+        return json_resp({"result": False, "msg": "from must be before to"}, status=400)
+
+    try:
+        duration = int(req.params.get("duration") or bookings.DEFAULT_DURATION)
+    except ValueError:
+        duration = 0
+    if not bookings.MIN_DURATION <= duration <= bookings.MAX_DURATION:
+        return json_resp({
+            "result": False,
+            "msg": f"duration must be between {bookings.MIN_DURATION} and {bookings.MAX_DURATION} minutes"
+        }, status=400)
+
+    if building and not valid_building_name(building):
+        return json_resp({"result": False, "msg": "invalid building name"}, status=400)
+
+    indexes = []
+    if lecturer:
+        if not get_lecturer_profile(lecturer):
+            return json_resp({"result": False, "msg": "lecturer not found"}, status=404)
+        indexes.append(booked_on("lecturer", lecturer, date))
+    if building:
+        indexes.append(booked_on("building", building, date))
+
+    free = bookings.free_slots(indexes, date, duration, day_start, day_end)
+
+    return json_resp(
+        {
+            "result": True,
+            "date": date,
+            "duration": duration,
+            "free": [{"start": start[11:], "end": end[11:]} for start, end in free]
+        },
+        status=200
+    )
+
+# Book a whole timetable at once. Every booking is validated, checked against the rest of the
+# timetable and against what is already booked before anything is written; then each day of
+# each lecturer and building index gets one write.
+# { "bookings": [{ "lecturer": "string", "building": "string", "date": "string", "time": "string", "duration": 60 }], "dryRun": false }
+@app.route(route="booking/timetable/import", auth_level=func.AuthLevel.FUNCTION, methods=["POST"])
+def booking_timetable_import(req: func.HttpRequest) -> func.HttpResponse:
+    logging.info("booking/timetable/import")
+
+    data, err = parse_json(req)
+    if err:
+        return err
+
+    items = data.get("bookings")
+    if not isinstance(items, list) or not items:
+        return json_resp({"result": False, "msg": "bookings must be a non-empty list"}, status=400)
+
+    if len(items) > MAX_TIMETABLE_BOOKINGS:
+        return json_resp(
+            {"result": False, "msg": f"at most {MAX_TIMETABLE_BOOKINGS} bookings per import"},
+            status=413
+        )
+
+    errors = []
+    booked = []
+    new_entries = {}    # (kind, key, date) -> [[start, end, id]]
+    position = {}       # booking id -> index in the request
+
+    for n, item in enumerate(items):
+        if not isinstance(item, dict):
+            errors.append({"index": n, "msg": "booking must be an object"})
+            continue
+
+        fields, invalid = validate_lecture_schedule(item, require_id=False)
+        if invalid:
+            errors.append({"index": n, "msg": invalid["msg"]})
+            continue
+
+        building = item.get("building") or ""
+        if not isinstance(building, str) or (building.strip() and not valid_building_name(building.strip())):
+            errors.append({"index": n, "msg": "invalid building name"})
+            continue
+        building = building.strip()
+
+        start, end = bookings.interval(fields["date"], fields["time"], fields["duration"])
+        booking_id = uuid.uuid4().hex
+        position[booking_id] = n
+        booked.append({
+            "index": n,
+            "id": booking_id,
+            "lecturer": fields["lecturer"],
+            "building": building,
+            "start": start,
+            "end": end
+        })
+        for index in booking_indexes(fields["lecturer"], building, fields["date"]):
+            new_entries.setdefault(index, []).append([start, end, booking_id])
+
+    # Clashes within the timetable
+    for (kind, key, _), entries in new_entries.items():
+        for first, second in bookings.batch_clashes(entries):
+            errors.append({
+                "index": position[second[2]],
+                "msg": f"{kind} double booked in the timetable",
+                "clash": {**clash_view(first), "index": position[first[2]]}
+            })
+
+    # Clashes with existing bookings, one read per day of each lecturer and building
+    def check(index):
+        kind, key, date = index
+        if kind == "lecturer" and not get_lecturer_profile(key):
+            return [{"index": position[e[2]], "msg": "lecturer not found"} for e in new_entries[index]]
+        current = booked_on(kind, key, date)
+        found = []
+        for entry in new_entries[index]:
+            clash = bookings.find_clash(current, entry[0], entry[1])
+            if clash is not None:
+                found.append({"index": position[entry[2]], "msg": f"{kind} already booked", "clash": clash_view(clash)})
+        return found
+
+    indexes = list(new_entries)
+    with ThreadPoolExecutor(max_workers=BULK_WRITE_CONCURRENCY) as pool:
+        for found in pool.map(in_current_context(check), indexes):
+            errors.extend(found)
+
+        if errors:
+            errors.sort(key=lambda e: e["index"])
+            return json_resp(
+                {"result": False, "msg": "timetable not imported", "errors": errors},
+                status=409 if all("clash" in e for e in errors) else 400
+            )
+
+        if data.get("dryRun"):
+            return json_resp(
+                {"result": True, "msg": "timetable is valid", "bookings": booked},
+                status=200
+            )
+
+        # One conditional write per index; each re-checks in case something was booked meanwhile
+        def write(index):
+            def change(current):
+                for entry in new_entries[index]:
+                    clash = bookings.find_clash(current, entry[0], entry[1])
+                    if clash is not None:
+                        return clash
+                    bookings.add(current, entry)
+            return update_booking_index(*index, change)
+
+        results = list(pool.map(in_current_context(write), indexes))
+        failed = [(index, clash, err) for index, (clash, err) in zip(indexes, results) if clash is not None or err is not None]
+
+        if failed:
+            # All or nothing: take the timetable back off the indexes that took it
+            written = [index for index, (clash, err) in zip(indexes, results) if clash is None and err is None]
+            list(pool.map(in_current_context(lambda index: remove_bookings(*index, new_entries[index])), written))
+
+            (kind, key, _), clash, err = failed[0]
+            if err is not None:
+                return err
+            return json_resp(
+                {"result": False, "msg": f"{kind} {key} was booked meanwhile, timetable not imported", "clash": clash_view(clash)},
+                status=409
+            )
 
-    # Validate date format
+    return json_resp(
+        {"result": True, "msg": "timetable imported", "booked": len(booked), "bookings": booked},
+        status=201
+    )
+
+# Module enrolment index
+# "Who takes COMP2" is answered from the modules container instead of a scan of the students:
+# each module's students are spread over MODULE_INDEX_SHARDS documents ("COMP2:0", "COMP2:1"
+# ...) by student id, each holding a sorted list of names. Enroll, bulk enroll and module
+# replace apply their diff with etag-conditional patches. A failed index update only logs,
+# since the student write has happened; scripts/rebuild_module_index.py rebuilds the whole
+# index from the students (also needed after changing ModuleIndexShards).
+MODULE_INDEX_SHARDS = int(os.environ.get("ModuleIndexShards", "8"))
+MODULE_INDEX_RETRIES = int(os.environ.get("ModuleIndexRetries", "5"))
+MODULE_PAGE_SIZE = 100
+MODULE_PAGE_MAX = 1000
+MODULE_PAGE_READ_BATCH = 4  # shard documents fetched per read_items call while paging
+
+def module_index_shard(name: str) -> int:
+    return int(student_doc_id(name)[:8], 16) % MODULE_INDEX_SHARDS
+
+def module_index_id(module: str, shard: int) -> str:
+    return f"{module}:{shard}"
+
+# Index changes for students whose modules went from old to new
+# Return {(module, shard): (names to add, names to remove)}
+def module_index_changes(moves) -> dict:
+    changes = {}
+    for name, old, new in moves:
+        shard = module_index_shard(name)
+        for module in set(new) - set(old):
+            changes.setdefault((module, shard), (set(), set()))[0].add(name)
+        for module in set(old) - set(new):
+            changes.setdefault((module, shard), (set(), set()))[1].add(name)
+    return changes
+
+# Apply one document's adds and removes under its etag
+# Return True once written (or nothing to write)
+def apply_module_index_change(module: str, shard: int, add: set, remove: set) -> bool:
+    ModuleContainer = get_module_container()
+    doc_id = module_index_id(module, shard)
+
+    for _ in range(MODULE_INDEX_RETRIES):
+        try:
+            doc = ModuleContainer.read_item(item=doc_id, partition_key=doc_id)
+        except CosmosResourceNotFoundError:
+            doc = None
+
+        students = list(doc["students"]) if doc else []
+        ops = []
+        for name in sorted(remove):
+            i = bisect.bisect_left(students, name)
+            if i < len(students) and students[i] == name:
+                del students[i]
+                ops.append({"op": "remove", "path": f"/students/{i}"})
+        for name in sorted(add):
+            i = bisect.bisect_left(students, name)
+            if i == len(students) or students[i] != name:
+                students.insert(i, name)
+                ops.append({"op": "add", "path": f"/students/{i}", "value": name})
+
+        if not ops:
+            return True
+
+        try:
+            if doc is None:
+                ModuleContainer.create_item(body={
+                    "id": doc_id,
+                    "type": "moduleStudents",
+                    "module": module,
+                    "shard": shard,
+                    "students": students
+                })
+            else:
+                # Positional ops for a few changes, the whole list for many
+                if len(ops) > MAX_PATCH_OPERATIONS:
+                    ops = [{"op": "set", "path": "/students", "value": students}]
+                ModuleContainer.patch_item(
+                    item=doc_id,
+                    partition_key=doc_id,
+                    patch_operations=ops,
+                    etag=doc["_etag"],
+                    match_condition=MatchConditions.IfNotModified
+                )
+        except (CosmosAccessConditionFailedError, CosmosResourceExistsError):
+            continue
+
+        return True
+
+    return False
+
+def update_module_index(changes: dict, pool=None):
+    if not changes:
+        return
+
+    def apply(item):
+        (module, shard), (add, remove) = item
+        try:
+            return apply_module_index_change(module, shard, add, remove)
+        except Exception as e:
+            logging.error(f"module index update failed for {module}:{shard}: {e}")
+            return False
+
+    results = pool.map(in_current_context(apply), changes.items()) if pool else map(apply, changes.items())
+    if not all(list(results)):
+        logging.warning("module index is behind the student documents, run scripts/rebuild_module_index.py")
+
+def encode_module_cursor(shard: int, after: str) -> str:
+    return base64.urlsafe_b64encode(json.dumps([shard, after]).encode()).decode()
+
+def decode_module_cursor(cursor: str):
     try:
-        datetime.datetime.strptime(lecture_date, "%Y-%m-%d")
-    except ValueError:
-        return json_resp(
-            {"result": False, "msg": "date format must be YYYY-MM-DD"},
-            status=400
-        )
+        shard, after = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (ValueError, TypeError):
+        return None
+    if not isinstance(shard, int) or not isinstance(after, str) or not 0 <= shard < MODULE_INDEX_SHARDS:
+        return None
+    return shard, after
+
+# Page through a module's students, shard by shard in name order
+# GET ?module=COMP2&limit=100&cursor=<cursor from the previous page>
+@app.route(route="module/students", auth_level=func.AuthLevel.FUNCTION, methods=["GET"])
+def module_students(req: func.HttpRequest) -> func.HttpResponse:
+    logging.info("module/students")
+
+    module = (req.params.get("module") or "").strip()
+    cursor = (req.params.get("cursor") or "").strip()
+
+    if not module:
+        return json_resp({"result": False, "msg": "module is required"}, status=400)
+
+    if module not in ALLOWED_MODULES:
+        return json_resp({"result": False, "msg": "invalid module", "allowed": sorted(ALLOWED_MODULES)}, status=400)
 
-    # Validate time format
     try:
-        datetime.datetime.strptime(lecture_time, "%H:%M")
+        limit = int(req.params.get("limit") or MODULE_PAGE_SIZE)
     except ValueError:
-        return json_resp(
-            {"result": False, "msg": "time format must be HH:MM"},
-            status=400
-        )
+        limit = 0
+    if not 1 <= limit <= MODULE_PAGE_MAX:
+        return json_resp({"result": False, "msg": f"limit must be between 1 and {MODULE_PAGE_MAX}"}, status=400)
+
+    shard, after = 0, ""
+    if cursor:
+        decoded = decode_module_cursor(cursor)
+        if decoded is None:
+            return json_resp({"result": False, "msg": "invalid cursor"}, status=400)
+        shard, after = decoded
+
+    ModuleContainer = get_module_container()
+    students = []
+    next_cursor = None
+
+    while shard < MODULE_INDEX_SHARDS and next_cursor is None:
+        batch = range(shard, min(shard + MODULE_PAGE_READ_BATCH, MODULE_INDEX_SHARDS))
+        docs = {
+            d["shard"]: d["students"]
+            for d in ModuleContainer.read_items(
+                items=[(module_index_id(module, s), module_index_id(module, s)) for s in batch]
+            )
+        }
+
+        for s in batch:
+            names = docs.get(s, [])
+            start = bisect.bisect_right(names, after) if after else 0
+            after = ""
+            taken = names[start:start + limit - len(students)]
+            students.extend(taken)
+
+            if len(students) == limit:
+                # Resume after the last name here, or at the next shard if this one is done
+                if start + len(taken) < len(names):
+                    next_cursor = encode_module_cursor(s, taken[-1])
+                elif s + 1 < MODULE_INDEX_SHARDS:
+                    next_cursor = encode_module_cursor(s + 1, "")
+                break
+
+        shard = batch[-1] + 1
+
+    return json_list_resp(
+        {"result": True, "module": module, "students": students, "cursor": next_cursor},
+        "students"
+    )
 
-    LecturerContainer = get_lecturer_container()
-    LectureContainer = get_lecture_container()
+# Materialized views
+# Read models kept up to date from the change feeds of the lecture and student containers,
+# so their read routes are a single point read on the views container:
+#   timetable:<lecturer id>   a lecturer's scheduled lectures in start order
+#   building:<building>       the lectures in a building in start order, for its current lecture
+#   module-counts             students enrolled per module
+# The feed only carries the new version of a document, so what each source document last
+# contributed is kept as source:<kind>:<id>; a change is taken out of the views it used to be
+# in before it goes into its new ones.
+# In Azure the Cosmos DB triggers below deliver the changes and the host checkpoints them in
+# the leases container. Local backends have no triggers: POST views/sync (or
+# scripts/rebuild_views.py) reads their change feed from a checkpoint kept in the views
+# container, and a rebuild clears the views and replays each feed from the beginning, which
+# also puts right counts left behind by a batch that failed half way.
+VIEW_RETRIES = int(os.environ.get("ViewRetries", "5"))
+VIEW_APPLY_BATCH = int(os.environ.get("ViewApplyBatchSize", "100"))
+MODULE_COUNTS_ID = "module-counts"
+VIEW_DOC_TYPES = ("lecturerTimetable", "buildingLectures", "moduleCounts", "viewSource", "viewCheckpoint")
+_view_sync_lock = threading.Lock()
+
+# Gets the materialized views container
+def get_view_container():
+    return get_container("ViewContainerName", "views")
+
+def timetable_view_id(lecturer: str) -> str:
+    return f"timetable:{lecturer_doc_id(lecturer)}"
+
+def building_view_id(building: str) -> str:
+    return f"building:{building}"
+
+def view_source_id(kind: str, doc_id: str) -> str:
+    return f"source:{kind}:{doc_id}"
+
+# A scheduled lecture as it appears in the views, or None for a free slot
+def lecture_view_entry(lecture: dict):
+    lecturer = lecture.get("lecturer")
+    lecture_date = lecture.get("date")
+    lecture_time = lecture.get("time")
+    if not lecturer or not lecture_date or not lecture_time:
+        return None
+
+    booking = lecture.get("booking") or {}
+    if booking.get("start") and booking.get("end"):
+        start, end = booking["start"], booking["end"]
+    else:
+        try:
+            times = bookings.interval(lecture_date, lecture_time, bookings.DEFAULT_DURATION)
+        except (TypeError, ValueError):
+            return None
+        if times is None:
+            return None
+        start, end = times
+
+    return {
+        "id": lecture["id"],
+        "title": lecture.get("title") or "",
+        "module": lecture.get("module") or "",
+        "lecturer": lecturer,
+        "building": lecture.get("building") or "",
+        "start": start,
+        "end": end
+    }
 
-    # Check if lecturer exists
-    lecturers = list(LecturerContainer.query_items(
-        query="SELECT * FROM l WHERE l.name = @name",
-        parameters=[{"name": "@name", "value": lecture_lecturer}],
+# Views a lecture entry belongs in: {view id: (doc type, key field, key)}
+def lecture_views(entry: dict) -> dict:
+    views = {timetable_view_id(entry["lecturer"]): ("lecturerTimetable", "lecturer", entry["lecturer"])}
+    if entry["building"] and valid_building_name(entry["building"]):
+        views[building_view_id(entry["building"])] = ("buildingLectures", "building", entry["building"])
+    return views
+
+# Replace the entries of the given lectures in one view under its etag
+# upserts: {lecture id: entry}, removals: lecture ids to drop
+def apply_lecture_view_change(view_id: str, kind: tuple, upserts: dict, removals: set) -> bool:
+    ViewContainer = get_view_container()
+    doc_type, key_field, key = kind
+
+    for _ in range(VIEW_RETRIES):
+        try:
+            doc = ViewContainer.read_item(item=view_id, partition_key=view_id)
+        except CosmosResourceNotFoundError:
+            doc = None
+
+        current = doc["lectures"] if doc else []
+        lectures = [e for e in current if e["id"] not in removals and e["id"] not in upserts]
+        for entry in upserts.values():
+            bisect.insort(lectures, entry, key=lambda e: (e["start"], e["id"]))
+
+        if lectures == current:
+            return True
+
+        try:
+            if doc is None:
+                ViewContainer.create_item(body={
+                    "id": view_id, "type": doc_type, key_field: key, "lectures": lectures
+                })
+            else:
+                ViewContainer.patch_item(
+                    item=view_id,
+                    partition_key=view_id,
+                    patch_operations=[{"op": "set", "path": "/lectures", "value": lectures}],
+                    etag=doc["_etag"],
+                    match_condition=MatchConditions.IfNotModified
+                )
+        except (CosmosAccessConditionFailedError, CosmosResourceExistsError):
+            continue
+
+        return True
+
+    return False
+
+def read_view_sources(kind: str, doc_ids) -> dict:
+    ids = [view_source_id(kind, i) for i in doc_ids]
+    if not ids:
+        return {}
+    return {d["id"]: d for d in get_view_container().read_items(items=[(i, i) for i in ids])}
+
+def write_view_source(kind: str, doc_id: str, **fields):
+    source_id = view_source_id(kind, doc_id)
+    get_view_container().upsert_item(body={"id": source_id, "type": "viewSource", "kind": kind, **fields})
+
+# Latest version of each document in a feed batch, in feed order
+def latest_versions(docs) -> list:
+    latest = {}
+    for doc in docs:
+        latest.pop(doc["id"], None)
+        latest[doc["id"]] = doc
+    return list(latest.values())
+
+# Apply changed lecture documents to the timetable and building views
+def apply_lecture_changes(docs):
+    lectures = [d for d in latest_versions(docs) if "lecturer" in d]
+    if not lectures:
+        return
+
+    sources = read_view_sources("lecture", [d["id"] for d in lectures])
+    changes = {}  # view id -> (kind, upserts, removals)
+    moved = []
+
+    for lecture in lectures:
+        entry = lecture_view_entry(lecture)
+        views = lecture_views(entry) if entry else {}
+        previous = sources.get(view_source_id("lecture", lecture["id"]), {}).get("views", {})
+
+        for view_id, kind in previous.items():
+            if view_id not in views:
+                changes.setdefault(view_id, (tuple(kind), {}, set()))[2].add(lecture["id"])
+        for view_id, kind in views.items():
+            changes.setdefault(view_id, (kind, {}, set()))[1][lecture["id"]] = entry
+
+        if set(previous) != set(views):
+            moved.append((lecture["id"], views))
+
+    failed = [
+        view_id for view_id, (kind, upserts, removals) in changes.items()
+        if not apply_lecture_view_change(view_id, kind, upserts, removals)
+    ]
+    if failed:
+        raise RuntimeError(f"lecture views not updated: {', '.join(failed)}")
+
+    # Only once the views hold the change, so a redelivered batch still finds the old views
+    for lecture_id, views in moved:
+        write_view_source("lecture", lecture_id, views={k: list(v) for k, v in views.items()})
+
+# Add deltas to the module counts; incr is applied server side, so no etag is needed
+def apply_module_count_deltas(deltas: dict):
+    ViewContainer = get_view_container()
+    ops = [{"op": "incr", "path": f"/counts/{m}", "value": n} for m, n in sorted(deltas.items()) if n]
+
+    for i in range(0, len(ops), MAX_PATCH_OPERATIONS):
+        chunk = ops[i:i + MAX_PATCH_OPERATIONS]
+        try:
+            ViewContainer.patch_item(item=MODULE_COUNTS_ID, partition_key=MODULE_COUNTS_ID, patch_operations=chunk)
+        except CosmosResourceNotFoundError:
+            try:
+                ViewContainer.create_item(body={
+                    "id": MODULE_COUNTS_ID,
+                    "type": "moduleCounts",
+                    "counts": {m: 0 for m in sorted(ALLOWED_MODULES)}
+                })
+            except CosmosResourceExistsError:
+                pass
+            ViewContainer.patch_item(item=MODULE_COUNTS_ID, partition_key=MODULE_COUNTS_ID, patch_operations=chunk)
+
+# Apply changed student documents to the module counts
+def apply_student_changes(docs):
+    students = [d for d in latest_versions(docs) if isinstance(d.get("modules"), list)]
+    if not students:
+        return
+
+    sources = read_view_sources("student", [d["id"] for d in students])
+    deltas = {}
+    moved = []
+
+    for student in students:
+        modules = sorted({m for m in student["modules"] if m in ALLOWED_MODULES})
+        previous = sources.get(view_source_id("student", student["id"]), {}).get("modules", [])
+        if modules == previous:
+            continue
+        for m in set(modules) - set(previous):
+            deltas[m] = deltas.get(m, 0) + 1
+        for m in set(previous) - set(modules):
+            deltas[m] = deltas.get(m, 0) - 1
+        moved.append((student["id"], modules))
+
+    apply_module_count_deltas(deltas)
+
+    for student_id, modules in moved:
+        write_view_source("student", student_id, modules=modules)
+
+VIEW_FEEDS = {
+    "lecture": (get_lecture_container, apply_lecture_changes),
+    "student": (get_student_container, apply_student_changes),
+}
+
+# Read one container's change feed from its checkpoint (or from the beginning) and apply it
+# Return the number of changed documents applied
+def sync_view_feed(kind: str, from_beginning: bool = False) -> int:
+    get_source, apply = VIEW_FEEDS[kind]
+    ViewContainer = get_view_container()
+    SourceContainer = get_source()
+    checkpoint_id = f"checkpoint:{kind}"
+
+    checkpoint = None
+    if not from_beginning:
+        try:
+            checkpoint = ViewContainer.read_item(item=checkpoint_id, partition_key=checkpoint_id)
+        except CosmosResourceNotFoundError:
+            pass
+
+    if checkpoint is not None:
+        feed = SourceContainer.query_items_change_feed(continuation=checkpoint["continuation"])
+    else:
+        feed = SourceContainer.query_items_change_feed(start_time="Beginning")
+    docs = list(feed)
+    continuation = SourceContainer.client_connection.last_response_headers.get("etag")
+
+    for i in range(0, len(docs), VIEW_APPLY_BATCH):
+        apply(docs[i:i + VIEW_APPLY_BATCH])
+
+    ViewContainer.upsert_item(body={
+        "id": checkpoint_id, "type": "viewCheckpoint", "kind": kind,
+        "continuation": continuation, "synced": time.time()
+    })
+    return len(docs)
+
+def clear_views():
+    ViewContainer = get_view_container()
+    for doc in list(ViewContainer.query_items(
+        query="SELECT c.id FROM c WHERE ARRAY_CONTAINS(@types, c.type)",
+        parameters=[{"name": "@types", "value": list(VIEW_DOC_TYPES)}],
         enable_cross_partition_query=True
-    ))
+    )):
+        try:
+            ViewContainer.delete_item(item=doc["id"], partition_key=doc["id"])
+        except CosmosResourceNotFoundError:
+            pass
+
+# Bring every view up to date; rebuild clears them and replays the feeds from the beginning
+# Return {kind: changes applied}, or None when a sync is already running in this worker
+def sync_views(rebuild: bool = False):
+    if not _view_sync_lock.acquire(blocking=False):
+        return None
+    try:
+        if rebuild:
+            clear_views()
+        return {kind: sync_view_feed(kind, from_beginning=rebuild) for kind in VIEW_FEEDS}
+    finally:
+        _view_sync_lock.release()
+
+# Change feed triggers, on Cosmos only; a new leases container starts at the current end of the
+# feed, so run a rebuild once after deploying them. function_app_async.py registers them too.
+def register_view_triggers(app):
+    if backend_kind(database_setting()) != "cosmos":
+        return
+
+    @app.cosmos_db_trigger(
+        arg_name="docs",
+        connection="AzureCosmosDBConnectionString",
+        database_name="%DatabaseName%",
+        container_name="%LectureContainerName%",
+        lease_container_name="leases",
+        lease_container_prefix="views-lecture-",
+        create_lease_container_if_not_exists=True
+    )
+    def lecture_views_feed(docs: func.DocumentList):
+        apply_lecture_changes([d.to_dict() for d in docs])
+
+    @app.cosmos_db_trigger(
+        arg_name="docs",
+        connection="AzureCosmosDBConnectionString",
+        database_name="%DatabaseName%",
+        container_name="%StudentContainerName%",
+        lease_container_name="leases",
+        lease_container_prefix="views-student-",
+        create_lease_container_if_not_exists=True
+    )
+    def student_views_feed(docs: func.DocumentList):
+        apply_student_changes([d.to_dict() for d in docs])
 
-    if not lecturers:
-        return json_resp(
-            {"result": False, "msg": "lecturer not found"},
-            status=404
-        )
+register_view_triggers(app)
 
-    # Get lecture by id (1-12)
-    try:
-        lecture = LectureContainer.read_item(
-            item=lecture_id,
-            partition_key=lecture_id
-        )
-    except Exception:
-        return json_resp(
-            {"result": False, "msg": "lecture not found"},
-            status=404
-        )
+# Catch the views up with the change feeds (local backends), or rebuild them
+# Body (optional): {"rebuild": true}
+@app.route(route="views/sync", auth_level=func.AuthLevel.FUNCTION, methods=["POST"])
+def views_sync(req: func.HttpRequest) -> func.HttpResponse:
+    logging.info("views/sync")
 
-    # Update
-    lecture["lecturer"] = lecture_lecturer
-    lecture["date"] = lecture_date
-    lecture["time"] = lecture_time
+    data = {}
+    if req.get_body():
+        data, err = parse_json(req)
+        if err:
+            return err
+    if not isinstance(data, dict):
+        return json_resp({"result": False, "msg": "body must be a json object"}, status=400)
 
-    LectureContainer.replace_item(
-        item=lecture["id"],
-        body=lecture
-    )
+    rebuild = data.get("rebuild", False)
+    if not isinstance(rebuild, bool):
+        return json_resp({"result": False, "msg": "rebuild must be true or false"}, status=400)
+
+    applied = sync_views(rebuild)
+    if applied is None:
+        return json_resp({"result": False, "msg": "views sync already running"}, status=409)
 
     return json_resp(
-        {"result": True, "msg": "lecture updated"},
+        {"result": True, "msg": "views rebuilt" if rebuild else "views synced", "changes": applied},
         status=200
     )
 
-# {"id": "string", "student" : "string" }
-@app.route(route="lecture/student/add", auth_level=func.AuthLevel.FUNCTION, methods=["POST"])
-def lecture_student_add(req: func.HttpRequest) -> func.HttpResponse:
-    logging.info("lecture/student/add")
-
-    data, err = parse_json(req)
-    if err:
-        return err
+def read_view(view_id: str):
+    try:
+        return get_view_container().read_item(item=view_id, partition_key=view_id)
+    except CosmosResourceNotFoundError:
+        return None
 
-    lecture_id = (data.get("id") or "").strip()
-    student_name = (data.get("student") or "").strip()
+# A lecturer's scheduled lectures, from their timetable view
+# GET ?name=string
+@app.route(route="lecturer/timetable", auth_level=func.AuthLevel.FUNCTION, methods=["GET"])
+def lecturer_timetable(req: func.HttpRequest) -> func.HttpResponse:
+    logging.info("lecturer/timetable")
 
-    # Validate input
-    if not lecture_id:
-        return json_resp({"result": False, "msg": "id is required"}, status=400)
+    name = (req.params.get("name") or "").strip()
+    if not name:
+        return json_resp({"result": False, "msg": "name is required"}, status=400)
 
-    if not student_name:
-        return json_resp({"result": False, "msg": "student is required"}, status=400)
+    view = read_view(timetable_view_id(name))
+    return json_resp(
+        {"result": True, "lecturer": name, "lectures": view["lectures"] if view else []},
+        status=200,
+        headers={"ETag": http_encoding.doc_etag(view, variant=f"timetable:{name}")}
+    )
 
-    LectureContainer = get_lecture_container()
-    StudentContainer = get_student_container()
+# The lecture running in a building now and the next one, from the building view
+# GET ?building=string
+@app.route(route="building/current", auth_level=func.AuthLevel.FUNCTION, methods=["GET"])
+def building_current(req: func.HttpRequest) -> func.HttpResponse:
+    logging.info("building/current")
 
-    # Check student exists
-    students = list(StudentContainer.query_items(
-        query="SELECT * FROM s WHERE s.name = @name",
-        parameters=[{"name": "@name", "value": student_name}],
-        enable_cross_partition_query=True
-    ))
+    building = (req.params.get("building") or "").strip()
+    if not building:
+        return json_resp({"result": False, "msg": "building is required"}, status=400)
+    if not valid_building_name(building):
+        return json_resp({"result": False, "msg": "invalid building name"}, status=400)
 
-    if not students:
-        return json_resp(
-            {"result": False, "msg": "student not found"},
-            status=404
-        )
+    view = read_view(building_view_id(building))
+    lectures = view["lectures"] if view else []
+    now = lecture_now().strftime(bookings.TIME_FORMAT)
 
-    # Get lecture by id (1-12)
-    try:
-        lecture = LectureContainer.read_item(
-            item=lecture_id,
-            partition_key=lecture_id
-        )
-    except Exception:
-        return json_resp(
-            {"result": False, "msg": "lecture not found"},
-            status=404
-        )
+    # Lectures in one building don't overlap, so the last one started is the only candidate
+    i = bisect.bisect_right(lectures, now, key=lambda e: e["start"])
+    current = lectures[i - 1] if i > 0 and lectures[i - 1]["end"] > now else None
+    upcoming = lectures[i] if i < len(lectures) else None
 
-    # CHeck students list exists
-    lecture_students = lecture.get("students") or []
+    return json_resp(
+        {"result": True, "building": building, "current": current, "next": upcoming},
+        status=200
+    )
 
-    # No duplicates
-    if student_name in lecture_students:
-        return json_resp(
-            {"result": False, "msg": "student already in lecture"},
-            status=409
-        )
+# Students enrolled per module, from the module counts view
+# GET ?module=COMP2 (optional, default all modules)
+@app.route(route="module/counts", auth_level=func.AuthLevel.FUNCTION, methods=["GET"])
+def module_counts(req: func.HttpRequest) -> func.HttpResponse:
+    logging.info("module/counts")
 
-    # Add student
-    lecture_students.append(student_name)
-    lecture["students"] = lecture_students
+    module = (req.params.get("module") or "").strip()
+    if module and module not in ALLOWED_MODULES:
+        return json_resp({"result": False, "msg": "invalid module", "allowed": sorted(ALLOWED_MODULES)}, status=400)
 
-    LectureContainer.replace_item(
-        item=lecture["id"],
-        body=lecture
-    )
+    view = read_view(MODULE_COUNTS_ID)
+    counts = {m: 0 for m in sorted(ALLOWED_MODULES)}
+    counts.update((view or {}).get("counts", {}))
+    if module:
+        counts = {module: counts[module]}
 
     return json_resp(
-        {"result": True, "msg": "student added to lecture"},
-        status=200
+        {"result": True, "counts": counts},
+        status=200,
+        headers={"ETag": http_encoding.doc_etag(view, variant=f"counts:{module}")}
     )
 
-# { "id": "string", "studnt": "string" } 
-@app.route(route="lecture/student/remove", auth_level=func.AuthLevel.FUNCTION, methods=["POST"])
-def lecture_student_remove(req: func.HttpRequest) -> func.HttpResponse:
-    logging.info("lecture/student/remove")
+# Lecture chat and board history
+# Chat messages and board saves are kept per lecture in the history container, keyed by the
+# lecture title the socket server uses. Both are queued in a write-behind buffer
+# (write_behind.py). Each chat flush writes one batch document per lecture (chat:<key>:<n>),
+# numbered by an incr on the chat head document (chat:<key>), so a flush costs two writes
+# however many messages it carries. Chat history is read newest first in pages of a few
+# batch documents per read_items call; the first page also carries what this worker hasn't
+# flushed yet. Board saves are full copies, so only the newest one queued for a lecture is
+# written, as the board's next revision (see Board revisions below).
+HISTORY_FLUSH_BATCH = int(os.environ.get("HistoryFlushBatchSize", "50"))
+HISTORY_FLUSH_MS = int(os.environ.get("HistoryFlushMs", "500"))
+HISTORY_MAX_PENDING = int(os.environ.get("HistoryMaxPending", "5000"))
+HISTORY_PAGE_SIZE = 50
+HISTORY_PAGE_MAX = 500
+HISTORY_READ_BATCH = 4  # batch documents fetched per read_items call while paging
+LECTURE_TITLE_MAX = 200
+CHAT_USER_MAX = 100
+CHAT_MESSAGE_MAX = 2000
+BOARD_CONTENT_MAX = 256 * 1024
+
+# Gets the chat and board history container
+def get_history_container():
+    return get_container("HistoryContainerName", "history")
+
+def history_key(lecture: str) -> str:
+    return str(uuid.uuid5(NAME_KEY_NAMESPACE, "lecture:" + normalize_name(lecture)))
+
+def history_head_id(kind: str, lecture: str) -> str:
+    return f"{kind}:{history_key(lecture)}"
+
+def history_batch_id(kind: str, lecture: str, batch: int) -> str:
+    return f"{kind}:{history_key(lecture)}:{batch}"
+
+# Write one flushed batch of a lecture's entries; the head's batch count numbers it
+def write_history_batch(kind: str, lecture: str, entries: list):
+    HistoryContainer = get_history_container()
+    head_id = history_head_id(kind, lecture)
+    ops = [{"op": "incr", "path": "/batches", "value": 1}]
+
+    try:
+        head = HistoryContainer.patch_item(item=head_id, partition_key=head_id, patch_operations=ops)
+    except CosmosResourceNotFoundError:
+        try:
+            HistoryContainer.create_item(body={
+                "id": head_id, "type": "historyHead", "kind": kind, "lecture": lecture, "batches": 0
+            })
+        except CosmosResourceExistsError:
+            pass
+        head = HistoryContainer.patch_item(item=head_id, partition_key=head_id, patch_operations=ops)
+
+    # A batch whose create fails leaves a gap in the numbering, which readers skip
+    batch = head["batches"] - 1
+    HistoryContainer.create_item(body={
+        "id": history_batch_id(kind, lecture, batch),
+        "type": "historyBatch",
+        "kind": kind,
+        "lecture": lecture,
+        "batch": batch,
+        "entries": entries
+    })
+
+# Board revisions
+# Every board flush is the next revision, stored as a delta (board_delta.py) against the one
+# before. The board head (board:<key>) holds the revision number, the base snapshot revision
+# and the deltas since it, so the current board, or the changes since any revision at or after
+# the base, is one point read plus the base snapshot (cached, snapshots never change). A write
+# is an etag-guarded patch of the head. Once the head has BoardCompactRevisions deltas, or
+# they outweigh the board itself, the next write compacts: the current board becomes snapshot
+# board:<key>:s<rev> and the old deltas move to archive board:<key>:a<base>, which is how any
+# older revision can still be rebuilt for replay.
+BOARD_COMPACT_REVISIONS = int(os.environ.get("BoardCompactRevisions", "50"))
+BOARD_WRITE_RETRIES = int(os.environ.get("BoardWriteRetries", "5"))
+BOARD_COMPACT_MIN = 1024  # characters of deltas always worth keeping over a snapshot write
+board_snapshot_cache = ProfileCache(max_size=256, ttl_seconds=3600)
+
+def board_snapshot_id(lecture: str, revision: int) -> str:
+    return f"{history_head_id('board', lecture)}:s{revision}"
+
+def board_archive_id(lecture: str, base: int) -> str:
+    return f"{history_head_id('board', lecture)}:a{base}"
+
+def read_board_head(lecture: str):
+    head_id = history_head_id("board", lecture)
+    try:
+        return get_history_container().read_item(item=head_id, partition_key=head_id)
+    except CosmosResourceNotFoundError:
+        return None
+
+# Board content at a snapshot revision; revision 0 is the empty board
+def read_board_snapshot(lecture: str, revision: int) -> str:
+    if revision == 0:
+        return ""
+
+    def load():
+        snapshot_id = board_snapshot_id(lecture, revision)
+        return get_history_container().read_item(item=snapshot_id, partition_key=snapshot_id)["content"]
+
+    return board_snapshot_cache.get_or_load((history_key(lecture), revision), load)
+
+# Content of the head's revision, or of an earlier one
+def board_content(lecture: str, head, revision: int = None) -> str:
+    if head is None:
+        return ""
+    if revision is None:
+        revision = head["revision"]
+
+    if revision >= head["base"]:
+        return board_delta.replay(read_board_snapshot(lecture, head["base"]), head["deltas"][:revision - head["base"]])
+
+    base = head["snapshots"][bisect.bisect_right(head["snapshots"], revision) - 1]
+    archive_id = board_archive_id(lecture, base)
+    archive = get_history_container().read_item(item=archive_id, partition_key=archive_id)
+    return board_delta.replay(read_board_snapshot(lecture, base), archive["deltas"][:revision - base])
+
+# Snapshot the head's revision and archive its deltas. Both follow from the head alone, so
+# writers racing on the same head write the same documents
+def compact_board(lecture: str, head: dict, content: str):
+    HistoryContainer = get_history_container()
+    for body in (
+        {
+            "id": board_snapshot_id(lecture, head["revision"]), "type": "boardSnapshot",
+            "lecture": lecture, "revision": head["revision"], "content": content
+        },
+        {
+            "id": board_archive_id(lecture, head["base"]), "type": "boardArchive",
+            "lecture": lecture, "base": head["base"], "deltas": head["deltas"]
+        },
+    ):
+        try:
+            HistoryContainer.create_item(body=body)
+        except CosmosResourceExistsError:
+            pass
+    board_snapshot_cache.put((history_key(lecture), head["revision"]), content)
+
+# Store the newest queued save as the board's next revision; called by the board buffer
+def write_board_revision(lecture: str, entries: list):
+    HistoryContainer = get_history_container()
+    head_id = history_head_id("board", lecture)
+    save = entries[-1]
+
+    for _ in range(BOARD_WRITE_RETRIES):
+        head = read_board_head(lecture)
+        current = board_content(lecture, head)
+        if save["content"] == current:
+            return
+
+        delta = board_delta.diff(current, save["content"])
+        try:
+            if head is None:
+                HistoryContainer.create_item(body={
+                    "id": head_id, "type": "boardHead", "lecture": lecture, "revision": 1, "base": 0,
+                    "deltas": [delta], "snapshots": [0], "user": save["user"], "at": save["at"]
+                })
+                return
+
+            ops = [
+                {"op": "set", "path": "/revision", "value": head["revision"] + 1},
+                {"op": "set", "path": "/user", "value": save["user"]},
+                {"op": "set", "path": "/at", "value": save["at"]},
+            ]
+            weight = sum(board_delta.weight(d) for d in head["deltas"])
+            if len(head["deltas"]) >= BOARD_COMPACT_REVISIONS or weight > max(len(current), BOARD_COMPACT_MIN):
+                compact_board(lecture, head, current)
+                ops += [
+                    {"op": "set", "path": "/base", "value": head["revision"]},
+                    {"op": "set", "path": "/deltas", "value": [delta]},
+                    {"op": "add", "path": "/snapshots/-", "value": head["revision"]},
+                ]
+            else:
+                ops.append({"op": "add", "path": "/deltas/-", "value": delta})
+
+            HistoryContainer.patch_item(
+                item=head_id,
+                partition_key=head_id,
+                patch_operations=ops,
+                etag=head["_etag"],
+                match_condition=MatchConditions.IfNotModified
+            )
+            return
+        except (CosmosAccessConditionFailedError, CosmosResourceExistsError):
+            continue
+
+    raise RuntimeError(f"board revision for {lecture} not written after {BOARD_WRITE_RETRIES} tries")
+
+history_buffers = {
+    "chat": WriteBehindBuffer(
+        lambda lecture, entries: write_history_batch("chat", lecture, entries),
+        max_batch=HISTORY_FLUSH_BATCH,
+        max_delay=HISTORY_FLUSH_MS / 1000,
+        max_pending=HISTORY_MAX_PENDING,
+        name="chat-history"
+    ),
+    "board": WriteBehindBuffer(
+        write_board_revision,
+        max_batch=HISTORY_FLUSH_BATCH,
+        max_delay=HISTORY_FLUSH_MS / 1000,
+        max_pending=HISTORY_MAX_PENDING,
+        coalesce=True,
+        name="board-history"
+    ),
+}
+
+def encode_history_cursor(batch: int, offset) -> str:
+    return base64.urlsafe_b64encode(json.dumps([batch, offset]).encode()).decode()
+
+def decode_history_cursor(cursor: str):
+    try:
+        batch, offset = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (ValueError, TypeError):
+        return None
+    if not isinstance(batch, int) or batch < 0 or not (offset is None or isinstance(offset, int) and offset > 0):
+        return None
+    return batch, offset
+
+# Up to limit stored entries before position (batch, offset), newest first; offset None is
+# the whole batch. Return (entries oldest first, position of the next older page or None)
+def read_history_page(kind: str, lecture: str, limit: int, position):
+    HistoryContainer = get_history_container()
+    batch, offset = position
+    pages = []
+    taken = 0
+
+    while batch >= 0:
+        group = range(batch, max(batch - HISTORY_READ_BATCH, -1), -1)
+        ids = [history_batch_id(kind, lecture, b) for b in group]
+        docs = {d["batch"]: d["entries"] for d in HistoryContainer.read_items(items=[(i, i) for i in ids])}
+
+        for b in group:
+            stored = docs.get(b, [])
+            end = len(stored) if offset is None else min(offset, len(stored))
+            offset = None
+            start = max(0, end - (limit - taken))
+            pages.append(stored[start:end])
+            taken += end - start
+
+            if taken == limit:
+                entries = [e for page in reversed(pages) for e in page]
+                if start > 0:
+                    return entries, (b, start)
+                return entries, ((b - 1, None) if b > 0 else None)
+
+        batch = group[-1] - 1
+
+    return [e for page in reversed(pages) for e in page], None
+
+def history_limit(req: func.HttpRequest):
+    try:
+        limit = int(req.params.get("limit") or HISTORY_PAGE_SIZE)
+    except ValueError:
+        limit = 0
+    if not 1 <= limit <= HISTORY_PAGE_MAX:
+        return None, json_resp({"result": False, "msg": f"limit must be between 1 and {HISTORY_PAGE_MAX}"}, status=400)
+    return limit, None
+
+# Return (title, error_payload)
+def validate_lecture_title(value):
+    if not isinstance(value, str) or not value.strip():
+        return None, {"result": False, "msg": "lecture is required"}
+    if len(value.strip()) > LECTURE_TITLE_MAX:
+        return None, {"result": False, "msg": f"lecture must be at most {LECTURE_TITLE_MAX} characters"}
+    return value.strip(), None
+
+# Return (user, error_payload); the socket server sends the logged in name
+def validate_history_user(value):
+    if value is None or value == "":
+        return "Anonymous", None
+    if not isinstance(value, str) or len(value) > CHAT_USER_MAX:
+        return None, {"result": False, "msg": f"user must be a string of at most {CHAT_USER_MAX} characters"}
+    return value.strip() or "Anonymous", None
+
+# Queue a chat message for the lecture's history
+# Body: {"lecture": "title", "user": "name", "message": "text", "time": "display time"}
+@app.route(route="chat/append", auth_level=func.AuthLevel.FUNCTION, methods=["POST"])
+def chat_append(req: func.HttpRequest) -> func.HttpResponse:
+    logging.info("chat/append")
 
     data, err = parse_json(req)
     if err:
         return err
+    if not isinstance(data, dict):
+        return json_resp({"result": False, "msg": "body must be a json object"}, status=400)
 
-    lecture_id = (data.get("id") or "").strip()
-    student_name = (data.get("student") or "").strip()
+    lecture, invalid = validate_lecture_title(data.get("lecture"))
+    if invalid:
+        return json_resp(invalid, status=400)
 
-    # Validate input
-    if not lecture_id:
-        return json_resp({"result": False, "msg": "id is required"}, status=400)
+    user, invalid = validate_history_user(data.get("user"))
+    if invalid:
+        return json_resp(invalid, status=400)
 
-    if not student_name:
-        return json_resp({"result": False, "msg": "student is required"}, status=400)
+    message = data.get("message")
+    if not isinstance(message, str) or not message.strip():
+        return json_resp({"result": False, "msg": "message is required"}, status=400)
+    if len(message) > CHAT_MESSAGE_MAX:
+        return json_resp({"result": False, "msg": f"message must be at most {CHAT_MESSAGE_MAX} characters"}, status=400)
 
-    LectureContainer = get_lecture_container()
+    shown = data.get("time")
+    if not isinstance(shown, str) or not shown or len(shown) > 32:
+        shown = lecture_now().strftime("%H:%M:%S")
 
-    # Get lecture by id (1-12)
-    try:
-        lecture = LectureContainer.read_item(
-            item=lecture_id,
-            partition_key=lecture_id
-            
-        )
-    except Exception:
-        return json_resp(
-            {"result": False, "msg": "lecture not found"},
-            status=404
-        )
+    history_buffers["chat"].add(lecture, {"user": user, "message": message, "time": shown, "at": time.time()})
+    return json_resp({"result": True, "msg": "message queued"}, status=202)
 
-    lecture_students = lecture.get("students") or []
+# Queue a snapshot of the lecture's board
+# Body: {"lecture": "title", "user": "name", "content": "board html"}
+@app.route(route="board/save", auth_level=func.AuthLevel.FUNCTION, methods=["POST"])
+def board_save(req: func.HttpRequest) -> func.HttpResponse:
+    logging.info("board/save")
 
-    if student_name not in lecture_students:
-        return json_resp(
-            {"result": False, "msg": "student not in lecture"},
-            status=404
-        )
+    data, err = parse_json(req)
+    if err:
+        return err
+    if not isinstance(data, dict):
+        return json_resp({"result": False, "msg": "body must be a json object"}, status=400)
 
-    # Remove student
-    lecture_students.remove(student_name)
-    lecture["students"] = lecture_students
+    lecture, invalid = validate_lecture_title(data.get("lecture"))
+    if invalid:
+        return json_resp(invalid, status=400)
 
-    LectureContainer.replace_item(
-        item=lecture["id"],
-        body=lecture
-    )
+    user, invalid = validate_history_user(data.get("user"))
+    if invalid:
+        return json_resp(invalid, status=400)
+
+    content = data.get("content")
+    if not isinstance(content, str):
+        return json_resp({"result": False, "msg": "content must be a string"}, status=400)
+    if len(content.encode()) > BOARD_CONTENT_MAX:
+        return json_resp({"result": False, "msg": f"content must be at most {BOARD_CONTENT_MAX} bytes"}, status=413)
+
+    history_buffers["board"].add(lecture, {"content": content, "user": user, "at": time.time()})
+    return json_resp({"result": True, "msg": "board queued"}, status=202)
+
+# Newest page of a stream: stored entries up to the head's batch count, then every entry this
+# worker still has queued (normally under HistoryFlushBatchSize, so the page can run over limit)
+# Return (entries oldest first, position of the next older page)
+def latest_history_page(kind: str, lecture: str, head, limit: int):
+    pending = history_buffers[kind].pending(lecture)
+    batches = (head or {}).get("batches", 0)
+    position = (batches - 1, None) if batches else None
+
+    if position is None:
+        return pending, None
+    if len(pending) >= limit:
+        return pending, position
+
+    entries, older = read_history_page(kind, lecture, limit - len(pending), position)
+    return entries + pending, older
+
+# Page of a lecture's chat history, newest page first
+def history_page(req: func.HttpRequest, kind: str) -> func.HttpResponse:
+    lecture, invalid = validate_lecture_title(req.params.get("lecture"))
+    if invalid:
+        return json_resp(invalid, status=400)
 
-    return json_resp(
-        {"result": True, "msg": "student removed from lecture"},
-        status=200
+    limit, err = history_limit(req)
+    if err:
+        return err
+
+    cursor = (req.params.get("cursor") or "").strip()
+    if cursor:
+        position = decode_history_cursor(cursor)
+        if position is None:
+            return json_resp({"result": False, "msg": "invalid cursor"}, status=400)
+        entries, older = read_history_page(kind, lecture, limit, position)
+    else:
+        head_id = history_head_id(kind, lecture)
+        try:
+            head = get_history_container().read_item(item=head_id, partition_key=head_id)
+        except CosmosResourceNotFoundError:
+            head = None
+        entries, older = latest_history_page(kind, lecture, head, limit)
+
+    return json_list_resp(
+        {
+            "result": True,
+            "lecture": lecture,
+            "entries": entries,
+            "cursor": encode_history_cursor(*older) if older else None
+        },
+        "entries"
     )
 
-# { "id": "string"} 
-@app.route(route="lecture/end", auth_level=func.AuthLevel.FUNCTION, methods=["POST"])
-def lecture_end(req: func.HttpRequest) -> func.HttpResponse:
-    logging.info("lecture/end")
+# GET ?lecture=title&limit=50&cursor=<cursor from the previous page>
+@app.route(route="chat/history", auth_level=func.AuthLevel.FUNCTION, methods=["GET"])
+def chat_history(req: func.HttpRequest) -> func.HttpResponse:
+    logging.info("chat/history")
 
-    data, err = parse_json(req)
+    return history_page(req, "chat")
+
+def board_revision_param(req: func.HttpRequest, name: str):
+    value = req.params.get(name)
+    if value is None or value == "":
+        return None, None
+    try:
+        revision = int(value)
+    except ValueError:
+        revision = -1
+    if revision < 0:
+        return None, json_resp({"result": False, "msg": f"{name} must be a revision number"}, status=400)
+    return revision, None
+
+# Changes to a lecture's board since the revision a client has: the deltas to apply in order,
+# or the whole board when that revision is older than the head's base snapshot
+# GET ?lecture=title&since=12
+@app.route(route="board/changes", auth_level=func.AuthLevel.FUNCTION, methods=["GET"])
+def board_changes(req: func.HttpRequest) -> func.HttpResponse:
+    logging.info("board/changes")
+
+    lecture, invalid = validate_lecture_title(req.params.get("lecture"))
+    if invalid:
+        return json_resp(invalid, status=400)
+
+    since, err = board_revision_param(req, "since")
     if err:
         return err
+    if since is None:
+        return json_resp({"result": False, "msg": "since is required"}, status=400)
 
-    lecture_id = (data.get("id") or "").strip()
+    head = read_board_head(lecture)
+    revision = head["revision"] if head else 0
+    if since > revision:
+        return json_resp({"result": False, "msg": "since is ahead of the board", "revision": revision}, status=409)
 
-    # Validate input
-    if not lecture_id:
-        return json_resp(
-            {"result": False, "msg": "id is required"},
-            status=400
-        )
+    if head is None or since >= head["base"]:
+        deltas = head["deltas"][since - head["base"]:] if head else []
+        return json_resp({"result": True, "lecture": lecture, "revision": revision, "deltas": deltas}, status=200)
 
-    LectureContainer = get_lecture_container()
+    return json_resp(
+        {"result": True, "lecture": lecture, "revision": revision, "content": board_content(lecture, head)},
+        status=200
+    )
 
-    # Get lecture by id (1-12)
-    try:
-        lecture = LectureContainer.read_item(
-            item=lecture_id,
-            partition_key=lecture_id
-        )
-    except Exception:
-        return json_resp(
-            {"result": False, "msg": "lecture not found"},
-            status=404
-        )
+# A lecture's board at any stored revision, for replay
+# GET ?lecture=title&revision=12 (default the latest)
+@app.route(route="board/revision", auth_level=func.AuthLevel.FUNCTION, methods=["GET"])
+def board_revision(req: func.HttpRequest) -> func.HttpResponse:
+    logging.info("board/revision")
 
-    # Reset lecture
-    lecture["title"] = ""
-    lecture["module"] = ""
-    lecture["lecturer"] = ""
-    lecture["students"] = []
-    lecture["date"] = ""
-    lecture["time"] = ""
+    lecture, invalid = validate_lecture_title(req.params.get("lecture"))
+    if invalid:
+        return json_resp(invalid, status=400)
 
+    revision, err = board_revision_param(req, "revision")
+    if err:
+        return err
 
-    LectureContainer.replace_item(
-        item=lecture["id"],
-        body=lecture
-    )
+    head = read_board_head(lecture)
+    latest = head["revision"] if head else 0
+    if revision is None:
+        revision = latest
+    if revision > latest:
+        return json_resp({"result": False, "msg": "revision not found", "revision": latest}, status=404)
 
     return json_resp(
-        {"result": True, "msg": "lecture reset successfully"},
+        {"result": True, "lecture": lecture, "revision": revision, "content": board_content(lecture, head, revision)},
         status=200
     )
 
+# Everything a joining client needs: the current board and the latest chat page
+# GET ?lecture=title&limit=50
+@app.route(route="lecture/history", auth_level=func.AuthLevel.FUNCTION, methods=["GET"])
+def lecture_history(req: func.HttpRequest) -> func.HttpResponse:
+    lecture, invalid = validate_lecture_title(req.params.get("lecture"))
+    if invalid:
+        return json_resp(invalid, status=400)
 
-# helpers for new lecture APIs
-def clean_unique_modules(mods):
-    if not isinstance(mods, list):
-        return []
-    cleaned = []
-    seen = set()
-    for m in mods:
-        if isinstance(m, str):
-            mm = m.strip()
-            if mm and mm not in seen:
-                seen.add(mm)
-                cleaned.append(mm)
-    return cleaned
+    limit, err = history_limit(req)
+    if err:
+        return err
 
-def get_or_create_building_doc(building: str):
-    LectureContainer = get_lecture_container()
-    building = (building or "").strip()
-    if not building:
-        return None, json_resp({"result": False, "msg": "building is required"}, status=400)
+    chat_id, board_id = history_head_id("chat", lecture), history_head_id("board", lecture)
+    heads = {d["id"]: d for d in get_history_container().read_items(items=[(chat_id, chat_id), (board_id, board_id)])}
 
-    existing = list(LectureContainer.query_items(
-        query="SELECT * FROM c WHERE c.id = @id",
-        parameters=[{"name": "@id", "value": building}],
-        enable_cross_partition_query=True
-    ))
+    board_head = heads.get(board_id)
+    queued = history_buffers["board"].pending(lecture)
+    board = queued[-1]["content"] if queued else board_content(lecture, board_head)
 
-    if existing:
-        return existing[0], None
+    messages, older = latest_history_page("chat", lecture, heads.get(chat_id), limit)
 
-    doc = {
-        "id": building,
-        "building": building,
-        "lecturer": None,
-        "module": None,
-        "students": []
-    }
-    LectureContainer.upsert_item(body=doc)
-    return doc, None
+    return json_resp(
+        {
+            "result": True,
+            "lecture": lecture,
+            "board": board,
+            "boardRevision": board_head["revision"] if board_head else 0,
+            "messages": messages,
+            "cursor": encode_history_cursor(*older) if older else None
+        },
+        status=200
+    )
+
+# Write-behind buffer counters for the metrics page
+def history_buffer_samples():
+    stats = {kind: buffer.stats() for kind, buffer in history_buffers.items()}
+    return [
+        ("history_pending_entries", "gauge", "History entries queued and not written yet",
+         [({"stream": k}, s["pending"]) for k, s in stats.items()]),
+        ("history_flushes_total", "counter", "History batch documents written",
+         [({"stream": k}, s["flushes"]) for k, s in stats.items()]),
+        ("history_flush_failures_total", "counter", "History flushes that failed and were requeued",
+         [({"stream": k}, s["failures"]) for k, s in stats.items()]),
+        ("history_dropped_total", "counter", "History entries dropped over HistoryMaxPending",
+         [({"stream": k}, s["dropped"]) for k, s in stats.items()]),
+    ]
+
+metrics_registry.register_collector(history_buffer_samples)
 
 # Student modules: get / replace
 @app.route(route="student/modules/get", auth_level=func.AuthLevel.FUNCTION, methods=["GET"])
@@ -794,20 +3204,19 @@ def student_modules_get(req: func.HttpRequest) -> func.HttpResponse:
     if not name:
         return json_resp({"result": False, "msg": "name is required"}, status=400)
 
-    StudentContainer = get_student_container()
-    students = list(StudentContainer.query_items(
-        query="SELECT * FROM s WHERE s.name = @name",
-        parameters=[{"name": "@name", "value": name}],
-        enable_cross_partition_query=True
-    ))
-    if not students:
+    s = get_student_profile(name)
+    if not s:
         return json_resp({"result": False, "msg": "student not found"}, status=404)
 
-    s = students[0]
-    return json_resp({"result": True, "modules": s.get("modules", [])}, status=200)
+    return json_resp(
+        {"result": True, "modules": s.get("modules", [])},
+        status=200,
+        headers={"ETag": http_encoding.doc_etag(s, variant="modules")}
+    )
 
 
 @app.route(route="student/modules/replace", auth_level=func.AuthLevel.FUNCTION, methods=["POST"])
+@idempotent
 def student_modules_replace(req: func.HttpRequest) -> func.HttpResponse:
     data, err = parse_json(req)
     if err:
@@ -826,20 +3235,34 @@ def student_modules_replace(req: func.HttpRequest) -> func.HttpResponse:
     if invalid:
         return json_resp({"result": False, "msg": "invalid module(s)", "invalid": invalid}, status=400)
 
+    # The module index needs the modules being replaced, so patch against the etag of the
+    # cached profile: while that copy is current no read is needed, otherwise read and retry
     StudentContainer = get_student_container()
-    students = list(StudentContainer.query_items(
-        query="SELECT * FROM s WHERE s.name = @name",
-        parameters=[{"name": "@name", "value": name}],
-        enable_cross_partition_query=True
-    ))
-    if not students:
-        return json_resp({"result": False, "msg": "student not found"}, status=404)
-
-    s = students[0]
-    s["modules"] = modules
-    StudentContainer.replace_item(item=s["id"], body=s)
+    current = get_student_profile(name)
+    for _ in range(MODULE_INDEX_RETRIES):
+        if not current:
+            return json_resp({"result": False, "msg": "student not found"}, status=404)
+        try:
+            s = StudentContainer.patch_item(
+                item=current["id"],
+                partition_key=current["id"],
+                patch_operations=[{"op": "set", "path": "/modules", "value": modules}],
+                etag=current["_etag"],
+                match_condition=MatchConditions.IfNotModified
+            )
+            break
+        except (CosmosAccessConditionFailedError, CosmosResourceNotFoundError):
+            current = get_student_by_name(name)
+    else:
+        return json_resp({"result": False, "msg": "student is busy, try again"}, status=409)
+
+    cache_student(s)
+    update_module_index(module_index_changes([(s["name"], current.get("modules") or [], modules)]))
 
-    return json_resp({"result": True, "msg": "OK", "modules": modules}, status=200)
+    return json_resp(
+        with_session_token({"result": True, "msg": "OK", "modules": modules}, s, "student"),
+        status=200
+    )
 
 
 
@@ -849,20 +3272,19 @@ def lecturer_modules_get(req: func.HttpRequest) -> func.HttpResponse:
     if not name:
         return json_resp({"result": False, "msg": "name is required"}, status=400)
 
-    LecturerContainer = get_lecturer_container()
-    lecturers = list(LecturerContainer.query_items(
-        query="SELECT * FROM l WHERE l.name = @name",
-        parameters=[{"name": "@name", "value": name}],
-        enable_cross_partition_query=True
-    ))
-    if not lecturers:
+    l = get_lecturer_profile(name)
+    if not l:
         return json_resp({"result": False, "msg": "lecturer not found"}, status=404)
 
-    l = lecturers[0]
-    return json_resp({"result": True, "modules": l.get("modules", [])}, status=200)
+    return json_resp(
+        {"result": True, "modules": l.get("modules", [])},
+        status=200,
+        headers={"ETag": http_encoding.doc_etag(l, variant="modules")}
+    )
 
 
 @app.route(route="lecturer/modules/replace", auth_level=func.AuthLevel.FUNCTION, methods=["POST"])
+@idempotent
 def lecturer_modules_replace(req: func.HttpRequest) -> func.HttpResponse:
     data, err = parse_json(req)
     if err:
@@ -881,17 +3303,141 @@ def lecturer_modules_replace(req: func.HttpRequest) -> func.HttpResponse:
     if invalid:
         return json_resp({"result": False, "msg": "invalid module(s)", "invalid": invalid}, status=400)
 
+    # The document id follows from the name, so patch without reading it; a document that
+    # isn't re-keyed yet is found by name (LegacyNameLookup). Patch rather than replace, so
+    # fields written meanwhile are kept.
     LecturerContainer = get_lecturer_container()
-    lecturers = list(LecturerContainer.query_items(
-        query="SELECT * FROM l WHERE l.name = @name",
-        parameters=[{"name": "@name", "value": name}],
-        enable_cross_partition_query=True
-    ))
-    if not lecturers:
+    lecturer_id = lecturer_doc_id(name)
+    for _ in range(2):
+        try:
+            l = LecturerContainer.patch_item(
+                item=lecturer_id,
+                partition_key=lecturer_id,
+                patch_operations=[{"op": "set", "path": "/modules", "value": modules}]
+            )
+            break
+        except CosmosResourceNotFoundError:
+            legacy = query_by_name(LecturerContainer, "l", name) if legacy_name_lookup_enabled() else None
+            if not legacy or legacy["id"] == lecturer_id:
+                return json_resp({"result": False, "msg": "lecturer not found"}, status=404)
+            lecturer_id = legacy["id"]
+    else:
         return json_resp({"result": False, "msg": "lecturer not found"}, status=404)
 
-    l = lecturers[0]
-    l["modules"] = modules
-    LecturerContainer.replace_item(item=l["id"], body=l)
+    cache_lecturer(l)
+
+    return json_resp(
+        with_session_token({"result": True, "msg": "OK", "modules": modules}, l, "lecturer"),
+        status=200
+    )
+
+
+# Batch: several sub-requests in one invocation (see batch.py)
+BATCH_MAX_REQUESTS = int(os.environ.get("BatchMaxRequests", "20"))
+BATCH_CONCURRENCY = int(os.environ.get("BatchConcurrency", "8"))
+BATCH_MEMO_SIZE = 256
+_batch_handlers = {}
+
+# route -> (methods, handler) of an app, built on first use once every route is registered
+def batch_handlers(function_app) -> dict:
+    table = _batch_handlers.get(id(function_app))
+    if table is None:
+        table = _batch_handlers.setdefault(id(function_app), batch.handler_table(function_app))
+    return table
+
+# Checked batch entries, or the 400 response
+def parse_batch(req: func.HttpRequest):
+    data, err = parse_json(req)
+    if err:
+        return None, err
+    try:
+        return batch.parse(data, BATCH_MAX_REQUESTS), None
+    except batch.BatchError as e:
+        return None, json_resp({"result": False, "msg": str(e)}, status=400)
+
+def batch_response(results: list) -> func.HttpResponse:
+    return json_resp(
+        {
+            "result": True,
+            "msg": "OK",
+            "failed": sum(1 for r in results if r["status"] >= 400),
+            "responses": results
+        },
+        status=200
+    )
+
+# Sub-requests share the worker's container clients and a lookup memo for the batch;
+# independent ones run concurrently on the batch's threads
+@app.route(route="batch", auth_level=func.AuthLevel.FUNCTION, methods=["POST"])
+def batch_run(req: func.HttpRequest) -> func.HttpResponse:
+    entries, err = parse_batch(req)
+    if err:
+        return err
+
+    token = batch_memo.set(ProfileCache(max_size=BATCH_MEMO_SIZE, ttl_seconds=profile_cache.ttl_seconds))
+    try:
+        with ThreadPoolExecutor(max_workers=BATCH_CONCURRENCY, thread_name_prefix="batch") as pool:
+            results = batch.run(
+                entries, req, batch_handlers(app),
+                lambda fn, entry: pool.submit(in_current_context(fn), entry)
+            )
+    finally:
+        batch_memo.reset(token)
+
+    return batch_response(results)
+
+# Profile cache counters for this worker
+@app.route(route="cache/stats", auth_level=func.AuthLevel.FUNCTION, methods=["GET"])
+def cache_stats(req: func.HttpRequest) -> func.HttpResponse:
+    logging.info("cache/stats")
+
+    return json_resp(
+        {
+            "result": True,
+            "profiles": profile_cache.stats(),
+            "history": {kind: buffer.stats() for kind, buffer in history_buffers.items()},
+            "idempotency": idempotency_keys.stats(),
+            "admission": admission.stats(),
+            "retries": retry_policy.stats()
+        },
+        status=200
+    )
+
+# Profile cache counters for the metrics page
+def profile_cache_samples():
+    stats = profile_cache.stats()
+    return [
+        ("profile_cache_entries", "gauge", "Cached profiles", [({}, stats["size"])]),
+        ("profile_cache_hits_total", "counter", "Profile cache hits", [({}, stats["hits"])]),
+        ("profile_cache_misses_total", "counter", "Profile cache misses", [({}, stats["misses"])]),
+        ("profile_cache_evictions_total", "counter", "Profile cache evictions", [({}, stats["evictions"])]),
+        ("profile_cache_coalesced_total", "counter", "Misses that waited on another load", [({}, stats["coalesced"])]),
+    ]
+
+metrics_registry.register_collector(profile_cache_samples)
+
+# Throttling counters for the metrics page
+def throttling_samples():
+    retries = retry_policy.stats()
+    stats = admission.stats()
+    return [
+        ("backend_throttled_total", "counter", "Container calls throttled with 429", [({}, retries["throttled"])]),
+        ("backend_throttle_retries_total", "counter", "Throttled calls retried", [({}, retries["retried"])]),
+        ("backend_throttle_exhausted_total", "counter", "Throttles past the request's retry budget", [({}, retries["exhausted"])]),
+        ("admission_rate", "gauge", "Requests a second currently admitted", [({}, stats["rate"])]),
+        ("admission_admitted_total", "counter", "Requests admitted", [({}, stats["admitted"])]),
+        ("admission_shed_total", "counter", "Requests turned away with 429", [({}, stats["shed"])]),
+    ]
+
+metrics_registry.register_collector(throttling_samples)
+
+# Prometheus metrics for this worker
+@app.route(route="metrics", auth_level=func.AuthLevel.FUNCTION, methods=["GET"])
+def metrics_get(req: func.HttpRequest) -> func.HttpResponse:
+    logging.info("metrics")
 
-    return json_resp({"result": True, "msg": "OK", "modules": modules}, status=200)
+    return func.HttpResponse(
+        body=metrics_registry.render(),
+        status_code=200,
+        mimetype="text/plain"
+    )
@@ -0,0 +1,580 @@
+# Async variant of the function app, built on azure.cosmos.aio
+# Select it with the app setting PYTHON_SCRIPT_FILE_NAME=function_app_async.py
+# Routes whose lookups don't depend on each other issue them concurrently; every other route
+# is served by its sync handler from function_app.py on the worker's thread pool.
+import asyncio
+import copy
+import inspect
+import logging
+import os
+
+import aiohttp
+import azure.functions as func
+from azure.core import MatchConditions
+from azure.core.pipeline.transport import AioHttpTransport
+from azure.cosmos.aio import CosmosClient
+from azure.cosmos.exceptions import CosmosAccessConditionFailedError, CosmosResourceNotFoundError
+
+import batch
+import function_app as sync_app
+import http_encoding
+from function_app import (
+    BATCH_MEMO_SIZE,
+    LECTURE_SLOTS_ID,
+    ROSTER_PATCH_RETRIES,
+    add_student_ops,
+    batch_handlers,
+    batch_memo,
+    batch_response,
+    cached_profile_async,
+    has_session_for,
+    idempotent,
+    json_resp,
+    lecture_busy_resp,
+    lecture_reset_ops,
+    legacy_name_lookup_enabled,
+    lecturer_doc_id,
+    login_fields,
+    login_refused,
+    login_response,
+    needs_bookings_field,
+    parse_batch,
+    parse_json,
+    profile_cache,
+    remove_student_ops,
+    roster_batch_ops,
+    roster_batch_response,
+    schedule_ops,
+    set_module_ops,
+    student_doc_id,
+    validate_auto_roster,
+    validate_lecture_module,
+    validate_lecture_schedule,
+    validate_lecture_student,
+    validate_roster_batch
+)
+from metrics import MetricsFunctionApp, instrument_async_container
+from profile_cache import ProfileCache
+from profiling import span
+from storage import backend_kind
+from storage.base import AsyncDocumentContainer
+from storage.cosmos import build_connection_policy
+from throttling import AsyncRetryingContainer
+
+# Same admission control, retry budgets and response encoding as the sync routes
+app = MetricsFunctionApp(guard=sync_app.route_guard)
+
+# Process-wide async Cosmos client, built lazily inside the worker's event loop
+_client_lock = asyncio.Lock()
+_cosmos_client = None
+_cosmos_session = None
+_cosmos_db = None
+_container_clients = {}
+
+async def get_cosmos_db_async():
+    global _cosmos_client, _cosmos_session, _cosmos_db
+
+    if _cosmos_db is not None:
+        return _cosmos_db
+
+    async with _client_lock:
+        if _cosmos_db is None:
+            cosmos_conn = os.environ.get("AzureCosmosDBConnectionString")
+            if not cosmos_conn:
+                raise ValueError("Missing AzureCosmosDBConnectionString in environment")
+
+            db_name = sync_app.database_setting()
+            pool_maxsize = int(os.environ.get("CosmosPoolMaxSize", "10"))
+
+            with span("client_construction"):
+                session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=pool_maxsize))
+                transport = AioHttpTransport(session=session, session_owner=False)
+                _cosmos_client = CosmosClient.from_connection_string(
+                    cosmos_conn, transport=transport, connection_policy=build_connection_policy()
+                )
+                _cosmos_session = session
+                _cosmos_db = _cosmos_client.get_database_client(db_name)
+
+    return _cosmos_db
+
+# Gets an async container client, cached per container name. Local backends (memory:, sqlite:)
+# are shared with the sync app so both see the same documents (and are instrumented there);
+# their throttles are retried here, so the waits don't block the event loop.
+async def get_container_async(env_name: str, default_name: str):
+    container_name = os.environ.get(env_name, default_name)
+
+    container = _container_clients.get(container_name)
+    if container is None:
+        if backend_kind(sync_app.database_setting()) != "cosmos":
+            local = sync_app.get_container(env_name, default_name)
+            container = _container_clients.setdefault(
+                container_name, AsyncRetryingContainer(AsyncDocumentContainer(local.container), sync_app.retry_policy)
+            )
+        else:
+            db = await get_cosmos_db_async()
+            container = _container_clients.setdefault(
+                container_name,
+                AsyncRetryingContainer(instrument_async_container(db.get_container_client(container_name)), sync_app.retry_policy)
+            )
+    return container
+
+# Drops the shared async client so the next call builds a fresh one
+async def reset_async_cosmos_clients():
+    global _cosmos_client, _cosmos_session, _cosmos_db
+
+    async with _client_lock:
+        client, session = _cosmos_client, _cosmos_session
+        _cosmos_client = None
+        _cosmos_session = None
+        _cosmos_db = None
+        _container_clients.clear()
+
+    if client is not None:
+        try:
+            await client.close()
+        except Exception as e:
+            logging.warning(f"async Cosmos client close failed: {e}")
+    if session is not None:
+        await session.close()
+
+async def get_lecture_container_async():
+    return await get_container_async("LectureContainerName", "lecture")
+
+async def get_lecturer_container_async():
+    return await get_container_async("LecturerContainerName", "lecturer")
+
+async def get_student_container_async():
+    return await get_container_async("StudentContainerName", "student")
+
+# Raised by a lookup to end the request early with this response
+class EarlyResponse(Exception):
+    def __init__(self, response: func.HttpResponse):
+        super().__init__(response.status_code)
+        self.response = response
+
+# Run independent lookups concurrently; the first one to fail cancels the rest
+async def run_concurrently(*coros):
+    tasks = [asyncio.ensure_future(c) for c in coros]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for t in tasks:
+            t.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+# Name lookups, same rules as find_by_name in function_app.py
+async def find_by_name_async(container, alias: str, doc_id: str, name: str):
+    try:
+        return await container.read_item(item=doc_id, partition_key=doc_id)
+    except CosmosResourceNotFoundError:
+        pass
+
+    if not legacy_name_lookup_enabled():
+        return None
+
+    docs = [d async for d in container.query_items(
+        query=f"SELECT * FROM {alias} WHERE {alias}.name = @name",
+        parameters=[{"name": "@name", "value": name}]
+    )]
+    return docs[0] if docs else None
+
+async def get_student_profile_async(name: str):
+    container = await get_student_container_async()
+    doc_id = student_doc_id(name)
+    doc = await cached_profile_async(
+        ("student", doc_id),
+        lambda: find_by_name_async(container, "s", doc_id, name)
+    )
+    return copy.deepcopy(doc)
+
+async def get_lecturer_profile_async(name: str):
+    container = await get_lecturer_container_async()
+    doc_id = lecturer_doc_id(name)
+    doc = await cached_profile_async(
+        ("lecturer", doc_id),
+        lambda: find_by_name_async(container, "l", doc_id, name)
+    )
+    return copy.deepcopy(doc)
+
+async def require_student(name: str):
+    if not await get_student_profile_async(name):
+        raise EarlyResponse(json_resp({"result": False, "msg": "student not found"}, status=404))
+
+async def require_lecturer(name: str):
+    if not await get_lecturer_profile_async(name):
+        raise EarlyResponse(json_resp({"result": False, "msg": "lecturer not found"}, status=404))
+
+async def read_lecture_async(container, lecture_id: str):
+    try:
+        return await container.read_item(item=lecture_id, partition_key=lecture_id)
+    except CosmosResourceNotFoundError:
+        raise EarlyResponse(json_resp({"result": False, "msg": "lecture not found"}, status=404))
+
+# Async patch_lecture: the first read can be passed in when it was made concurrently with other
+# lookups, and build_ops may be a coroutine function
+async def patch_lecture_async(container, lecture_id: str, build_ops, lecture=None):
+    for _ in range(ROSTER_PATCH_RETRIES):
+        if lecture is None:
+            lecture = await read_lecture_async(container, lecture_id)
+
+        result = build_ops(lecture)
+        if inspect.isawaitable(result):
+            result = await result
+        ops, err = result
+        if err:
+            return err
+
+        # Nothing to change
+        if not ops:
+            return None
+
+        try:
+            await container.patch_item(
+                item=lecture_id,
+                partition_key=lecture_id,
+                patch_operations=ops,
+                etag=lecture["_etag"],
+                match_condition=MatchConditions.IfNotModified
+            )
+            return None
+        except CosmosAccessConditionFailedError:
+            logging.info(f"lecture {lecture_id} changed during patch, retrying")
+            lecture = None
+
+    return lecture_busy_resp()
+
+# Both login routes: fresh read, then the same checks and answer as function_app.login
+async def login_async(req: func.HttpRequest, role: str) -> func.HttpResponse:
+    data, err = parse_json(req)
+    if err:
+        return err
+
+    name, password, err = login_fields(data)
+    if err:
+        return err
+
+    if role == "student":
+        container = await get_student_container_async()
+        doc = await find_by_name_async(container, "s", student_doc_id(name), name)
+    else:
+        container = await get_lecturer_container_async()
+        doc = await find_by_name_async(container, "l", lecturer_doc_id(name), name)
+
+    err = login_refused(doc, password, role)
+    if err:
+        return err
+
+    # Ensure bookings array exists
+    if needs_bookings_field(doc, role):
+        doc["bookings"] = []
+        doc = await container.replace_item(item=doc["id"], body=doc)
+
+    return login_response(doc, role)
+
+@app.route(route="student/login", auth_level=func.AuthLevel.FUNCTION, methods=["POST"])
+async def student_login(req: func.HttpRequest) -> func.HttpResponse:
+    logging.info("student/login")
+    return await login_async(req, "student")
+
+@app.route(route="lecturer/login", auth_level=func.AuthLevel.FUNCTION, methods=["POST"])
+async def lecturer_login(req: func.HttpRequest) -> func.HttpResponse:
+    logging.info("lecturer/login")
+    return await login_async(req, "lecturer")
+
+@app.route(route="student/modules/get", auth_level=func.AuthLevel.FUNCTION, methods=["GET"])
+async def student_modules_get(req: func.HttpRequest) -> func.HttpResponse:
+    name = (req.params.get("name") or "").strip()
+    if not name:
+        return json_resp({"result": False, "msg": "name is required"}, status=400)
+
+    s = await get_student_profile_async(name)
+    if not s:
+        return json_resp({"result": False, "msg": "student not found"}, status=404)
+
+    return json_resp(
+        {"result": True, "modules": s.get("modules", [])},
+        status=200,
+        headers={"ETag": http_encoding.doc_etag(s, variant="modules")}
+    )
+
+@app.route(route="lecturer/modules/get", auth_level=func.AuthLevel.FUNCTION, methods=["GET"])
+async def lecturer_modules_get(req: func.HttpRequest) -> func.HttpResponse:
+    name = (req.params.get("name") or "").strip()
+    if not name:
+        return json_resp({"result": False, "msg": "name is required"}, status=400)
+
+    l = await get_lecturer_profile_async(name)
+    if not l:
+        return json_resp({"result": False, "msg": "lecturer not found"}, status=404)
+
+    return json_resp(
+        {"result": True, "modules": l.get("modules", [])},
+        status=200,
+        headers={"ETag": http_encoding.doc_etag(l, variant="modules")}
+    )
+
+@app.route(route="lecture/setModule", auth_level=func.AuthLevel.FUNCTION, methods=["POST"])
+async def lecture_set_module(req: func.HttpRequest) -> func.HttpResponse:
+    logging.info("lecture/setModule")
+
+    data, err = parse_json(req)
+    if err:
+        return err
+
+    fields, invalid = validate_lecture_module(data)
+    if invalid:
+        return json_resp(invalid, status=400)
+
+    LectureContainer = await get_lecture_container_async()
+
+    auto_roster, invalid = validate_auto_roster(data)
+    if invalid:
+        return json_resp(invalid, status=400)
+
+    # The module's students go on the roster in the same write as the module
+    roster = await asyncio.to_thread(sync_app.module_roster, fields["module"]) if auto_roster else None
+
+    def set_module(lecture):
+        return set_module_ops(lecture, fields["title"], fields["module"], roster), None
+
+    try:
+        err = await patch_lecture_async(LectureContainer, fields["id"], set_module)
+    except EarlyResponse as e:
+        return e.response
+    if err:
+        return err
+
+    payload = {"result": True, "msg": "lecture module updated"}
+    if roster is not None:
+        payload["rostered"] = len(roster)
+    return json_resp(payload, status=200)
+
+# Lecturer lookup and lecture read run concurrently
+@app.route(route="lecture/setLecturer", auth_level=func.AuthLevel.FUNCTION, methods=["POST"])
+async def lecture_set_lecturer(req: func.HttpRequest) -> func.HttpResponse:
+    logging.info("lecture/setLecturer")
+
+    data, err = parse_json(req)
+    if err:
+        return err
+
+    fields, invalid = validate_lecture_schedule(data)
+    if invalid:
+        return json_resp(invalid, status=400)
+
+    LectureContainer = await get_lecture_container_async()
+
+    try:
+        # A session for that lecturer already proves they exist
+        if has_session_for(req, "lecturer", fields["lecturer"]):
+            lecture = await read_lecture_async(LectureContainer, fields["id"])
+        else:
+            _, lecture = await run_concurrently(
+                require_lecturer(fields["lecturer"]),
+                read_lecture_async(LectureContainer, fields["id"])
+            )
+
+        # Booking indexes are updated by the sync helpers, off the event loop
+        scheduled = {}
+        build_ops = schedule_ops(fields, scheduled)
+
+        async def set_schedule(lecture):
+            return await asyncio.to_thread(build_ops, lecture)
+
+        err = await patch_lecture_async(LectureContainer, fields["id"], set_schedule, lecture)
+    except EarlyResponse as e:
+        return e.response
+    if err:
+        await asyncio.to_thread(sync_app.release_booking, scheduled.get("booking"))
+        return err
+
+    await asyncio.to_thread(sync_app.release_booking, scheduled.get("previous"))
+
+    return json_resp({"result": True, "msg": "lecture updated", "booking": scheduled["booking"]}, status=200)
+
+# Student lookup and lecture read run concurrently
+@app.route(route="lecture/student/add", auth_level=func.AuthLevel.FUNCTION, methods=["POST"])
+@idempotent
+async def lecture_student_add(req: func.HttpRequest) -> func.HttpResponse:
+    logging.info("lecture/student/add")
+
+    data, err = parse_json(req)
+    if err:
+        return err
+
+    fields, invalid = validate_lecture_student(data)
+    if invalid:
+        return json_resp(invalid, status=400)
+
+    lecture_id, student_name = fields["id"], fields["student"]
+    LectureContainer = await get_lecture_container_async()
+
+    def add_student(lecture):
+        return add_student_ops(lecture, student_name)
+
+    try:
+        # A session for that student already proves they exist
+        if has_session_for(req, "student", student_name):
+            lecture = await read_lecture_async(LectureContainer, lecture_id)
+        else:
+            _, lecture = await run_concurrently(
+                require_student(student_name),
+                read_lecture_async(LectureContainer, lecture_id)
+            )
+        err = await patch_lecture_async(LectureContainer, lecture_id, add_student, lecture)
+    except EarlyResponse as e:
+        return e.response
+    if err:
+        return err
+
+    return json_resp({"result": True, "msg": "student added to lecture"}, status=200)
+
+@app.route(route="lecture/student/remove", auth_level=func.AuthLevel.FUNCTION, methods=["POST"])
+async def lecture_student_remove(req: func.HttpRequest) -> func.HttpResponse:
+    logging.info("lecture/student/remove")
+
+    data, err = parse_json(req)
+    if err:
+        return err
+
+    fields, invalid = validate_lecture_student(data)
+    if invalid:
+        return json_resp(invalid, status=400)
+
+    lecture_id, student_name = fields["id"], fields["student"]
+    LectureContainer = await get_lecture_container_async()
+
+    def remove_student(lecture):
+        return remove_student_ops(lecture, student_name)
+
+    try:
+        err = await patch_lecture_async(LectureContainer, lecture_id, remove_student)
+    except EarlyResponse as e:
+        return e.response
+    if err:
+        return err
+
+    return json_resp({"result": True, "msg": "student removed from lecture"}, status=200)
+
+@app.route(route="lecture/end", auth_level=func.AuthLevel.FUNCTION, methods=["POST"])
+async def lecture_end(req: func.HttpRequest) -> func.HttpResponse:
+    logging.info("lecture/end")
+
+    data, err = parse_json(req)
+    if err:
+        return err
+
+    lecture_id = (data.get("id") or "").strip()
+    if not lecture_id:
+        return json_resp({"result": False, "msg": "id is required"}, status=400)
+
+    LectureContainer = await get_lecture_container_async()
+
+    # Same reset as function_app.lecture_end, keeping the booking it clears
+    ended = {}
+
+    def reset(lecture):
+        ended["booking"] = lecture.get("booking")
+        return lecture_reset_ops(), None
+
+    try:
+        err = await patch_lecture_async(LectureContainer, lecture_id, reset)
+    except EarlyResponse as e:
+        return e.response
+    if err:
+        return err
+
+    # The slot is free again for lecture/make, and its time for other bookings
+    await release_lecture_slot_async(LectureContainer, lecture_id)
+    await asyncio.to_thread(sync_app.release_booking, ended.get("booking"))
+
+    return json_resp({"result": True, "msg": "lecture reset successfully"}, status=200)
+
+# Async form of function_app.release_lecture_slot
+async def release_lecture_slot_async(LectureContainer, slot_id: str):
+    if not slot_id.isdigit():
+        return
+    try:
+        await LectureContainer.patch_item(
+            item=LECTURE_SLOTS_ID,
+            partition_key=LECTURE_SLOTS_ID,
+            patch_operations=[{"op": "add", "path": "/free/-", "value": slot_id}],
+            filter_predicate=f'FROM c WHERE NOT ARRAY_CONTAINS(c.free, "{slot_id}")'
+        )
+    except (CosmosAccessConditionFailedError, CosmosResourceNotFoundError):
+        pass    # already listed, or no index yet
+
+# Batched student check and lecture read run concurrently
+@app.route(route="lecture/students/batch", auth_level=func.AuthLevel.FUNCTION, methods=["POST"])
+async def lecture_students_batch(req: func.HttpRequest) -> func.HttpResponse:
+    logging.info("lecture/students/batch")
+
+    data, err = parse_json(req)
+    if err:
+        return err
+
+    fields, invalid = validate_roster_batch(data)
+    if invalid:
+        return json_resp(invalid, status=400)
+
+    lecture_id, add_names, remove_names = fields["id"], fields["add"], fields["remove"]
+    candidates = list({n for n in add_names if n})
+
+    StudentContainer = await get_student_container_async()
+    LectureContainer = await get_lecture_container_async()
+
+    async def known_students():
+        if not candidates:
+            return set()
+
+        ids = {student_doc_id(n): n for n in candidates}
+        found = await StudentContainer.read_items(items=[(i, i) for i in ids])
+        known = {ids[d["id"]] for d in found}
+
+        missing = [n for n in candidates if n not in known]
+        if missing and legacy_name_lookup_enabled():
+            known |= {n async for n in StudentContainer.query_items(
+                query="SELECT VALUE s.name FROM s WHERE ARRAY_CONTAINS(@names, s.name)",
+                parameters=[{"name": "@names", "value": missing}]
+            )}
+        return known
+
+    outcomes = []
+
+    try:
+        known, lecture = await run_concurrently(
+            known_students(),
+            read_lecture_async(LectureContainer, lecture_id)
+        )
+
+        def apply_batch(lecture):
+            return roster_batch_ops(lecture, add_names, remove_names, known, outcomes)
+
+        err = await patch_lecture_async(LectureContainer, lecture_id, apply_batch, lecture)
+    except EarlyResponse as e:
+        return e.response
+    if err:
+        return err
+
+    return roster_batch_response(outcomes)
+
+# Batch of sub-requests: async handlers run as tasks on this loop, the others on threads
+@app.route(route="batch", auth_level=func.AuthLevel.FUNCTION, methods=["POST"])
+async def batch_run(req: func.HttpRequest) -> func.HttpResponse:
+    entries, err = parse_batch(req)
+    if err:
+        return err
+
+    token = batch_memo.set(ProfileCache(max_size=BATCH_MEMO_SIZE, ttl_seconds=profile_cache.ttl_seconds))
+    try:
+        results = await batch.run_async(entries, req, batch_handlers(app))
+    finally:
+        batch_memo.reset(token)
+
+    return batch_response(results)
+
+# Every route not overridden above keeps its sync handler from function_app.py, and the change
+# feed triggers are the same
+app.register_routes_from(sync_app.app)
+sync_app.register_view_triggers(app)
@@ -0,0 +1,134 @@
+# Conditional GETs and response compression for the HTTP routes.
+# Every 200 answer to a GET carries an ETag: the one the handler set (routes built from a
+# document derive it from the document's _etag, see doc_etag), otherwise a hash of the body.
+# A request whose If-None-Match has it gets 304 with no body, so a poller only transfers
+# data that changed. ETags are weak, as the same data may be sent with different encodings.
+# Bodies of at least min_size bytes are compressed with the best encoding the client accepts:
+# brotli (when the brotli package is installed), then gzip.
+import asyncio
+import functools
+import gzip
+import hashlib
+
+import azure.functions as func
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+
+
+def _weak(digest: str) -> str:
+    return f'W/"{digest[:32]}"'
+
+
+# ETag of a response built from these documents; variant tells apart routes that show
+# different parts of the same documents
+def doc_etag(*docs, variant: str = "") -> str:
+    h = hashlib.sha1(variant.encode())
+    for doc in docs:
+        h.update(b"\0" + str((doc or {}).get("_etag", "")).encode())
+    return _weak(h.hexdigest())
+
+
+def body_etag(body: bytes) -> str:
+    return _weak(hashlib.sha1(body).hexdigest())
+
+
+# If-None-Match against etag, with the weak comparison (RFC 9110 13.1.2)
+def matches(if_none_match, etag: str) -> bool:
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    opaque = etag[2:] if etag.startswith("W/") else etag
+    for tag in if_none_match.split(","):
+        tag = tag.strip()
+        if (tag[2:] if tag.startswith("W/") else tag) == opaque:
+            return True
+    return False
+
+
+def _encodings() -> tuple:
+    return ("br", "gzip") if brotli is not None else ("gzip",)
+
+
+# Encoding to answer with for an Accept-Encoding header, or None for identity
+def negotiate(accept_encoding) -> str:
+    if not accept_encoding:
+        return None
+    weights = {}
+    for part in accept_encoding.split(","):
+        name, _, params = part.strip().partition(";")
+        q = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        weights[name.strip().lower()] = q
+
+    best, best_q = None, 0.0
+    for encoding in _encodings():
+        q = weights.get(encoding, weights.get("*", 0.0))
+        if q > best_q:
+            best, best_q = encoding, q
+    return best
+
+
+def compress(body: bytes, encoding: str) -> bytes:
+    if encoding == "br":
+        return brotli.compress(body, quality=BROTLI_QUALITY)
+    return gzip.compress(body, compresslevel=GZIP_LEVEL, mtime=0)
+
+
+def finish(req: func.HttpRequest, resp: func.HttpResponse, min_size: int) -> func.HttpResponse:
+    if req is None or resp is None:
+        return resp
+    body = resp.get_body() or b""
+
+    if req.method in ("GET", "HEAD") and resp.status_code == 200:
+        etag = resp.headers.get("ETag") or body_etag(body)
+        resp.headers["ETag"] = etag
+        if matches(req.headers.get("If-None-Match"), etag):
+            return func.HttpResponse(status_code=304, headers=dict(resp.headers))
+
+    if len(body) < min_size or "Content-Encoding" in resp.headers:
+        return resp
+
+    resp.headers["Vary"] = "Accept-Encoding"
+    encoding = negotiate(req.headers.get("Accept-Encoding"))
+    if encoding is None:
+        return resp
+    return func.HttpResponse(
+        compress(body, encoding),
+        status_code=resp.status_code,
+        headers={**resp.headers, "Content-Encoding": encoding},
+        mimetype=resp.mimetype,
+        charset=resp.charset
+    )
+
+
+def _request_arg(args, kwargs):
+    for value in list(args) + list(kwargs.values()):
+        if isinstance(value, func.HttpRequest):
+            return value
+    return None
+
+
+# Wraps a route handler with the ETag / 304 handling and compression above
+def negotiated(fn, min_size: int):
+    if asyncio.iscoroutinefunction(fn):
+        @functools.wraps(fn)
+        async def async_handler(*args, **kwargs):
+            return finish(_request_arg(args, kwargs), await fn(*args, **kwargs), min_size)
+        return async_handler
+
+    @functools.wraps(fn)
+    def handler(*args, **kwargs):
+        return finish(_request_arg(args, kwargs), fn(*args, **kwargs), min_size)
+    return handler
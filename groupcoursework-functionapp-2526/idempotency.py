@@ -0,0 +1,333 @@
+# Idempotency-Key support for write routes.
+# A client that may retry a write sends the same Idempotency-Key header with every attempt.
+# The first request with a key runs the handler and its response is kept for ttl seconds;
+# later requests with that key get the kept response back (with Idempotent-Replayed: true)
+# without running the handler again, and ones that arrive while the first is still running
+# wait for it. A key reused with a different body is refused with 422. 5xx and 429 responses
+# are not kept, so a retry after those runs the handler again.
+# Responses are kept in this worker's memory. With a persistent store (ContainerResultStore)
+# they are also written to a container, which other workers check and claim keys in, so a
+# duplicate that lands on another worker is answered from there or waits as well. A claim
+# lasts lease_seconds, separate from how long duplicates wait: it has to outlast the slowest
+# handler, or another worker would take the key over and run the request a second time. A
+# claim left by a worker that died blocks its key until the lease runs out.
+import asyncio
+import functools
+import hashlib
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+import azure.functions as func
+from azure.core import MatchConditions
+from azure.cosmos.exceptions import (
+    CosmosAccessConditionFailedError,
+    CosmosResourceExistsError,
+    CosmosResourceNotFoundError
+)
+
+HEADER = "Idempotency-Key"
+REPLAYED_HEADER = "Idempotent-Replayed"
+KEY_MAX = 255
+# Headers that describe one invocation rather than the response
+UNKEPT_HEADERS = ("x-request-charge", "content-length", "content-type")
+
+
+def _resp(payload: dict, status: int) -> func.HttpResponse:
+    return func.HttpResponse(json.dumps(payload), status_code=status, mimetype="application/json")
+
+
+def fingerprint(req: func.HttpRequest) -> str:
+    return hashlib.sha256((req.method or "").encode() + b"\n" + (req.get_body() or b"")).hexdigest()
+
+
+# Kept response of one key
+def keep(key: str, fp: str, resp: func.HttpResponse) -> dict:
+    return {
+        "key": key,
+        "fingerprint": fp,
+        "status": resp.status_code,
+        "body": (resp.get_body() or b"").decode("utf-8"),
+        "mimetype": resp.mimetype,
+        "headers": {k: v for k, v in resp.headers.items() if k.lower() not in UNKEPT_HEADERS},
+    }
+
+
+def replay(record: dict) -> func.HttpResponse:
+    return func.HttpResponse(
+        record["body"],
+        status_code=record["status"],
+        mimetype=record["mimetype"],
+        headers={**record["headers"], REPLAYED_HEADER: "true"}
+    )
+
+
+def keepable(resp: func.HttpResponse) -> bool:
+    return resp.status_code < 500 and resp.status_code != 429
+
+
+# Responses kept in a container, one document per key. Cosmos removes them after their ttl
+# when the container has TTL enabled (default time to live "on, no default"); expired
+# documents that are still there are ignored.
+class ContainerResultStore:
+    def __init__(self, get_container):
+        self._get_container = get_container
+
+    @staticmethod
+    def _doc_id(key: str) -> str:
+        return hashlib.sha256(key.encode()).hexdigest()
+
+    # Kept response or claim of key, None when there is none (or it expired)
+    def get(self, key: str):
+        doc_id = self._doc_id(key)
+        try:
+            doc = self._get_container().read_item(item=doc_id, partition_key=doc_id)
+        except CosmosResourceNotFoundError:
+            return None
+        return doc if doc["expires"] > time.time() else None
+
+    # Claims key for this worker for lease seconds: None when claimed, otherwise the
+    # response or claim already there
+    def claim(self, key: str, fp: str, lease: float):
+        doc_id = self._doc_id(key)
+        container = self._get_container()
+        doc = {"id": doc_id, "key": key, "fingerprint": fp, "status": None,
+               "expires": time.time() + lease, "ttl": max(1, int(lease))}
+        while True:
+            try:
+                container.create_item(body=doc)
+                return None
+            except CosmosResourceExistsError:
+                pass
+            try:
+                existing = container.read_item(item=doc_id, partition_key=doc_id)
+            except CosmosResourceNotFoundError:
+                # Released since: claim it afresh
+                continue
+            if existing["expires"] > time.time():
+                return existing
+
+            # Expired: take it over, unless another worker did since our read, in which case
+            # the next round reads its claim
+            try:
+                container.replace_item(
+                    item=doc_id,
+                    body=doc,
+                    etag=existing["_etag"],
+                    match_condition=MatchConditions.IfNotModified
+                )
+                return None
+            except (CosmosAccessConditionFailedError, CosmosResourceNotFoundError):
+                continue
+
+    def put(self, key: str, record: dict, ttl: float):
+        doc_id = self._doc_id(key)
+        self._get_container().upsert_item(
+            body={**record, "id": doc_id, "expires": time.time() + ttl, "ttl": max(1, int(ttl))}
+        )
+
+    def release(self, key: str):
+        doc_id = self._doc_id(key)
+        try:
+            self._get_container().delete_item(item=doc_id, partition_key=doc_id)
+        except CosmosResourceNotFoundError:
+            pass
+
+
+# One request running with a key in this worker
+class _Flight:
+    def __init__(self, fp: str):
+        self.fingerprint = fp
+        self.event = threading.Event()
+        self.record = None
+
+
+class IdempotencyKeys:
+    def __init__(self, ttl_seconds: float = 86400, max_size: int = 10000, wait_seconds: float = 10,
+                 store=None, poll_seconds: float = 0.1, lease_seconds: float = 240):
+        self.ttl_seconds = ttl_seconds
+        self.max_size = max_size
+        self.wait_seconds = wait_seconds
+        self.lease_seconds = lease_seconds
+        self.store = store
+        self.poll_seconds = poll_seconds
+        self._lock = threading.Lock()
+        self._records = OrderedDict()   # key -> (expires_at, record)
+        self._inflight = {}             # key -> _Flight
+        self.replayed = 0
+        self.waited = 0
+        self.conflicts = 0
+
+    # Either (None, flight) when the caller should run the request and finish(flight, ...)
+    # afterwards, or (response, None) to answer with straight away
+    def begin(self, key: str, fp: str):
+        deadline = time.monotonic() + self.wait_seconds
+        while True:
+            with self._lock:
+                record = self._cached(key)
+                flight = None if record is not None else self._inflight.get(key)
+                leader = record is None and flight is None
+                if leader:
+                    flight = self._inflight[key] = _Flight(fp)
+            if record is not None:
+                return self._answer(record, fp), None
+            if leader:
+                break
+            if flight.fingerprint != fp:
+                return self._mismatch(), None
+            with self._lock:
+                self.waited += 1
+            if not flight.event.wait(max(0.0, deadline - time.monotonic())):
+                return self._in_progress(), None
+            # The original wasn't kept (5xx, 429 or an error): go again
+
+        if self.store is None:
+            return None, flight
+        try:
+            found = self._claim(key, fp, deadline)
+        except BaseException:
+            self._end(key, flight)
+            raise
+        if found is None:
+            return None, flight
+        self._end(key, flight, found if found.get("status") is not None else None)
+        if found["fingerprint"] != fp:
+            return self._mismatch(), None
+        if found.get("status") is None:
+            return self._in_progress(), None
+        return self._answer(found, fp), None
+
+    def finish(self, key: str, flight: _Flight, resp):
+        record = keep(key, flight.fingerprint, resp) if resp is not None and keepable(resp) else None
+        try:
+            if self.store is not None:
+                if record is not None:
+                    self.store.put(key, record, self.ttl_seconds)
+                else:
+                    self.store.release(key)
+        except Exception as e:
+            # The request itself succeeded; other workers just won't see its response
+            logging.error(f"idempotency store write failed for {key}: {e}")
+        finally:
+            self._end(key, flight, record)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "size": len(self._records),
+                "inflight": len(self._inflight),
+                "replayed": self.replayed,
+                "waited": self.waited,
+                "conflicts": self.conflicts,
+            }
+
+    # Claims key in the store, waiting while another worker holds it. None when claimed,
+    # otherwise the kept response, or the other worker's claim if it outlasted the wait.
+    def _claim(self, key: str, fp: str, deadline: float):
+        found = self.store.claim(key, fp, self.lease_seconds)
+        while found is not None and found.get("status") is None and found["fingerprint"] == fp:
+            if time.monotonic() >= deadline:
+                break
+            time.sleep(self.poll_seconds)
+            found = self.store.get(key)
+            if found is None:
+                found = self.store.claim(key, fp, self.lease_seconds)
+        return found
+
+    def _end(self, key: str, flight: _Flight, record=None):
+        with self._lock:
+            if record is not None:
+                self._records[key] = (time.monotonic() + self.ttl_seconds, record)
+                self._records.move_to_end(key)
+                while len(self._records) > self.max_size:
+                    self._records.popitem(last=False)
+            if self._inflight.get(key) is flight:
+                del self._inflight[key]
+        flight.record = record
+        flight.event.set()
+
+    # Caller holds the lock
+    def _cached(self, key: str):
+        entry = self._records.get(key)
+        if entry is None:
+            return None
+        if entry[0] <= time.monotonic():
+            del self._records[key]
+            return None
+        return entry[1]
+
+    def _answer(self, record: dict, fp: str) -> func.HttpResponse:
+        if record["fingerprint"] != fp:
+            return self._mismatch()
+        with self._lock:
+            self.replayed += 1
+        return replay(record)
+
+    def _mismatch(self) -> func.HttpResponse:
+        with self._lock:
+            self.conflicts += 1
+        return _resp({"result": False, "msg": f"{HEADER} was already used for a different request"}, 422)
+
+    @staticmethod
+    def _in_progress() -> func.HttpResponse:
+        return _resp({"result": False, "msg": f"a request with this {HEADER} is still in progress"}, 409)
+
+
+# Wraps a route handler so requests with an Idempotency-Key run at most once per key. Keys
+# are scoped by handler name, which the sync and async apps share.
+def idempotent(keys: IdempotencyKeys, fn):
+    name = fn.__name__
+
+    def request_key(args, kwargs):
+        for value in list(args) + list(kwargs.values()):
+            if isinstance(value, func.HttpRequest):
+                return value, (value.headers.get(HEADER) or "").strip()
+        return None, ""
+
+    def invalid_key(key: str):
+        if len(key) > KEY_MAX:
+            return _resp({"result": False, "msg": f"{HEADER} must be at most {KEY_MAX} characters"}, 400)
+        return None
+
+    if asyncio.iscoroutinefunction(fn):
+        @functools.wraps(fn)
+        async def async_handler(*args, **kwargs):
+            req, key = request_key(args, kwargs)
+            if not key:
+                return await fn(*args, **kwargs)
+            err = invalid_key(key)
+            if err:
+                return err
+            scoped = f"{name}:{key}"
+            answer, flight = await asyncio.to_thread(keys.begin, scoped, fingerprint(req))
+            if answer is not None:
+                return answer
+            resp = None
+            try:
+                resp = await fn(*args, **kwargs)
+                return resp
+            finally:
+                await asyncio.to_thread(keys.finish, scoped, flight, resp)
+        return async_handler
+
+    @functools.wraps(fn)
+    def handler(*args, **kwargs):
+        req, key = request_key(args, kwargs)
+        if not key:
+            return fn(*args, **kwargs)
+        err = invalid_key(key)
+        if err:
+            return err
+        scoped = f"{name}:{key}"
+        answer, flight = keys.begin(scoped, fingerprint(req))
+        if answer is not None:
+            return answer
+        resp = None
+        try:
+            resp = fn(*args, **kwargs)
+            return resp
+        finally:
+            keys.finish(scoped, flight, resp)
+    return handler
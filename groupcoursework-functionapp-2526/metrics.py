@@ -0,0 +1,393 @@
+# Per-route and per-backend-operation metrics for this worker process, in Prometheus text format.
+# MetricsFunctionApp wraps every HTTP handler it registers and instrument_container wraps every
+# container client, so each invocation records latency, status and response size, and each
+# container call records latency, outcome and its request charge (RU, from the response
+# headers) against the route that made it. Each worker keeps its own numbers, so scrape every
+# instance. The per-request RU total is also returned in the X-Request-Charge header.
+# The same wrappers start and feed on-demand profiles (see profiling.py).
+import asyncio
+import bisect
+import contextvars
+import functools
+import threading
+import time
+from collections import Counter
+
+import azure.functions as func
+from azure.functions.decorators.function_app import FunctionBuilder
+from azure.cosmos.exceptions import CosmosHttpResponseError
+
+import profiling
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (128, 512, 1024, 4096, 16384, 65536, 262144, 1048576)
+
+# Route of the invocation running in this context, "-" outside a handler (scripts, startup)
+current_route = contextvars.ContextVar("current_route", default="-")
+# RU spent so far by the invocation running in this context, as a one-item list
+_current_charge = contextvars.ContextVar("current_charge", default=None)
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._collectors = []
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.requests = Counter()           # (route, method, status) -> count
+            self.request_latency = {}           # route -> Histogram
+            self.response_size = {}             # route -> Histogram
+            self.backend_calls = Counter()      # (route, container, operation, outcome) -> count
+            self.backend_latency = {}           # (container, operation) -> Histogram
+            self.request_charge = Counter()     # (route, container, operation) -> RU
+
+    # Extra samples for the metrics page: fn() -> [(name, type, help, [(labels dict, value)])]
+    def register_collector(self, fn):
+        self._collectors.append(fn)
+
+    def observe_request(self, route: str, method: str, status: int, seconds: float, size: int):
+        with self._lock:
+            self.requests[(route, method, str(status))] += 1
+            self.request_latency.setdefault(route, Histogram(LATENCY_BUCKETS)).observe(seconds)
+            self.response_size.setdefault(route, Histogram(SIZE_BUCKETS)).observe(size)
+
+    def observe_backend(self, route: str, container: str, operation: str, outcome: str, seconds: float, charge: float):
+        with self._lock:
+            self.backend_calls[(route, container, operation, outcome)] += 1
+            self.backend_latency.setdefault((container, operation), Histogram(LATENCY_BUCKETS)).observe(seconds)
+            if charge:
+                self.request_charge[(route, container, operation)] += charge
+            total = _current_charge.get()
+            if total is not None:
+                total[0] += charge
+
+    def render(self) -> str:
+        lines = []
+
+        def family(name, kind, help_text):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+
+        def histogram(name, labels, h):
+            cumulative = 0
+            for bound, n in zip(h.buckets, h.counts):
+                cumulative += n
+                lines.append(f"{name}_bucket{_labels({**labels, 'le': _number(bound)})} {cumulative}")
+            lines.append(f"{name}_bucket{_labels({**labels, 'le': '+Inf'})} {h.count}")
+            lines.append(f"{name}_sum{_labels(labels)} {_number(h.sum)}")
+            lines.append(f"{name}_count{_labels(labels)} {h.count}")
+
+        with self._lock:
+            family("http_requests_total", "counter", "HTTP invocations by route, method and status")
+            for (route, method, status), n in sorted(self.requests.items()):
+                lines.append(f"http_requests_total{_labels({'route': route, 'method': method, 'status': status})} {n}")
+
+            family("http_request_duration_seconds", "histogram", "Handler latency by route")
+            for route, h in sorted(self.request_latency.items()):
+                histogram("http_request_duration_seconds", {"route": route}, h)
+
+            family("http_response_size_bytes", "histogram", "Response body size by route")
+            for route, h in sorted(self.response_size.items()):
+                histogram("http_response_size_bytes", {"route": route}, h)
+
+            family("backend_calls_total", "counter", "Container calls by route, container, operation and outcome")
+            for (route, container, operation, outcome), n in sorted(self.backend_calls.items()):
+                labels = {"route": route, "container": container, "operation": operation, "outcome": outcome}
+                lines.append(f"backend_calls_total{_labels(labels)} {n}")
+
+            family("backend_call_duration_seconds", "histogram", "Container call latency by container and operation")
+            for (container, operation), h in sorted(self.backend_latency.items()):
+                histogram("backend_call_duration_seconds", {"container": container, "operation": operation}, h)
+
+            family("backend_request_charge_total", "counter", "Request units consumed by route, container and operation")
+            for (route, container, operation), ru in sorted(self.request_charge.items()):
+                labels = {"route": route, "container": container, "operation": operation}
+                lines.append(f"backend_request_charge_total{_labels(labels)} {_number(ru)}")
+
+        for collect in self._collectors:
+            for name, kind, help_text, samples in collect():
+                family(name, kind, help_text)
+                for labels, value in samples:
+                    lines.append(f"{name}{_labels(labels)} {_number(value)}")
+
+        return "\n".join(lines) + "\n"
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(labels: dict) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in labels.items()) + "}"
+
+
+def _number(value) -> str:
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+registry = MetricsRegistry()
+
+
+# Handler instrumentation
+
+def _begin(route: str):
+    return current_route.set(route), _current_charge.set([0.0])
+
+
+def _finish(route: str, req, resp, start: float, tokens):
+    seconds = time.perf_counter() - start
+    charge = _current_charge.get()[0]
+    current_route.reset(tokens[0])
+    _current_charge.reset(tokens[1])
+
+    status = resp.status_code if resp is not None else 500
+    size = len(resp.get_body() or b"") if resp is not None else 0
+    registry.observe_request(route, getattr(req, "method", "") or "", status, seconds, size)
+    if resp is not None:
+        resp.headers["X-Request-Charge"] = f"{charge:.2f}"
+
+
+def _request_arg(args, kwargs):
+    for value in list(args) + list(kwargs.values()):
+        if isinstance(value, func.HttpRequest):
+            return value
+    return None
+
+
+def observe_route(route: str, fn):
+    if asyncio.iscoroutinefunction(fn):
+        @functools.wraps(fn)
+        async def async_handler(*args, **kwargs):
+            req = _request_arg(args, kwargs)
+            tokens = _begin(route)
+            profile = profiling.start(route, req)
+            start = time.perf_counter()
+            resp = None
+            try:
+                resp = await fn(*args, **kwargs)
+                return resp
+            finally:
+                if profile is not None:
+                    profiling.finish(profile, resp)
+                _finish(route, req, resp, start, tokens)
+        return async_handler
+
+    @functools.wraps(fn)
+    def handler(*args, **kwargs):
+        req = _request_arg(args, kwargs)
+        tokens = _begin(route)
+        profile = profiling.start(route, req)
+        start = time.perf_counter()
+        resp = None
+        try:
+            resp = fn(*args, **kwargs)
+            return resp
+        finally:
+            if profile is not None:
+                profiling.finish(profile, resp)
+            _finish(route, req, resp, start, tokens)
+    return handler
+
+
+# A route registered on a MetricsFunctionApp: the function and decorator arguments it was
+# registered with, and handler, the function the host calls (fn wrapped by guard and metrics)
+class RegisteredRoute:
+    def __init__(self, route: str, fn, handler, args: tuple, kwargs: dict):
+        self.route = route
+        self.fn = fn
+        self.handler = handler
+        self.args = args
+        self.kwargs = kwargs
+        self.methods = {str(getattr(m, "value", m)).upper() for m in (kwargs.get("methods") or [])}
+
+
+# FunctionApp whose HTTP routes are recorded in the registry. guard(route, fn), when given,
+# wraps each handler inside the instrumentation (e.g. admission control, see throttling.py).
+# routes maps each route to its RegisteredRoute, in registration order.
+class MetricsFunctionApp(func.FunctionApp):
+    def __init__(self, *args, guard=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.guard = guard
+        self.routes = {}
+
+    def route(self, route=None, *args, **kwargs):
+        register = super().route(route, *args, **kwargs)
+
+        def decorator(fn):
+            if not isinstance(fn, FunctionBuilder):
+                name = route or fn.__name__
+                handler = fn
+                if self.guard is not None:
+                    handler = self.guard(name, handler)
+                handler = observe_route(name, handler)
+                self.routes[name] = RegisteredRoute(name, fn, handler, args, kwargs)
+                fn = handler
+            return register(fn)
+        return decorator
+
+    # Registers the routes of other that this app has no handler for, with the same arguments
+    def register_routes_from(self, other: "MetricsFunctionApp"):
+        for name, registered in list(other.routes.items()):
+            if name not in self.routes:
+                self.route(name, *registered.args, **registered.kwargs)(registered.fn)
+
+
+# Run fn in a copy of the caller's context, so work handed to a thread pool is still
+# attributed to the route that submitted it
+def in_current_context(fn):
+    context = contextvars.copy_context()
+
+    @functools.wraps(fn)
+    def run(*args, **kwargs):
+        return context.copy().run(fn, *args, **kwargs)
+    return run
+
+
+# Container instrumentation
+
+def _charge_from(headers) -> float:
+    try:
+        return float((headers or {}).get("x-ms-request-charge", 0) or 0)
+    except (TypeError, ValueError):
+        return 0.0
+
+
+def _outcome(e: Exception) -> str:
+    if isinstance(e, CosmosHttpResponseError) and e.status_code:
+        return str(e.status_code)
+    return "error"
+
+
+class _Call:
+    def __init__(self, container: str, operation: str, kwargs: dict):
+        self.route = current_route.get()
+        self.container = container
+        self.operation = operation
+        self.charge = 0.0
+        self.outcome = "ok"
+        self.start = time.perf_counter()
+
+        user_hook = kwargs.get("response_hook")
+
+        def hook(headers, result):
+            self.charge += _charge_from(headers)
+            if user_hook is not None:
+                user_hook(headers, result)
+        kwargs["response_hook"] = hook
+
+    def failed(self, e: Exception):
+        self.outcome = _outcome(e)
+        self.charge += _charge_from(getattr(e, "headers", None))
+
+    def done(self):
+        seconds = time.perf_counter() - self.start
+        registry.observe_backend(self.route, self.container, self.operation, self.outcome, seconds, self.charge)
+        profiling.record(f"backend:{self.container}.{self.operation}", seconds)
+
+
+POINT_OPERATIONS = (
+    "read_item", "read_items", "create_item", "upsert_item", "replace_item",
+    "patch_item", "delete_item", "execute_item_batch"
+)
+ITERATOR_OPERATIONS = ("query_items", "read_all_items", "query_items_change_feed")
+
+
+# Sync container client proxy; anything not listed above passes straight through
+class InstrumentedContainer:
+    def __init__(self, container):
+        self._container = container
+        self.id = container.id
+
+    def __getattr__(self, name):
+        attr = getattr(self._container, name)
+        if name in POINT_OPERATIONS:
+            return functools.partial(self._call, name, attr)
+        if name in ITERATOR_OPERATIONS:
+            return functools.partial(self._iterate, name, attr)
+        return attr
+
+    def _call(self, operation, method, *args, **kwargs):
+        call = _Call(self.id, operation, kwargs)
+        try:
+            return method(*args, **kwargs)
+        except Exception as e:
+            call.failed(e)
+            raise
+        finally:
+            call.done()
+
+    # Queries are lazy: the call is timed until the caller has consumed the results
+    def _iterate(self, operation, method, *args, **kwargs):
+        call = _Call(self.id, operation, kwargs)
+        try:
+            results = method(*args, **kwargs)
+        except Exception as e:
+            call.failed(e)
+            call.done()
+            raise
+        return self._consume(call, results)
+
+    @staticmethod
+    def _consume(call, results):
+        try:
+            yield from results
+        except Exception as e:
+            call.failed(e)
+            raise
+        finally:
+            call.done()
+
+
+# Async (azure.cosmos.aio) container client proxy
+class AsyncInstrumentedContainer(InstrumentedContainer):
+    async def _call(self, operation, method, *args, **kwargs):
+        call = _Call(self.id, operation, kwargs)
+        try:
+            return await method(*args, **kwargs)
+        except Exception as e:
+            call.failed(e)
+            raise
+        finally:
+            call.done()
+
+    def _iterate(self, operation, method, *args, **kwargs):
+        call = _Call(self.id, operation, kwargs)
+        return self._consume_async(call, method(*args, **kwargs))
+
+    @staticmethod
+    async def _consume_async(call, results):
+        try:
+            async for item in results:
+                yield item
+        except Exception as e:
+            call.failed(e)
+            raise
+        finally:
+            call.done()
+
+
+def instrument_container(container):
+    return InstrumentedContainer(container)
+
+
+def instrument_async_container(container):
+    return AsyncInstrumentedContainer(container)
@@ -0,0 +1,171 @@
+import asyncio
+import threading
+import time
+from collections import OrderedDict
+
+
+# One in-progress backend load, shared by every caller that misses on the same key
+class _Flight:
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+        self.error = None
+        self.stale = False
+
+
+# Bounded in-process cache with TTL expiry, LRU eviction and per-key single-flight loads
+class ProfileCache:
+    def __init__(self, max_size: int = 1024, ttl_seconds: float = 30.0):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()   # key -> (expires_at, value)
+        self._inflight = {}             # key -> _Flight
+        self._async_inflight = {}       # key -> asyncio.Future, for the async app
+        self._async_stale = set()       # async loads overtaken by a put/invalidate
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.coalesced = 0
+
+    # Return the cached value, or run loader once for all concurrent misses on key.
+    # None results are not cached so a new profile is visible straight away.
+    def get_or_load(self, key, loader):
+        now = time.monotonic()
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[0] > now:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return entry[1]
+                del self._entries[key]
+
+            self.misses += 1
+            flight = self._inflight.get(key)
+            leader = flight is None
+            if leader:
+                flight = _Flight()
+                self._inflight[key] = flight
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            flight.event.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.value
+
+        try:
+            flight.value = loader()
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+                if flight.error is None and flight.value is not None and not flight.stale:
+                    self._store(key, flight.value)
+            flight.event.set()
+
+        return flight.value
+
+    # Same as get_or_load for coroutine loaders: concurrent misses on key await one load
+    async def get_or_load_async(self, key, loader):
+        now = time.monotonic()
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[0] > now:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return entry[1]
+                del self._entries[key]
+
+            self.misses += 1
+            future = self._async_inflight.get(key)
+            leader = future is None
+            if leader:
+                future = asyncio.get_running_loop().create_future()
+                self._async_inflight[key] = future
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            try:
+                return await asyncio.shield(future)
+            except asyncio.CancelledError:
+                # The leader was cancelled, not us: load again
+                if future.cancelled():
+                    return await self.get_or_load_async(key, loader)
+                raise
+
+        try:
+            value = await loader()
+        except BaseException as e:
+            with self._lock:
+                self._async_inflight.pop(key, None)
+                self._async_stale.discard(key)
+            if isinstance(e, asyncio.CancelledError):
+                future.cancel()
+            else:
+                future.set_exception(e)
+                # Nobody else may be waiting, don't log "exception never retrieved"
+                future.exception()
+            raise
+
+        with self._lock:
+            self._async_inflight.pop(key, None)
+            stale = key in self._async_stale
+            self._async_stale.discard(key)
+            if value is not None and not stale:
+                self._store(key, value)
+        future.set_result(value)
+        return value
+
+    # Write-through after a successful backend write
+    def put(self, key, value):
+        with self._lock:
+            self._mark_stale(key)
+            self._store(key, value)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._mark_stale(key)
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            for key in list(self._inflight) + list(self._async_inflight):
+                self._mark_stale(key)
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "maxSize": self.max_size,
+                "ttlSeconds": self.ttl_seconds,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "coalesced": self.coalesced,
+            }
+
+    # Caller holds the lock
+    def _mark_stale(self, key):
+        flight = self._inflight.get(key)
+        if flight is not None:
+            flight.stale = True
+        if key in self._async_inflight:
+            self._async_stale.add(key)
+
+    # Caller holds the lock
+    def _store(self, key, value):
+        self._entries[key] = (time.monotonic() + self.ttl_seconds, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
@@ -0,0 +1,201 @@
+# On-demand profiling of single handler invocations.
+# A request is profiled when it sends "X-Profile: <ProfileKey>" (the route still needs its
+# function key) or is picked by ProfileSampleRate (0..1, default 0). A profiled invocation
+# runs under cProfile and records phase spans: JSON parsing, validation, client construction
+# and every backend call. Header-triggered requests get the phase split back in
+# X-Profile-* response headers; with ProfileOutputDir set, each profile is also written there as
+# <id>.pstats (cProfile, for snakeviz / flameprof) and <id>.folded (collapsed phase stacks in
+# microseconds, for flamegraph.pl / speedscope). When neither setting is on, the only cost is one
+# context variable lookup per span.
+import asyncio
+import contextvars
+import cProfile
+import functools
+import hmac
+import logging
+import os
+import pstats
+import random
+import threading
+import time
+import uuid
+from collections import Counter
+from contextlib import nullcontext
+
+PROFILE_HEADER = "X-Profile"
+
+_active = contextvars.ContextVar("active_profile", default=None)
+_NULL_SPAN = nullcontext()
+
+
+def _owner():
+    try:
+        task = asyncio.current_task()
+    except RuntimeError:
+        task = None
+    return id(task) if task is not None else threading.get_ident()
+
+
+class Profile:
+    def __init__(self, route: str, requested: bool):
+        self.id = f"{time.strftime('%Y%m%dT%H%M%S')}-{route.replace('/', '_')}-{uuid.uuid4().hex[:8]}"
+        self.route = route
+        self.requested = requested
+        self.phases = Counter()         # phase name -> seconds, nested phases included
+        self.folded = Counter()         # "route;phase;..." -> self seconds
+        self.profiler = None
+        self.token = None
+        self._lock = threading.Lock()
+        self._stacks = {}               # thread or task -> [[name, start, child seconds]]
+        self.start = time.perf_counter()
+
+    def _stack(self) -> list:
+        owner = _owner()
+        stack = self._stacks.get(owner)
+        if stack is None:
+            stack = self._stacks.setdefault(owner, [[self.route, self.start, 0.0]])
+        return stack
+
+    def enter(self, name: str):
+        self._stack().append([name, time.perf_counter(), 0.0])
+
+    def exit(self):
+        stack = self._stack()
+        name, start, children = stack.pop()
+        self._add(stack, name, time.perf_counter() - start, children)
+
+    # A finished leaf span, e.g. a backend call timed by the metrics layer
+    def record(self, name: str, seconds: float):
+        self._add(self._stack(), name, seconds, 0.0)
+
+    def _add(self, stack: list, name: str, seconds: float, children: float):
+        path = ";".join(frame[0] for frame in stack) + ";" + name
+        with self._lock:
+            self.folded[path] += seconds - children
+            self.phases[name] += seconds
+        if stack:
+            stack[-1][2] += seconds
+
+    def close(self) -> float:
+        total = time.perf_counter() - self.start
+        root = self._stacks.get(_owner())
+        children = root[0][2] if root else 0.0
+        with self._lock:
+            self.folded[self.route] += max(total - children, 0.0)
+        return total
+
+
+class _Span:
+    __slots__ = ("profile", "name")
+
+    def __init__(self, profile: Profile, name: str):
+        self.profile = profile
+        self.name = name
+
+    def __enter__(self):
+        self.profile.enter(self.name)
+        return self
+
+    def __exit__(self, *exc):
+        self.profile.exit()
+        return False
+
+
+# Context manager timing one phase of the current invocation, a no-op when it isn't profiled
+def span(name: str):
+    profile = _active.get()
+    if profile is None:
+        return _NULL_SPAN
+    return _Span(profile, name)
+
+
+# Decorator form of span for whole helper functions
+def phase(name: str):
+    def decorate(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            profile = _active.get()
+            if profile is None:
+                return fn(*args, **kwargs)
+            with _Span(profile, name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def record(name: str, seconds: float):
+    profile = _active.get()
+    if profile is not None:
+        profile.record(name, seconds)
+
+
+def _sample_rate() -> float:
+    try:
+        return float(os.environ.get("ProfileSampleRate", "0") or 0)
+    except ValueError:
+        return 0.0
+
+
+def _requested(req) -> bool:
+    key = os.environ.get("ProfileKey", "")
+    if not key or req is None:
+        return False
+    value = req.headers.get(PROFILE_HEADER)
+    return bool(value) and hmac.compare_digest(value, key)
+
+
+# Start profiling this invocation if it asked for it or was sampled, otherwise None
+def start(route: str, req):
+    requested = _requested(req)
+    if not requested:
+        rate = _sample_rate()
+        if rate <= 0 or random.random() >= rate:
+            return None
+
+    profile = Profile(route, requested)
+    profile.token = _active.set(profile)
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+        profile.profiler = profiler
+    except ValueError:
+        # Another profiler is already active on this thread; keep the phase spans only
+        logging.warning(f"profile {profile.id}: cProfile unavailable, recording phases only")
+    return profile
+
+
+def _top_functions(profiler, limit: int = 5) -> list:
+    stats = pstats.Stats(profiler)
+    rows = sorted(stats.stats.items(), key=lambda kv: kv[1][2], reverse=True)[:limit]
+    return [f"{os.path.basename(f)}:{line}({name})={tt * 1000:.3f}" for (f, line, name), (_, _, tt, _, _) in rows]
+
+
+def finish(profile: Profile, resp):
+    if profile.profiler is not None:
+        profile.profiler.disable()
+    _active.reset(profile.token)
+    total = profile.close()
+
+    phases = ";".join(f"{name}={seconds * 1000:.3f}" for name, seconds in profile.phases.most_common())
+    top = ";".join(_top_functions(profile.profiler)) if profile.profiler is not None else ""
+    logging.info(f"profile {profile.id}: total={total * 1000:.3f}ms {phases}")
+
+    out_dir = os.environ.get("ProfileOutputDir", "")
+    if out_dir:
+        try:
+            os.makedirs(out_dir, exist_ok=True)
+            base = os.path.join(out_dir, profile.id)
+            if profile.profiler is not None:
+                profile.profiler.dump_stats(base + ".pstats")
+            with open(base + ".folded", "w") as f:
+                for path, seconds in sorted(profile.folded.items()):
+                    f.write(f"{path} {max(int(seconds * 1_000_000), 0)}\n")
+        except OSError as e:
+            logging.warning(f"profile {profile.id}: could not write output: {e}")
+
+    if profile.requested and resp is not None:
+        resp.headers["X-Profile-Id"] = profile.id
+        resp.headers["X-Profile-Total-Ms"] = f"{total * 1000:.3f}"
+        resp.headers["X-Profile-Phases-Ms"] = phases
+        if top:
+            resp.headers["X-Profile-Top-Ms"] = top
@@ -0,0 +1,104 @@
+# Moves bookings from the old one-list-per-resource indexes into the per-day booking documents
+# Usage: python scripts/migrate_booking_days.py [--dry-run]
+# Uses the same AzureCosmosDBConnectionString / DatabaseName / *ContainerName settings as the app.
+# The old indexes are the "bookings" list of each lecturer document and the
+# "calendar:<building>" documents of the buildings container. Each entry is added to its day
+# document unless a booking of that id is there already, so a rerun is harmless; then the
+# lecturer's list is emptied and the building calendar deleted. Bookings made while it runs
+# already go to the day documents.
+import argparse
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from azure.cosmos.exceptions import CosmosResourceNotFoundError
+
+import function_app
+
+
+# (kind, key, source document, entries) for every old index that still holds bookings
+def old_indexes():
+    for doc in function_app.get_lecturer_container().query_items(
+        query="SELECT c.id, c.name, c.bookings FROM c",
+        enable_cross_partition_query=True
+    ):
+        if doc.get("bookings") and isinstance(doc.get("name"), str):
+            yield "lecturer", doc["name"], doc, doc["bookings"]
+
+    for doc in function_app.get_building_container().query_items(
+        query="SELECT * FROM c WHERE c.type = 'buildingCalendar'",
+        enable_cross_partition_query=True
+    ):
+        yield "building", doc.get("building") or "", doc, doc.get("bookings") or []
+
+
+# Entries grouped by the day they start on; anything not [start, end, id] is dropped
+def by_day(entries: list) -> dict:
+    days = {}
+    for entry in entries:
+        if not (isinstance(entry, list) and len(entry) == 3 and all(isinstance(v, str) for v in entry)):
+            continue
+        days.setdefault(entry[0][:10], []).append(entry)
+    return days
+
+
+def move(kind: str, key: str, days: dict) -> bool:
+    for date, entries in days.items():
+        def change(current):
+            present = {e[2] for e in current}
+            for entry in entries:
+                if entry[2] not in present:
+                    function_app.bookings.add(current, entry)
+
+        _, err = function_app.update_booking_index(kind, key, date, change)
+        if err is not None:
+            print(f"{kind} {key} {date}: busy, rerun to finish it")
+            return False
+    return True
+
+
+def clear(kind: str, doc: dict):
+    if kind == "lecturer":
+        function_app.get_lecturer_container().patch_item(
+            item=doc["id"],
+            partition_key=doc["id"],
+            patch_operations=[{"op": "set", "path": "/bookings", "value": []}]
+        )
+        return
+    try:
+        function_app.get_building_container().delete_item(item=doc["id"], partition_key=doc["id"])
+    except CosmosResourceNotFoundError:
+        pass
+
+
+def migrate(dry_run: bool) -> dict:
+    stats = {"indexes": 0, "days": 0, "entries": 0, "failed": 0}
+
+    for kind, key, doc, entries in list(old_indexes()):
+        days = by_day(entries)
+        stats["indexes"] += 1
+        stats["days"] += len(days)
+        stats["entries"] += sum(len(e) for e in days.values())
+
+        if dry_run:
+            continue
+        if not key or not move(kind, key, days):
+            stats["failed"] += 1
+            continue
+        clear(kind, doc)
+
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Move bookings into the per-day booking documents")
+    parser.add_argument("--dry-run", action="store_true", help="report what would move without writing")
+    args = parser.parse_args()
+
+    stats = migrate(args.dry_run)
+    print(f"bookings: indexes={stats['indexes']} days={stats['days']} entries={stats['entries']} failed={stats['failed']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+# Re-keys student and lecturer documents onto their name-derived ids
+# Usage: python scripts/migrate_name_keys.py [--container student|lecturer|all] [--dry-run] [--skip-views]
+# Uses the same AzureCosmosDBConnectionString / DatabaseName / *ContainerName settings as the app.
+# --dry-run reports what would move and the conflicts (two documents of one name, or another
+# document already under the new id) without writing. Once a run reports no conflicts, set
+# LegacyNameLookup=false on the function app (or remove it).
+# Re-keying deletes the old documents, which the student change feed doesn't carry, so the
+# module counts view would count a re-keyed student twice: after moving students the views are
+# rebuilt (as scripts/rebuild_views.py --rebuild does) unless --skip-views is given, in which
+# case run that before relying on the counts. Stop the change feed triggers while it runs.
+import argparse
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from azure.cosmos.exceptions import CosmosResourceExistsError, CosmosResourceNotFoundError
+
+import function_app
+
+TARGETS = {
+    "student": (function_app.get_student_container, function_app.student_doc_id),
+    "lecturer": (function_app.get_lecturer_container, function_app.lecturer_doc_id),
+}
+
+
+# Copy of a document without the Cosmos system properties
+def user_fields(doc: dict) -> dict:
+    return {k: v for k, v in doc.items() if not k.startswith("_")}
+
+
+# True when nothing is stored under new_id, or the same document is
+def same_as_existing(container, new_id: str, body: dict) -> bool:
+    try:
+        existing = container.read_item(item=new_id, partition_key=new_id)
+    except CosmosResourceNotFoundError:
+        return True
+    return user_fields(existing) == body
+
+
+def migrate_container(kind: str, dry_run: bool) -> dict:
+    get_container, doc_id = TARGETS[kind]
+    container = get_container()
+    stats = {"scanned": 0, "already": 0, "migrated": 0, "skipped": 0, "conflicts": []}
+    targets = {}    # new id -> old id of the document moving there in this run
+
+    # Snapshot the ids first so re-keyed documents are not visited twice
+    old_ids = [d["id"] for d in container.query_items(
+        query="SELECT c.id FROM c",
+        enable_cross_partition_query=True
+    )]
+
+    for old_id in old_ids:
+        stats["scanned"] += 1
+        try:
+            doc = container.read_item(item=old_id, partition_key=old_id)
+        except CosmosResourceNotFoundError:
+            continue
+
+        name = doc.get("name")
+        if not isinstance(name, str) or not name.strip():
+            stats["skipped"] += 1
+            continue
+
+        new_id = doc_id(name)
+        if old_id == new_id:
+            stats["already"] += 1
+            continue
+
+        body = user_fields(doc)
+        body["id"] = new_id
+
+        # Two un-migrated documents of one name, or a different document already under the new
+        # id; the same document there means a previous run stopped before deleting the old copy
+        if new_id in targets or not same_as_existing(container, new_id, body):
+            stats["conflicts"].append({"name": name, "id": old_id, "keptId": new_id})
+            continue
+        targets[new_id] = old_id
+
+        if dry_run:
+            stats["migrated"] += 1
+            continue
+
+        try:
+            container.create_item(body=body)
+        except CosmosResourceExistsError:
+            # Created since the check above
+            if not same_as_existing(container, new_id, body):
+                stats["conflicts"].append({"name": name, "id": old_id, "keptId": new_id})
+                continue
+
+        container.delete_item(item=old_id, partition_key=old_id)
+        stats["migrated"] += 1
+
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Re-key student/lecturer documents by name")
+    parser.add_argument("--container", choices=["student", "lecturer", "all"], default="all")
+    parser.add_argument("--dry-run", action="store_true", help="report what would change without writing")
+    parser.add_argument("--skip-views", action="store_true", help="don't rebuild the views after moving students")
+    args = parser.parse_args()
+
+    kinds = list(TARGETS) if args.container == "all" else [args.container]
+    failed = False
+    moved_students = False
+
+    for kind in kinds:
+        stats = migrate_container(kind, args.dry_run)
+        print(
+            f"{kind}: scanned={stats['scanned']} already={stats['already']} "
+            f"migrated={stats['migrated']} skipped={stats['skipped']} conflicts={len(stats['conflicts'])}"
+        )
+        for c in stats["conflicts"]:
+            failed = True
+            print(f"  conflict: name={c['name']!r} old id={c['id']} (kept {c['keptId']})")
+        moved_students = moved_students or (kind == "student" and stats["migrated"] > 0)
+
+    if moved_students and not args.dry_run:
+        if args.skip_views:
+            print("students were re-keyed: run scripts/rebuild_views.py --rebuild before relying on module counts")
+        else:
+            for kind, count in function_app.sync_views(rebuild=True).items():
+                print(f"views rebuilt from {kind}: changes applied={count}")
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+# Rebuilds the module enrolment index (the modules container) from the student documents
+# Usage: python scripts/rebuild_module_index.py [--dry-run]
+# Uses the same AzureCosmosDBConnectionString / DatabaseName / *ContainerName / ModuleIndexShards
+# settings as the app. Run it once after deploying the index, after changing ModuleIndexShards,
+# or when the app logs that the index is behind. Enrolments made while it runs may need a rerun.
+import argparse
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from azure.cosmos.exceptions import CosmosResourceNotFoundError
+
+import function_app
+
+
+def build_index() -> dict:
+    index = {
+        function_app.module_index_id(m, s): (m, s, set())
+        for m in function_app.ALLOWED_MODULES
+        for s in range(function_app.MODULE_INDEX_SHARDS)
+    }
+
+    for doc in function_app.get_student_container().query_items(
+        query="SELECT c.name, c.modules FROM c",
+        enable_cross_partition_query=True
+    ):
+        name = doc.get("name")
+        if not isinstance(name, str) or not name.strip():
+            continue
+        shard = function_app.module_index_shard(name)
+        for module in doc.get("modules") or []:
+            entry = index.get(function_app.module_index_id(module, shard))
+            if entry is not None:
+                entry[2].add(name)
+
+    return index
+
+
+def rebuild(dry_run: bool) -> dict:
+    container = function_app.get_module_container()
+    index = build_index()
+    stats = {"documents": len(index), "entries": sum(len(names) for _, _, names in index.values()), "removed": 0}
+
+    # Shard documents left over from a larger ModuleIndexShards
+    stale = [
+        d["id"] for d in container.query_items(
+            query="SELECT c.id FROM c WHERE c.type = 'moduleStudents'",
+            enable_cross_partition_query=True
+        )
+        if d["id"] not in index
+    ]
+    stats["removed"] = len(stale)
+
+    if dry_run:
+        return stats
+
+    for doc_id, (module, shard, names) in index.items():
+        container.upsert_item(body={
+            "id": doc_id,
+            "type": "moduleStudents",
+            "module": module,
+            "shard": shard,
+            "students": sorted(names)
+        })
+
+    for doc_id in stale:
+        try:
+            container.delete_item(item=doc_id, partition_key=doc_id)
+        except CosmosResourceNotFoundError:
+            pass
+
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Rebuild the module enrolment index from the students")
+    parser.add_argument("--dry-run", action="store_true", help="report what would be written without writing")
+    args = parser.parse_args()
+
+    stats = rebuild(args.dry_run)
+    print(f"modules: documents={stats['documents']} entries={stats['entries']} stale removed={stats['removed']}")
+
+
+if __name__ == "__main__":
+    main()
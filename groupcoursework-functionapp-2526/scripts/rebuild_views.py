@@ -0,0 +1,28 @@
+# Catches up or rebuilds the materialized views (the views container) from the change feeds
+# Usage: python scripts/rebuild_views.py [--rebuild]
+# Uses the same AzureCosmosDBConnectionString / DatabaseName / *ContainerName settings as the
+# app. Without --rebuild it applies the changes since the last checkpoint, which is how local
+# backends keep their views current. --rebuild clears the views and replays every feed from
+# the beginning: run it once after deploying the change feed triggers, or when a view has
+# drifted. Stop the triggers (or expect a few changes to be applied twice) while it runs.
+import argparse
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import function_app
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Catch up or rebuild the materialized views")
+    parser.add_argument("--rebuild", action="store_true", help="clear the views and replay the feeds from the beginning")
+    args = parser.parse_args()
+
+    applied = function_app.sync_views(args.rebuild)
+    for kind, count in applied.items():
+        print(f"{kind}: changes applied={count}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+# Compact HMAC-signed session tokens: base64url(json claims) + "." + base64url(HMAC-SHA256)
+# Keys come from SessionTokenKeys as "kid1:secret1,kid2:secret2". The first key signs new tokens,
+# every listed key is accepted when verifying, so a key can be rotated by putting the new one
+# first and dropping the old one once its tokens have expired.
+import base64
+import hashlib
+import hmac
+import json
+import os
+import time
+
+_keys_source = None
+_keys = []
+
+
+def _b64encode(raw: bytes) -> str:
+    return base64.urlsafe_b64encode(raw).rstrip(b"=").decode("ascii")
+
+
+def _b64decode(text: str) -> bytes:
+    return base64.urlsafe_b64decode(text + "=" * (-len(text) % 4))
+
+
+# [(kid, secret)], parsed again only when the setting changes
+def signing_keys() -> list:
+    global _keys_source, _keys
+
+    source = os.environ.get("SessionTokenKeys", "")
+    if source != _keys_source:
+        keys = []
+        for part in source.split(","):
+            kid, sep, secret = part.strip().partition(":")
+            if sep and kid and secret:
+                keys.append((kid, secret.encode("utf-8")))
+        _keys_source, _keys = source, keys
+    return _keys
+
+
+def tokens_enabled() -> bool:
+    return bool(signing_keys())
+
+
+def _sign(secret: bytes, payload: str) -> str:
+    return _b64encode(hmac.new(secret, payload.encode("ascii"), hashlib.sha256).digest())
+
+
+# Issue a token for a logged-in student/lecturer, or None when no key is configured
+def issue_token(user_id: str, name: str, role: str, modules: list, ttl_seconds: int = None) -> str:
+    keys = signing_keys()
+    if not keys:
+        return None
+
+    if ttl_seconds is None:
+        ttl_seconds = int(os.environ.get("SessionTokenTtlSeconds", "3600"))
+
+    kid, secret = keys[0]
+    now = int(time.time())
+    claims = {
+        "kid": kid,
+        "id": user_id,
+        "name": name,
+        "role": role,
+        "modules": list(modules or []),
+        "iat": now,
+        "exp": now + ttl_seconds,
+    }
+    payload = _b64encode(json.dumps(claims, separators=(",", ":")).encode("utf-8"))
+    return f"{payload}.{_sign(secret, payload)}"
+
+
+# Return the claims of a valid, unexpired token, otherwise None
+def verify_token(token: str):
+    if not token or token.count(".") != 1:
+        return None
+
+    payload, signature = token.split(".")
+    try:
+        claims = json.loads(_b64decode(payload))
+    except ValueError:
+        return None
+
+    if not isinstance(claims, dict):
+        return None
+
+    # Forged payloads can hold any json, check types before using them
+    kid = claims.get("kid")
+    if not isinstance(kid, str):
+        return None
+    secret = dict(signing_keys()).get(kid)
+    if secret is None:
+        return None
+
+    # As bytes: compare_digest refuses non-ASCII strings
+    if not hmac.compare_digest(_sign(secret, payload).encode(), signature.encode("utf-8", "replace")):
+        return None
+
+    exp = claims.get("exp")
+    if not isinstance(exp, int) or exp <= time.time():
+        return None
+
+    if not all(isinstance(claims.get(k), str) for k in ("id", "name", "role")):
+        return None
+    modules = claims.get("modules")
+    if not isinstance(modules, list) or not all(isinstance(m, str) for m in modules):
+        return None
+
+    return claims
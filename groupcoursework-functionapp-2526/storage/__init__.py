@@ -0,0 +1,41 @@
+# Storage backends for the function app's documents.
+# DatabaseName picks the backend and the *ContainerName settings name the containers in it:
+#   university-database            Cosmos database (AzureCosmosDBConnectionString)
+#   memory: / memory:<name>        in-process dicts, shared by name within the process
+#   sqlite:///abs/path/uni.db      SQLite file, one table per container
+#   sqlite:relative/uni.db         relative to the working directory
+#   sqlite::memory:                private in-memory SQLite database
+# Every backend hands out containers with the azure.cosmos ContainerProxy calls the app uses.
+from storage.cosmos import CosmosBackend
+from storage.memory import MemoryBackend
+from storage.sqlite import SqliteBackend
+
+MEMORY_SCHEME = "memory:"
+SQLITE_SCHEME = "sqlite:"
+
+
+def backend_kind(database_setting: str) -> str:
+    if database_setting.startswith(MEMORY_SCHEME):
+        return "memory"
+    if database_setting.startswith(SQLITE_SCHEME):
+        return "sqlite"
+    return "cosmos"
+
+
+def sqlite_path(database_setting: str) -> str:
+    path = database_setting[len(SQLITE_SCHEME):]
+    if path.startswith("//"):
+        path = path[2:]
+    if not path:
+        raise ValueError("sqlite DatabaseName needs a path, e.g. sqlite:///home/data/university.db")
+    return path
+
+
+# Backend object with get_container(name) and close()
+def open_backend(database_setting: str):
+    kind = backend_kind(database_setting)
+    if kind == "memory":
+        return MemoryBackend(database_setting[len(MEMORY_SCHEME):])
+    if kind == "sqlite":
+        return SqliteBackend(sqlite_path(database_setting))
+    return CosmosBackend(database_setting)
@@ -0,0 +1,360 @@
+# Container API shared by the local backends.
+# Implements the azure.cosmos ContainerProxy calls the function app makes (point reads,
+# read-many, queries, create/upsert/replace, patch with etag and filter predicate, delete,
+# change feed) on top of a handful of storage primitives, so the memory and SQLite backends
+# only differ in how documents are kept. Documents get _etag/_ts/_lsn like Cosmos and errors
+# are the real azure.cosmos exceptions, so handler code is the same for every backend.
+# LocalThroughput (RU/s) makes every container throttle like provisioned Cosmos throughput.
+import asyncio
+import datetime
+import json
+import os
+import threading
+import time
+import uuid
+from collections import Counter
+from contextlib import contextmanager
+
+from azure.core import MatchConditions
+from azure.cosmos.exceptions import (
+    CosmosAccessConditionFailedError,
+    CosmosHttpResponseError,
+    CosmosResourceExistsError,
+    CosmosResourceNotFoundError
+)
+
+from storage.query import apply_patch, parse_query, run_query
+
+# Top-level document fields the local backends index besides id, for the name lookups
+INDEXED_FIELDS = ("name",)
+
+
+# Holds the headers of the last response, like the Cosmos client connection does
+class ClientConnection:
+    def __init__(self):
+        self.last_response_headers = {}
+
+
+class DocumentContainer:
+    # True when calls do I/O and should be moved off the event loop by the async app
+    blocking = False
+
+    def __init__(self, name: str, partition_key_path: str = "/id"):
+        self.id = name
+        self.partition_key_path = partition_key_path
+        self.client_connection = ClientConnection()
+        self.calls = Counter()
+        self.request_charge = 0.0
+        self._stats_lock = threading.Lock()
+        # Provisioned throughput to simulate, in RU/s (LocalThroughput, 0 for unlimited)
+        self.throughput = float(os.environ.get("LocalThroughput", "0"))
+        self._ru_balance = self.throughput
+        self._ru_refilled = time.monotonic()
+
+    # Storage primitives. Keys are (partition key, id); documents handed out by _get and
+    # _scan must not be modified by the caller.
+
+    @contextmanager
+    def _reading(self):
+        yield
+
+    @contextmanager
+    def _writing(self):
+        yield
+
+    def _get(self, key):
+        raise NotImplementedError
+
+    def _put(self, key, doc: dict):
+        raise NotImplementedError
+
+    def _delete(self, key):
+        raise NotImplementedError
+
+    def _scan(self, partition_key=None):
+        raise NotImplementedError
+
+    # Next log sequence number of the container; called inside _writing
+    def _next_lsn(self) -> int:
+        raise NotImplementedError
+
+    # Documents a query has to look at; backends with indexes narrow this down
+    def _candidates(self, q: dict, params: dict, partition_key=None):
+        return self._scan(partition_key)
+
+    # Copy of a stored document that the caller may keep
+    def _export(self, doc: dict) -> dict:
+        return json.loads(json.dumps(doc))
+
+    def _count(self) -> int:
+        return sum(1 for _ in self._scan())
+
+    # Call accounting, with an estimated request charge so local runs can be compared with Cosmos
+
+    def _charge(self, operation: str, ru: float) -> dict:
+        with self._stats_lock:
+            self.calls[operation] += 1
+            self.request_charge += ru
+            self._ru_balance -= ru
+        headers = {
+            "x-ms-request-charge": f"{ru:.2f}",
+            "x-ms-activity-id": str(uuid.uuid4()),
+        }
+        self.client_connection.last_response_headers = headers
+        return headers
+
+    # Charge a successful call and pass its headers to the caller's response_hook, like Cosmos
+    def _respond(self, operation: str, ru: float, kwargs: dict, result, extra_headers=None):
+        headers = self._charge(operation, ru)
+        headers.update(extra_headers or {})
+        hook = kwargs.get("response_hook")
+        if hook is not None:
+            hook(headers, result)
+        return result
+
+    # Charge a failed call; the error carries the response headers
+    def _failure(self, operation: str, error: Exception) -> Exception:
+        error.headers = self._charge(operation, 1.0)
+        return error
+
+    # With a throughput set, refuse calls like Cosmos does once the RU of the last second are
+    # used up: 429 with the wait until the balance is positive again in x-ms-retry-after-ms
+    def _throttle(self, operation: str):
+        if not self.throughput:
+            return
+        with self._stats_lock:
+            now = time.monotonic()
+            self._ru_balance = min(
+                self.throughput, self._ru_balance + (now - self._ru_refilled) * self.throughput
+            )
+            self._ru_refilled = now
+            if self._ru_balance > 0:
+                return
+            wait_ms = int(-self._ru_balance / self.throughput * 1000) + 1
+        error = CosmosHttpResponseError(status_code=429, message="request rate is large")
+        error.headers = self._charge(operation, 0.0)
+        error.headers["x-ms-retry-after-ms"] = str(wait_ms)
+        raise error
+
+    def reset_counters(self):
+        with self._stats_lock:
+            self.calls.clear()
+            self.request_charge = 0.0
+
+    @staticmethod
+    def _ru_for(doc) -> float:
+        return max(1.0, len(json.dumps(doc)) / 1024)
+
+    # Helpers
+
+    def _pk(self, doc: dict):
+        value = doc
+        for part in self.partition_key_path.strip("/").split("/"):
+            value = value.get(part) if isinstance(value, dict) else None
+        return value
+
+    def _stamp(self, body: dict) -> dict:
+        doc = json.loads(json.dumps(body))
+        doc["_etag"] = f'"{uuid.uuid4()}"'
+        doc["_ts"] = int(time.time())
+        doc["_lsn"] = self._next_lsn()
+        doc.setdefault("_rid", uuid.uuid4().hex[:16])
+        return doc
+
+    def _check_condition(self, operation: str, existing, etag, match_condition):
+        if match_condition == MatchConditions.IfNotModified:
+            failed = existing is None or existing.get("_etag") != etag
+        elif match_condition == MatchConditions.IfModified:
+            failed = existing is not None and existing.get("_etag") == etag
+        else:
+            failed = False
+        if failed:
+            raise self._failure(operation, CosmosAccessConditionFailedError(status_code=412, message="precondition failed"))
+
+    def _require(self, operation: str, item_id: str, existing):
+        if existing is None:
+            raise self._failure(operation, CosmosResourceNotFoundError(status_code=404, message=f"{item_id} not found"))
+
+    # Container API
+
+    def read_item(self, item, partition_key, **kwargs):
+        self._throttle("read_item")
+        item_id = item["id"] if isinstance(item, dict) else item
+        with self._reading():
+            doc = self._get((partition_key, item_id))
+            if doc is not None:
+                doc = self._export(doc)
+        self._require("read_item", item_id, doc)
+        return self._respond("read_item", 1.0, kwargs, doc)
+
+    def read_items(self, items, **kwargs):
+        self._throttle("read_items")
+        with self._reading():
+            found = [self._get((pk, i)) for i, pk in items]
+            found = [self._export(d) for d in found if d is not None]
+        return self._respond("read_items", max(1.0, float(len(items))), kwargs, found)
+
+    def read_all_items(self, max_item_count=None, **kwargs):
+        self._throttle("read_all_items")
+        with self._reading():
+            docs = [self._export(d) for d in self._scan()]
+        return iter(self._respond("read_all_items", 2.5 + 0.1 * len(docs), kwargs, docs))
+
+    def query_items(self, query, parameters=None, partition_key=None, enable_cross_partition_query=None, **kwargs):
+        self._throttle("query_items")
+        q = parse_query(query)
+        params = {p["name"]: p["value"] for p in (parameters or [])}
+        with self._reading():
+            docs = list(self._candidates(q, params, partition_key))
+            rows = run_query(q, docs, params)
+        return iter(self._respond("query_items", 2.5 + 0.1 * len(docs) + 0.5 * len(rows), kwargs, rows))
+
+    # Change feed in latest-version mode: the current version of every document written after
+    # the continuation, in write order. Deletes don't show up, as in Cosmos. The continuation
+    # is the last LSN read, handed back in the "etag" response header; without one the feed
+    # starts now, or from start_time ("Beginning" or a datetime)
+    def query_items_change_feed(self, start_time=None, continuation=None, max_item_count=None,
+                                partition_key=None, **kwargs):
+        self._throttle("query_items_change_feed")
+        since = None
+        if isinstance(start_time, datetime.datetime):
+            since = start_time.timestamp()
+        with self._reading():
+            docs = list(self._scan(partition_key))
+            if continuation is not None:
+                after = int(continuation)
+            elif start_time is not None:
+                after = 0
+            else:
+                after = max((d.get("_lsn", 0) for d in docs), default=0)
+            changed = sorted(
+                (d for d in docs if d.get("_lsn", 0) > after and (since is None or d["_ts"] >= since)),
+                key=lambda d: d["_lsn"]
+            )
+            changed = [self._export(d) for d in changed]
+
+        last = changed[-1]["_lsn"] if changed else after
+        return iter(self._respond(
+            "query_items_change_feed", 2.0 + 0.5 * len(changed), kwargs, changed, {"etag": str(last)}
+        ))
+
+    def create_item(self, body, **kwargs):
+        self._throttle("create_item")
+        key = (self._pk(body), body["id"])
+        with self._writing():
+            if self._get(key) is not None:
+                raise self._failure("create_item", CosmosResourceExistsError(
+                    status_code=409, message=f"{body['id']} already exists"
+                ))
+            doc = self._stamp(body)
+            self._put(key, doc)
+        return self._respond("create_item", 5.0 * self._ru_for(doc), kwargs, self._export(doc))
+
+    def upsert_item(self, body, etag=None, match_condition=None, **kwargs):
+        self._throttle("upsert_item")
+        key = (self._pk(body), body["id"])
+        with self._writing():
+            self._check_condition("upsert_item", self._get(key), etag, match_condition)
+            doc = self._stamp(body)
+            self._put(key, doc)
+        return self._respond("upsert_item", 5.0 * self._ru_for(doc), kwargs, self._export(doc))
+
+    def replace_item(self, item, body, etag=None, match_condition=None, **kwargs):
+        self._throttle("replace_item")
+        item_id = item["id"] if isinstance(item, dict) else item
+        key = (self._pk(body), item_id)
+        with self._writing():
+            existing = self._get(key)
+            self._require("replace_item", item_id, existing)
+            self._check_condition("replace_item", existing, etag, match_condition)
+            doc = self._stamp(body)
+            self._put(key, doc)
+        return self._respond("replace_item", 5.0 * self._ru_for(doc), kwargs, self._export(doc))
+
+    def patch_item(self, item, partition_key, patch_operations, filter_predicate=None,
+                   etag=None, match_condition=None, **kwargs):
+        self._throttle("patch_item")
+        item_id = item["id"] if isinstance(item, dict) else item
+        key = (partition_key, item_id)
+        with self._writing():
+            existing = self._get(key)
+            self._require("patch_item", item_id, existing)
+            self._check_condition("patch_item", existing, etag, match_condition)
+            if filter_predicate and not run_query(parse_query(f"SELECT * {filter_predicate}"), [existing], {}):
+                raise self._failure("patch_item", CosmosAccessConditionFailedError(
+                    status_code=412, message="filter predicate failed"
+                ))
+            doc = self._export(existing)
+            apply_patch(doc, patch_operations)
+            doc = self._stamp(doc)
+            self._put(key, doc)
+        return self._respond("patch_item", 5.0 + 0.5 * len(patch_operations), kwargs, self._export(doc))
+
+    def delete_item(self, item, partition_key, etag=None, match_condition=None, **kwargs):
+        self._throttle("delete_item")
+        item_id = item["id"] if isinstance(item, dict) else item
+        key = (partition_key, item_id)
+        with self._writing():
+            existing = self._get(key)
+            self._require("delete_item", item_id, existing)
+            self._check_condition("delete_item", existing, etag, match_condition)
+            self._delete(key)
+        self._respond("delete_item", 5.0, kwargs, None)
+
+    # Seeding, without call accounting
+    def load(self, docs):
+        with self._writing():
+            for body in docs:
+                self._put((self._pk(body), body["id"]), self._stamp(body))
+
+    def __len__(self):
+        with self._reading():
+            return self._count()
+
+
+# Async view of a local container with the azure.cosmos.aio call shapes: awaitable calls
+# and query_items returning an async iterator
+class AsyncDocumentContainer:
+    def __init__(self, container: DocumentContainer):
+        self._container = container
+        self.id = container.id
+        self.client_connection = container.client_connection
+
+    async def _call(self, fn, *args, **kwargs):
+        if self._container.blocking:
+            return await asyncio.to_thread(fn, *args, **kwargs)
+        return fn(*args, **kwargs)
+
+    async def read_item(self, *args, **kwargs):
+        return await self._call(self._container.read_item, *args, **kwargs)
+
+    async def read_items(self, *args, **kwargs):
+        return await self._call(self._container.read_items, *args, **kwargs)
+
+    async def create_item(self, *args, **kwargs):
+        return await self._call(self._container.create_item, *args, **kwargs)
+
+    async def upsert_item(self, *args, **kwargs):
+        return await self._call(self._container.upsert_item, *args, **kwargs)
+
+    async def replace_item(self, *args, **kwargs):
+        return await self._call(self._container.replace_item, *args, **kwargs)
+
+    async def patch_item(self, *args, **kwargs):
+        return await self._call(self._container.patch_item, *args, **kwargs)
+
+    async def delete_item(self, *args, **kwargs):
+        return await self._call(self._container.delete_item, *args, **kwargs)
+
+    async def _iterate(self, fn, *args, **kwargs):
+        for row in await self._call(lambda: list(fn(*args, **kwargs))):
+            yield row
+
+    def query_items(self, *args, **kwargs):
+        return self._iterate(self._container.query_items, *args, **kwargs)
+
+    def read_all_items(self, *args, **kwargs):
+        return self._iterate(self._container.read_all_items, *args, **kwargs)
+
+    def query_items_change_feed(self, *args, **kwargs):
+        return self._iterate(self._container.query_items_change_feed, *args, **kwargs)
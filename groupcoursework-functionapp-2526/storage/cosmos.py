@@ -0,0 +1,57 @@
+# Azure Cosmos DB backend: the database named by DatabaseName in the account from
+# AzureCosmosDBConnectionString, over one pooled HTTP session shared by every container.
+import logging
+import os
+
+import requests
+from azure.core.pipeline.transport import RequestsTransport
+from azure.cosmos import CosmosClient
+from azure.cosmos.documents import ConnectionPolicy, RetryOptions
+
+
+# Shared HTTP session with configurable connection-pool limits
+def build_cosmos_transport():
+    pool_connections = int(os.environ.get("CosmosPoolConnections", "10"))
+    pool_maxsize = int(os.environ.get("CosmosPoolMaxSize", "10"))
+
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=pool_connections,
+        pool_maxsize=pool_maxsize
+    )
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session, RequestsTransport(session=session, session_owner=False)
+
+
+# The SDK's own retries of throttled calls (CosmosThrottleRetries, none by default): the app
+# retries them itself within each request's budget (see throttling.py)
+def build_connection_policy() -> ConnectionPolicy:
+    policy = ConnectionPolicy()
+    policy.RetryOptions = RetryOptions(
+        max_retry_attempt_count=int(os.environ.get("CosmosThrottleRetries", "0"))
+    )
+    return policy
+
+
+class CosmosBackend:
+    def __init__(self, database_name: str):
+        cosmos_conn = os.environ.get("AzureCosmosDBConnectionString")
+        if not cosmos_conn:
+            raise ValueError("Missing AzureCosmosDBConnectionString in environment")
+
+        self.session, transport = build_cosmos_transport()
+        self.client = CosmosClient.from_connection_string(
+            cosmos_conn, transport=transport, connection_policy=build_connection_policy()
+        )
+        self.db = self.client.get_database_client(database_name)
+
+    def get_container(self, container_name: str):
+        return self.db.get_container_client(container_name)
+
+    def close(self):
+        try:
+            self.client.__exit__()
+        except Exception as e:
+            logging.warning(f"Cosmos client close failed: {e}")
+        self.session.close()
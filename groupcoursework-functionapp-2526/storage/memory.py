@@ -0,0 +1,118 @@
+# In-process backend: documents live in dicts, one per container, for tests, local runs
+# and benchmarks. Databases are kept by name for the life of the process, so every
+# client that opens "memory:<name>" sees the same documents.
+import copy
+import threading
+from contextlib import contextmanager
+
+from storage.base import INDEXED_FIELDS, DocumentContainer
+from storage.query import equality_hints
+
+_databases_lock = threading.Lock()
+_databases = {}
+
+
+class MemoryContainer(DocumentContainer):
+    def __init__(self, name: str, partition_key_path: str = "/id"):
+        super().__init__(name, partition_key_path)
+        self._docs = {}
+        self._index = {field: {} for field in ("id",) + INDEXED_FIELDS}  # field -> value -> {key}
+        self._lock = threading.RLock()
+        self._lsn = 0
+
+    @contextmanager
+    def _reading(self):
+        with self._lock:
+            yield
+
+    @contextmanager
+    def _writing(self):
+        with self._lock:
+            yield
+
+    def _unindex(self, key, doc: dict):
+        for field, entries in self._index.items():
+            value = doc.get(field)
+            if isinstance(value, str):
+                keys = entries.get(value)
+                keys.discard(key)
+                if not keys:
+                    del entries[value]
+
+    def _get(self, key):
+        return self._docs.get(key)
+
+    def _put(self, key, doc: dict):
+        old = self._docs.get(key)
+        if old is not None:
+            self._unindex(key, old)
+        self._docs[key] = doc
+        for field, entries in self._index.items():
+            value = doc.get(field)
+            if isinstance(value, str):
+                entries.setdefault(value, set()).add(key)
+
+    def _delete(self, key):
+        self._unindex(key, self._docs.pop(key))
+
+    def _scan(self, partition_key=None):
+        if partition_key is None:
+            return list(self._docs.values())
+        return [d for (pk, _), d in self._docs.items() if pk == partition_key]
+
+    def _next_lsn(self) -> int:
+        self._lsn += 1
+        return self._lsn
+
+    # id/name equality, IN and ARRAY_CONTAINS terms are answered from the indexes
+    def _candidates(self, q: dict, params: dict, partition_key=None):
+        hints = equality_hints(q, params, tuple(self._index))
+        if not hints:
+            return self._scan(partition_key)
+
+        keys = None
+        for field, values in hints.items():
+            entries = self._index[field]
+            matched = set()
+            for value in values:
+                matched |= entries.get(value, set())
+            keys = matched if keys is None else keys & matched
+        if partition_key is not None:
+            keys = {k for k in keys if k[0] == partition_key}
+        return [self._docs[k] for k in keys]
+
+    def _export(self, doc: dict) -> dict:
+        return copy.deepcopy(doc)
+
+    def _count(self) -> int:
+        return len(self._docs)
+
+    def clear(self):
+        with self._lock:
+            self._docs.clear()
+            for entries in self._index.values():
+                entries.clear()
+
+
+class MemoryBackend:
+    def __init__(self, name: str = ""):
+        self.name = name
+        with _databases_lock:
+            self._containers = _databases.setdefault(name, {})
+
+    def get_container(self, container_name: str, partition_key_path: str = "/id"):
+        with _databases_lock:
+            container = self._containers.get(container_name)
+            if container is None:
+                container = MemoryContainer(container_name, partition_key_path)
+                self._containers[container_name] = container
+        return container
+
+    def close(self):
+        pass
+
+
+# Forget every in-memory database, e.g. between benchmark runs
+def drop_databases():
+    with _databases_lock:
+        _databases.clear()
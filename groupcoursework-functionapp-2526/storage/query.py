@@ -0,0 +1,482 @@
+# Cosmos SQL subset and patch operations for the local storage backends.
+# Covers the queries function_app.py issues (SELECT [TOP] [VALUE] ... FROM alias WHERE ...
+# ORDER BY ... OFFSET/LIMIT, comparisons, IN, AND/OR/NOT, ARRAY_CONTAINS and friends, COUNT)
+# with Cosmos semantics for undefined properties. Errors are the real azure.cosmos exceptions.
+import copy
+import json
+import re
+
+from azure.cosmos.exceptions import CosmosHttpResponseError
+
+UNDEFINED = object()
+
+
+# Query parsing
+
+_TOKEN_RE = re.compile(r"""
+    \s+
+  | (?P<num>-?\d+(?:\.\d+)?)
+  | (?P<str>'(?:[^'\\]|\\.)*'|"(?:[^"\\]|\\.)*")
+  | (?P<param>@\w+)
+  | (?P<name>[A-Za-z_]\w*)
+  | (?P<op><=|>=|!=|<>|=|<|>|\(|\)|,|\.|\[|\]|\*)
+""", re.VERBOSE)
+
+KEYWORDS = {
+    "SELECT", "VALUE", "TOP", "FROM", "WHERE", "AND", "OR", "NOT", "ORDER", "BY",
+    "ASC", "DESC", "OFFSET", "LIMIT", "AS", "IN", "TRUE", "FALSE", "NULL"
+}
+
+
+def _unquote(text: str) -> str:
+    if text[0] == '"':
+        return json.loads(text)
+    inner = text[1:-1].replace("\\'", "'").replace('"', '\\"')
+    return json.loads('"' + inner + '"')
+
+
+def tokenize(query: str) -> list:
+    tokens = []
+    pos = 0
+    while pos < len(query):
+        m = _TOKEN_RE.match(query, pos)
+        if not m:
+            raise CosmosHttpResponseError(status_code=400, message=f"syntax error near {query[pos:pos + 20]!r}")
+        pos = m.end()
+        kind = m.lastgroup
+        if kind is None:
+            continue
+        text = m.group(kind)
+        if kind == "name" and text.upper() in KEYWORDS:
+            tokens.append(("kw", text.upper()))
+        elif kind == "num":
+            tokens.append(("lit", float(text) if "." in text else int(text)))
+        elif kind == "str":
+            tokens.append(("lit", _unquote(text)))
+        else:
+            tokens.append((kind, text))
+    tokens.append(("end", None))
+    return tokens
+
+
+class Parser:
+    def __init__(self, query: str):
+        self.tokens = tokenize(query)
+        self.pos = 0
+
+    def peek(self, kind=None, value=None):
+        tok = self.tokens[self.pos]
+        if kind is not None and tok[0] != kind:
+            return False
+        if value is not None and tok[1] != value:
+            return False
+        return True
+
+    def take(self, kind=None, value=None):
+        if not self.peek(kind, value):
+            raise CosmosHttpResponseError(status_code=400, message=f"expected {value or kind}, got {self.tokens[self.pos][1]!r}")
+        tok = self.tokens[self.pos]
+        self.pos += 1
+        return tok
+
+    def accept(self, kind, value=None):
+        if self.peek(kind, value):
+            return self.take(kind, value)
+        return None
+
+    # SELECT [TOP n] [VALUE] projection FROM alias [WHERE expr] [ORDER BY ...] [OFFSET n LIMIT m]
+    def parse_select(self) -> dict:
+        q = {"top": None, "value": False, "fields": None, "where": None, "order": [], "offset": None, "limit": None}
+        self.take("kw", "SELECT")
+        if self.accept("kw", "TOP"):
+            q["top"] = self.parse_primary()
+        if self.accept("kw", "VALUE"):
+            q["value"] = True
+        if self.accept("op", "*"):
+            q["fields"] = "*"
+        else:
+            fields = []
+            while True:
+                expr = self.parse_expr()
+                alias = self.take("name")[1] if self.accept("kw", "AS") else None
+                if alias is None and expr[0] == "path":
+                    alias = expr[2][-1] if expr[2] else expr[1]
+                fields.append((alias or f"${len(fields) + 1}", expr))
+                if not self.accept("op", ","):
+                    break
+            q["fields"] = fields
+        self.take("kw", "FROM")
+        q["alias"] = self.take("name")[1]
+        if self.accept("kw", "WHERE"):
+            q["where"] = self.parse_expr()
+        if self.accept("kw", "ORDER"):
+            self.take("kw", "BY")
+            while True:
+                expr = self.parse_expr()
+                desc = bool(self.accept("kw", "DESC"))
+                if not desc:
+                    self.accept("kw", "ASC")
+                q["order"].append((expr, desc))
+                if not self.accept("op", ","):
+                    break
+        if self.accept("kw", "OFFSET"):
+            q["offset"] = self.parse_primary()
+            self.take("kw", "LIMIT")
+            q["limit"] = self.parse_primary()
+        self.take("end")
+        return q
+
+    def parse_expr(self):
+        left = self.parse_and()
+        while self.accept("kw", "OR"):
+            left = ("or", left, self.parse_and())
+        return left
+
+    def parse_and(self):
+        left = self.parse_not()
+        while self.accept("kw", "AND"):
+            left = ("and", left, self.parse_not())
+        return left
+
+    def parse_not(self):
+        if self.accept("kw", "NOT"):
+            return ("not", self.parse_not())
+        return self.parse_compare()
+
+    def parse_compare(self):
+        left = self.parse_primary()
+        if self.peek("op") and self.tokens[self.pos][1] in ("=", "!=", "<>", "<", ">", "<=", ">="):
+            op = self.take("op")[1]
+            return ("cmp", "!=" if op == "<>" else op, left, self.parse_primary())
+        if self.accept("kw", "IN"):
+            self.take("op", "(")
+            items = [self.parse_primary()]
+            while self.accept("op", ","):
+                items.append(self.parse_primary())
+            self.take("op", ")")
+            return ("in", left, items)
+        return left
+
+    def parse_primary(self):
+        tok = self.tokens[self.pos]
+        if self.accept("op", "("):
+            expr = self.parse_expr()
+            self.take("op", ")")
+            return expr
+        if tok[0] == "lit":
+            self.pos += 1
+            return ("lit", tok[1])
+        if tok[0] == "kw" and tok[1] in ("TRUE", "FALSE", "NULL"):
+            self.pos += 1
+            return ("lit", {"TRUE": True, "FALSE": False, "NULL": None}[tok[1]])
+        if tok[0] == "param":
+            self.pos += 1
+            return ("param", tok[1])
+        if tok[0] == "name":
+            self.pos += 1
+            if self.accept("op", "("):
+                args = []
+                if not self.peek("op", ")"):
+                    args.append(self.parse_expr())
+                    while self.accept("op", ","):
+                        args.append(self.parse_expr())
+                self.take("op", ")")
+                return ("call", tok[1].upper(), args)
+            steps = []
+            while True:
+                if self.accept("op", "."):
+                    steps.append(self.take("name")[1])
+                elif self.accept("op", "["):
+                    steps.append(self.take("lit")[1])
+                    self.take("op", "]")
+                else:
+                    break
+            return ("path", tok[1], steps)
+        raise CosmosHttpResponseError(status_code=400, message=f"unexpected {tok[1]!r}")
+
+
+_parse_cache = {}
+
+
+def parse_query(query: str) -> dict:
+    parsed = _parse_cache.get(query)
+    if parsed is None:
+        parsed = Parser(query).parse_select()
+        _parse_cache[query] = parsed
+    return parsed
+
+
+# Query evaluation
+
+def _type_rank(v):
+    if v is None:
+        return 0
+    if isinstance(v, bool):
+        return 1
+    if isinstance(v, (int, float)):
+        return 2
+    if isinstance(v, str):
+        return 3
+    return 4
+
+
+def sort_key(v):
+    if v is UNDEFINED:
+        return (-1, 0)
+    rank = _type_rank(v)
+    return (rank, v if rank in (1, 2, 3) else 0)
+
+
+def evaluate(expr, doc, alias: str, params: dict):
+    kind = expr[0]
+    if kind == "lit":
+        return expr[1]
+    if kind == "param":
+        if expr[1] not in params:
+            raise CosmosHttpResponseError(status_code=400, message=f"missing parameter {expr[1]}")
+        return params[expr[1]]
+    if kind == "path":
+        if expr[1] != alias:
+            raise CosmosHttpResponseError(status_code=400, message=f"unknown identifier {expr[1]}")
+        value = doc
+        for step in expr[2]:
+            if isinstance(value, dict) and isinstance(step, str) and step in value:
+                value = value[step]
+            elif isinstance(value, list) and isinstance(step, int) and 0 <= step < len(value):
+                value = value[step]
+            else:
+                return UNDEFINED
+        return value
+    if kind == "and":
+        left = evaluate(expr[1], doc, alias, params)
+        if left is False:
+            return False
+        right = evaluate(expr[2], doc, alias, params)
+        if left is True and right is True:
+            return True
+        return False if right is False else UNDEFINED
+    if kind == "or":
+        left = evaluate(expr[1], doc, alias, params)
+        if left is True:
+            return True
+        right = evaluate(expr[2], doc, alias, params)
+        if right is True:
+            return True
+        return False if left is False and right is False else UNDEFINED
+    if kind == "not":
+        value = evaluate(expr[1], doc, alias, params)
+        return (not value) if isinstance(value, bool) else UNDEFINED
+    if kind == "cmp":
+        left = evaluate(expr[2], doc, alias, params)
+        right = evaluate(expr[3], doc, alias, params)
+        if left is UNDEFINED or right is UNDEFINED:
+            return UNDEFINED
+        op = expr[1]
+        if op == "=":
+            return _type_rank(left) == _type_rank(right) and left == right
+        if op == "!=":
+            return not (_type_rank(left) == _type_rank(right) and left == right)
+        if _type_rank(left) != _type_rank(right) or _type_rank(left) == 4:
+            return UNDEFINED
+        return {"<": left < right, ">": left > right, "<=": left <= right, ">=": left >= right}[op]
+    if kind == "in":
+        value = evaluate(expr[1], doc, alias, params)
+        if value is UNDEFINED:
+            return UNDEFINED
+        return any(value == evaluate(i, doc, alias, params) for i in expr[2])
+    if kind == "call":
+        return call_function(expr[1], [evaluate(a, doc, alias, params) for a in expr[2]])
+    raise CosmosHttpResponseError(status_code=400, message=f"cannot evaluate {kind}")
+
+
+def call_function(name: str, args: list):
+    if name == "IS_DEFINED":
+        return args[0] is not UNDEFINED
+    if name == "IS_NULL":
+        return args[0] is None
+    if any(a is UNDEFINED for a in args):
+        return UNDEFINED
+    if name == "ARRAY_CONTAINS":
+        if not isinstance(args[0], list):
+            return UNDEFINED
+        partial = len(args) > 2 and args[2] is True
+        if partial and isinstance(args[1], dict):
+            return any(isinstance(v, dict) and all(v.get(k) == x for k, x in args[1].items()) for v in args[0])
+        return args[1] in args[0]
+    if name == "ARRAY_LENGTH":
+        return len(args[0]) if isinstance(args[0], list) else UNDEFINED
+    if name == "STARTSWITH":
+        return args[0].startswith(args[1]) if isinstance(args[0], str) and isinstance(args[1], str) else UNDEFINED
+    if name == "CONTAINS":
+        return args[1] in args[0] if isinstance(args[0], str) and isinstance(args[1], str) else UNDEFINED
+    if name == "LOWER":
+        return args[0].lower() if isinstance(args[0], str) else UNDEFINED
+    if name == "UPPER":
+        return args[0].upper() if isinstance(args[0], str) else UNDEFINED
+    raise CosmosHttpResponseError(status_code=400, message=f"unsupported function {name}")
+
+
+def is_aggregate(q: dict) -> bool:
+    return (
+        q["value"] and q["fields"] != "*" and len(q["fields"]) == 1
+        and q["fields"][0][1][0] == "call" and q["fields"][0][1][1] == "COUNT"
+    )
+
+
+# Run a parsed query over docs (already narrowed to any partition key), return result rows
+def run_query(q: dict, docs, params: dict) -> list:
+    alias = q["alias"]
+    matched = [d for d in docs if q["where"] is None or evaluate(q["where"], d, alias, params) is True]
+
+    if is_aggregate(q):
+        return [len(matched)]
+
+    for expr, desc in reversed(q["order"]):
+        matched.sort(key=lambda d: sort_key(evaluate(expr, d, alias, params)), reverse=desc)
+
+    if q["offset"] is not None:
+        offset = evaluate(q["offset"], None, alias, params)
+        limit = evaluate(q["limit"], None, alias, params)
+        matched = matched[offset:offset + limit]
+    if q["top"] is not None:
+        matched = matched[:evaluate(q["top"], None, alias, params)]
+
+    rows = []
+    for d in matched:
+        if q["fields"] == "*":
+            rows.append(copy.deepcopy(d))
+        elif q["value"]:
+            value = evaluate(q["fields"][0][1], d, alias, params)
+            if value is not UNDEFINED:
+                rows.append(copy.deepcopy(value))
+        else:
+            row = {}
+            for name, expr in q["fields"]:
+                value = evaluate(expr, d, alias, params)
+                if value is not UNDEFINED:
+                    row[name] = copy.deepcopy(value)
+            rows.append(row)
+    return rows
+
+
+# Patch operations (JSON pointer paths)
+
+def _pointer(path: str) -> list:
+    if not path.startswith("/"):
+        raise CosmosHttpResponseError(status_code=400, message=f"invalid patch path {path!r}")
+    return [p.replace("~1", "/").replace("~0", "~") for p in path[1:].split("/")]
+
+
+def apply_patch(doc: dict, operations: list):
+    if not operations or len(operations) > 10:
+        raise CosmosHttpResponseError(status_code=400, message="patch needs between 1 and 10 operations")
+
+    for operation in operations:
+        op = operation.get("op")
+        parts = _pointer(operation.get("path", ""))
+        parent = doc
+        for part in parts[:-1]:
+            if isinstance(parent, list) and part.isdigit() and int(part) < len(parent):
+                parent = parent[int(part)]
+            elif isinstance(parent, dict) and part in parent:
+                parent = parent[part]
+            else:
+                raise CosmosHttpResponseError(status_code=400, message=f"patch path {operation['path']} not found")
+        last = parts[-1]
+        value = copy.deepcopy(operation.get("value"))
+
+        if isinstance(parent, list):
+            if op == "add":
+                if last == "-":
+                    parent.append(value)
+                elif last.isdigit() and int(last) <= len(parent):
+                    parent.insert(int(last), value)
+                else:
+                    raise CosmosHttpResponseError(status_code=400, message=f"bad index in {operation['path']}")
+                continue
+            if not (last.isdigit() and int(last) < len(parent)):
+                raise CosmosHttpResponseError(status_code=400, message=f"bad index in {operation['path']}")
+            index = int(last)
+            if op in ("set", "replace"):
+                parent[index] = value
+            elif op == "remove":
+                del parent[index]
+            elif op == "incr":
+                parent[index] += value
+            else:
+                raise CosmosHttpResponseError(status_code=400, message=f"unsupported patch op {op}")
+        elif isinstance(parent, dict):
+            if op in ("set", "add"):
+                parent[last] = value
+            elif op == "replace":
+                if last not in parent:
+                    raise CosmosHttpResponseError(status_code=400, message=f"{operation['path']} not found")
+                parent[last] = value
+            elif op == "remove":
+                if last not in parent:
+                    raise CosmosHttpResponseError(status_code=400, message=f"{operation['path']} not found")
+                del parent[last]
+            elif op == "incr":
+                parent[last] = parent.get(last, 0) + value
+            else:
+                raise CosmosHttpResponseError(status_code=400, message=f"unsupported patch op {op}")
+        else:
+            raise CosmosHttpResponseError(status_code=400, message=f"patch path {operation['path']} not found")
+
+
+# Index hints
+
+def _conjuncts(expr) -> list:
+    if expr is None:
+        return []
+    if expr[0] == "and":
+        return _conjuncts(expr[1]) + _conjuncts(expr[2])
+    return [expr]
+
+
+def _field_of(expr, alias: str):
+    if expr[0] == "path" and expr[1] == alias and len(expr[2]) == 1 and isinstance(expr[2][0], str):
+        return expr[2][0]
+    return None
+
+
+def _constant(expr, params: dict):
+    if expr[0] == "lit":
+        return expr[1]
+    if expr[0] == "param" and expr[1] in params:
+        return params[expr[1]]
+    return UNDEFINED
+
+
+# {field: [values]} that every matching document must take one of, from the top-level
+# field = x, field IN (...) and ARRAY_CONTAINS(list, field) terms of the WHERE clause.
+# Only string values are used, so a backend index can narrow candidates but never lose one.
+def equality_hints(q: dict, params: dict, fields) -> dict:
+    alias = q["alias"]
+    hints = {}
+
+    def narrow(field, values):
+        if field not in fields or not all(isinstance(v, str) for v in values):
+            return
+        values = list(dict.fromkeys(values))
+        if field in hints:
+            values = [v for v in hints[field] if v in values]
+        hints[field] = values
+
+    for term in _conjuncts(q["where"]):
+        if term[0] == "cmp" and term[1] == "=":
+            for a, b in ((term[2], term[3]), (term[3], term[2])):
+                field = _field_of(a, alias)
+                if field is not None:
+                    narrow(field, [_constant(b, params)])
+                    break
+        elif term[0] == "in":
+            field = _field_of(term[1], alias)
+            if field is not None:
+                narrow(field, [_constant(i, params) for i in term[2]])
+        elif term[0] == "call" and term[1] == "ARRAY_CONTAINS" and len(term[2]) == 2:
+            field = _field_of(term[2][1], alias)
+            values = _constant(term[2][0], params)
+            if field is not None and isinstance(values, list):
+                narrow(field, values)
+    return hints
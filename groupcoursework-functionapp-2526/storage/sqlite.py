@@ -0,0 +1,194 @@
+# SQLite backend: one table per container in a single database file.
+# Each row keeps the document JSON next to its partition key, id and the indexed top-level
+# fields, so point reads, read-many and name lookups are index seeks and only the remaining
+# queries scan. Every thread gets its own connection; writes run in BEGIN IMMEDIATE
+# transactions (WAL mode), so etag checks and patches are atomic across threads and processes.
+# Change feed LSNs come from a per-container counter row bumped in the writing transaction.
+import json
+import os
+import re
+import sqlite3
+import threading
+from contextlib import contextmanager, nullcontext
+
+from storage.base import INDEXED_FIELDS, DocumentContainer
+from storage.query import equality_hints
+
+_IDENTIFIER_RE = re.compile(r"^[A-Za-z_][A-Za-z0-9_-]*$")
+_LSN_TABLE = '"__change_feed"'
+
+
+class SqliteContainer(DocumentContainer):
+    blocking = True
+
+    def __init__(self, backend, name: str, partition_key_path: str = "/id"):
+        if not _IDENTIFIER_RE.match(name):
+            raise ValueError(f"invalid container name {name!r}")
+        super().__init__(name, partition_key_path)
+        self._backend = backend
+        self._table = f'"{name}"'
+
+        columns = "".join(f", {f} TEXT" for f in INDEXED_FIELDS)
+        with self._backend.transaction() as conn:
+            conn.execute(
+                f"CREATE TABLE IF NOT EXISTS {self._table} "
+                f"(pk TEXT NOT NULL, id TEXT NOT NULL{columns}, body TEXT NOT NULL, PRIMARY KEY (pk, id))"
+            )
+            conn.execute(f'CREATE INDEX IF NOT EXISTS "{name}__id" ON {self._table} (id)')
+            for field in INDEXED_FIELDS:
+                conn.execute(f'CREATE INDEX IF NOT EXISTS "{name}__{field}" ON {self._table} ({field})')
+            conn.execute(
+                f"CREATE TABLE IF NOT EXISTS {_LSN_TABLE} (container TEXT PRIMARY KEY, lsn INTEGER NOT NULL)"
+            )
+
+    @contextmanager
+    def _reading(self):
+        with self._backend.reading():
+            yield
+
+    @contextmanager
+    def _writing(self):
+        with self._backend.transaction():
+            yield
+
+    @staticmethod
+    def _pk_text(partition_key) -> str:
+        return json.dumps(partition_key)
+
+    def _rows(self, where: str = "", args=()):
+        sql = f"SELECT body FROM {self._table}" + (f" WHERE {where}" if where else "")
+        return [json.loads(row[0]) for row in self._backend.connection().execute(sql, args)]
+
+    def _get(self, key):
+        rows = self._rows("pk = ? AND id = ?", (self._pk_text(key[0]), key[1]))
+        return rows[0] if rows else None
+
+    def _put(self, key, doc: dict):
+        fields = [doc.get(f) if isinstance(doc.get(f), str) else None for f in INDEXED_FIELDS]
+        columns = "".join(f", {f}" for f in INDEXED_FIELDS)
+        marks = ", ?" * len(INDEXED_FIELDS)
+        self._backend.connection().execute(
+            f"INSERT OR REPLACE INTO {self._table} (pk, id{columns}, body) VALUES (?, ?{marks}, ?)",
+            [self._pk_text(key[0]), key[1], *fields, json.dumps(doc, separators=(",", ":"))]
+        )
+
+    def _delete(self, key):
+        self._backend.connection().execute(
+            f"DELETE FROM {self._table} WHERE pk = ? AND id = ?", (self._pk_text(key[0]), key[1])
+        )
+
+    def _scan(self, partition_key=None):
+        if partition_key is None:
+            return self._rows()
+        return self._rows("pk = ?", (self._pk_text(partition_key),))
+
+    def _next_lsn(self) -> int:
+        return self._backend.connection().execute(
+            f"INSERT INTO {_LSN_TABLE} (container, lsn) VALUES (?, 1) "
+            "ON CONFLICT (container) DO UPDATE SET lsn = lsn + 1 RETURNING lsn",
+            (self.id,)
+        ).fetchone()[0]
+
+    # Push id/name equality, IN and ARRAY_CONTAINS terms down to the indexes; the query
+    # evaluator still applies the whole WHERE clause to what comes back
+    def _candidates(self, q: dict, params: dict, partition_key=None):
+        hints = equality_hints(q, params, ("id",) + INDEXED_FIELDS)
+        clauses, args = [], []
+        if partition_key is not None:
+            clauses.append("pk = ?")
+            args.append(self._pk_text(partition_key))
+        for field, values in hints.items():
+            if not values:
+                return []
+            clauses.append(f"{field} IN ({', '.join('?' * len(values))})")
+            args.extend(values)
+        return self._rows(" AND ".join(clauses), args)
+
+    # Rows are parsed per call, so they already belong to the caller
+    def _export(self, doc: dict) -> dict:
+        return doc
+
+    def _count(self) -> int:
+        return self._backend.connection().execute(f"SELECT COUNT(*) FROM {self._table}").fetchone()[0]
+
+
+class SqliteBackend:
+    def __init__(self, path: str):
+        self.path = path
+        self.shared = path == ":memory:"
+        self._local = threading.local()
+        self._lock = threading.RLock()
+        self._shared_conn = None
+        self._connections = []
+        self._containers = {}
+
+        if not self.shared:
+            directory = os.path.dirname(os.path.abspath(path))
+            os.makedirs(directory, exist_ok=True)
+
+    def _open(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False, timeout=30)
+        conn.execute("PRAGMA busy_timeout = 30000")
+        if not self.shared:
+            conn.execute("PRAGMA journal_mode = WAL")
+            conn.execute("PRAGMA synchronous = NORMAL")
+        with self._lock:
+            self._connections.append(conn)
+        return conn
+
+    # This thread's connection; ":memory:" databases have one connection used under a lock
+    def connection(self) -> sqlite3.Connection:
+        if self.shared:
+            if self._shared_conn is None:
+                with self._lock:
+                    if self._shared_conn is None:
+                        self._shared_conn = self._open()
+            return self._shared_conn
+
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._open()
+            self._local.conn = conn
+        return conn
+
+    @contextmanager
+    def reading(self):
+        if self.shared:
+            with self._lock:
+                yield
+        else:
+            yield
+
+    # Nested calls on the same thread join the outer transaction
+    @contextmanager
+    def transaction(self):
+        lock = self._lock if self.shared else nullcontext()
+        with lock:
+            conn = self.connection()
+            if conn.in_transaction:
+                yield conn
+                return
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield conn
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+
+    def get_container(self, container_name: str, partition_key_path: str = "/id"):
+        with self._lock:
+            container = self._containers.get(container_name)
+            if container is None:
+                container = SqliteContainer(self, container_name, partition_key_path)
+                self._containers[container_name] = container
+        return container
+
+    # Closes every thread's connection; only call once no request is using the backend
+    def close(self):
+        with self._lock:
+            connections, self._connections = self._connections, []
+            self._shared_conn = None
+            self._local = threading.local()
+        for conn in connections:
+            conn.close()
@@ -0,0 +1,91 @@
+# The tests run the function apps against the in-memory storage backend (storage/memory.py),
+# which has the Cosmos etag and conditional write behaviour the races depend on.
+# Usage: python -m pytest tests
+import asyncio
+import json
+import os
+import sys
+
+import pytest
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, APP_DIR)
+os.environ["DatabaseName"] = "memory:tests"
+os.environ["AdmissionRate"] = "0"
+os.environ.pop("SessionTokenKeys", None)
+
+import azure.functions as func
+
+import function_app
+import function_app_async
+from storage.memory import drop_databases
+
+LECTURER = {"name": "Dr Alwash", "password": "Password1", "modules": ["COMP1", "COMP2", "COMP3"]}
+
+
+def reset_storage():
+    function_app.reset_storage_clients()
+    asyncio.run(function_app_async.reset_async_cosmos_clients())
+    drop_databases()
+    function_app.profile_cache.clear()
+
+
+@pytest.fixture(autouse=True)
+def fresh_storage():
+    reset_storage()
+    yield
+    reset_storage()
+
+
+def make_request(route: str, body=None, method: str = "POST", params=None, headers=None) -> func.HttpRequest:
+    return func.HttpRequest(
+        method,
+        f"http://localhost/api/{route}",
+        headers=headers or {},
+        params=params or {},
+        route_params={},
+        body=json.dumps(body).encode() if body is not None else b""
+    )
+
+
+# call(route, body, method=..., params=..., headers=...) -> (status, json body), through the
+# route's registered handler (guard and metrics included) of the app under test
+def caller(app):
+    def call(route: str, body=None, **kwargs):
+        resp = app.routes[route].handler(make_request(route, body, **kwargs))
+        if asyncio.iscoroutine(resp):
+            resp = asyncio.run(resp)
+        return resp.status_code, json.loads(resp.get_body())
+    return call
+
+
+@pytest.fixture
+def call():
+    return caller(function_app.app)
+
+
+# The same test against the sync app and the async one
+@pytest.fixture(params=["sync", "async"])
+def app_call(request):
+    return caller(function_app.app if request.param == "sync" else function_app_async.app)
+
+
+@pytest.fixture
+def lecturer(call):
+    status, body = call("lecturer/hire", LECTURER)
+    assert status == 201, body
+    return LECTURER["name"]
+
+
+def lecture_fields(lecturer: str, **overrides) -> dict:
+    fields = {
+        "title": "Cloud Computing",
+        "module": "COMP1",
+        "lecturer": lecturer,
+        "date": "2026-11-02",
+        "time": "10:00",
+        "duration": 60,
+        "building": "Hub",
+    }
+    fields.update(overrides)
+    return fields
@@ -0,0 +1,88 @@
+import os
+import sys
+
+import bookings
+import function_app
+from conftest import APP_DIR, lecture_fields
+
+sys.path.insert(0, os.path.join(APP_DIR, "scripts"))
+
+import migrate_booking_days
+
+
+def test_find_clash_sees_past_a_nested_entry():
+    # A lecture moving within its own time holds both bookings for a moment
+    entries = []
+    bookings.add(entries, ["2026-11-02T10:00", "2026-11-02T12:00", "old"])
+    bookings.add(entries, ["2026-11-02T10:30", "2026-11-02T11:00", "new"])
+
+    assert bookings.find_clash(entries, "2026-11-02T11:30", "2026-11-02T12:30")[2] == "old"
+    assert bookings.find_clash(entries, "2026-11-02T11:30", "2026-11-02T12:30", ignore={"old"}) is None
+    assert bookings.find_clash(entries, "2026-11-02T12:00", "2026-11-02T13:00") is None
+    assert bookings.find_clash(entries, "2026-11-02T09:00", "2026-11-02T10:00") is None
+
+
+def test_bookings_are_kept_per_day(call, lecturer):
+    status, body = call("lecture/make", lecture_fields(lecturer))
+    assert status == 201, body
+    booking = body["lecture"]["booking"]
+
+    day_id = function_app.booking_day_id("building", "Hub", "2026-11-02")
+    day = function_app.get_building_container().read_item(item=day_id, partition_key=day_id)
+    assert day["bookings"] == [[booking["start"], booking["end"], booking["id"]]]
+    assert function_app.booked_on("lecturer", lecturer, "2026-11-03") == []
+
+
+def test_booking_free_reads_the_day(call, lecturer):
+    call("lecture/make", lecture_fields(lecturer))
+
+    status, body = call("booking/free", method="GET", params={"date": "2026-11-02", "lecturer": lecturer})
+    assert status == 200
+    assert body["free"] == [{"start": "08:00", "end": "10:00"}, {"start": "11:00", "end": "18:00"}]
+
+    status, _ = call("booking/free", method="GET", params={"date": "2026-11-02", "lecturer": "Nobody"})
+    assert status == 404
+
+
+def test_timetable_import_checks_each_day(call, lecturer):
+    call("lecture/make", lecture_fields(lecturer))
+    timetable = [
+        {"lecturer": lecturer, "building": "Hub", "date": "2026-11-02", "time": "10:30"},
+        {"lecturer": lecturer, "building": "Hub", "date": "2026-11-03", "time": "10:30"},
+    ]
+
+    status, body = call("booking/timetable/import", {"bookings": timetable})
+    assert status == 409
+    assert {e["index"] for e in body["errors"]} == {0}
+
+    status, body = call("booking/timetable/import", {"bookings": timetable[1:]})
+    assert status == 201, body
+    assert len(function_app.booked_on("building", "Hub", "2026-11-03")) == 1
+
+
+def test_migration_moves_old_lists_into_days(call, lecturer):
+    doc = function_app.get_lecturer_by_name(lecturer)
+    function_app.get_lecturer_container().patch_item(
+        item=doc["id"],
+        partition_key=doc["id"],
+        patch_operations=[{"op": "set", "path": "/bookings", "value": [
+            ["2026-11-02T10:00", "2026-11-02T11:00", "a"],
+            ["2026-11-03T09:00", "2026-11-03T10:00", "b"],
+        ]}]
+    )
+    function_app.get_building_container().create_item(body={
+        "id": "calendar:Hub", "type": "buildingCalendar", "building": "Hub",
+        "bookings": [["2026-11-02T10:00", "2026-11-02T11:00", "a"]]
+    })
+
+    assert migrate_booking_days.migrate(dry_run=False)["entries"] == 3
+    assert migrate_booking_days.migrate(dry_run=False)["indexes"] == 0
+
+    assert function_app.booked_on("lecturer", lecturer, "2026-11-02") == [["2026-11-02T10:00", "2026-11-02T11:00", "a"]]
+    assert function_app.booked_on("lecturer", lecturer, "2026-11-03") == [["2026-11-03T09:00", "2026-11-03T10:00", "b"]]
+    assert function_app.booked_on("building", "Hub", "2026-11-02") == [["2026-11-02T10:00", "2026-11-02T11:00", "a"]]
+    assert function_app.get_lecturer_by_name(lecturer)["bookings"] == []
+
+    # The old calendar is gone, the day documents take new bookings around the moved ones
+    status, _ = call("lecture/make", lecture_fields(lecturer))
+    assert status == 409
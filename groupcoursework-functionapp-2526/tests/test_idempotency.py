@@ -0,0 +1,79 @@
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import azure.functions as func
+
+import function_app
+import idempotency
+
+
+def store():
+    return idempotency.ContainerResultStore(function_app.get_idempotency_container)
+
+
+def keyed_request(key: str = "k1", body: bytes = b"{}") -> func.HttpRequest:
+    return func.HttpRequest("POST", "http://localhost/api/x", headers={idempotency.HEADER: key}, body=body)
+
+
+def test_an_expired_claim_is_taken_over_once():
+    results_store = store()
+    assert results_store.claim("k1", "fp", lease=60) is None
+
+    # Let the claim run out without the holder finishing
+    container = function_app.get_idempotency_container()
+    doc_id = results_store._doc_id("k1")
+    doc = container.read_item(item=doc_id, partition_key=doc_id)
+    doc["expires"] = time.time() - 1
+    container.upsert_item(body=doc)
+
+    start = threading.Barrier(8)
+
+    def claim(_):
+        start.wait()
+        return store().claim("k1", "fp", lease=60)
+
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        results = list(pool.map(claim, range(8)))
+
+    assert sum(r is None for r in results) == 1
+    assert all(r["status"] is None for r in results if r is not None)
+
+
+def test_a_claim_outlasts_the_wait_while_the_handler_runs():
+    # Two workers sharing the store; duplicates wait less than the handler takes
+    first = idempotency.IdempotencyKeys(wait_seconds=0.2, store=store(), poll_seconds=0.02, lease_seconds=30)
+    second = idempotency.IdempotencyKeys(wait_seconds=0.2, store=store(), poll_seconds=0.02, lease_seconds=30)
+    runs = []
+    started = threading.Event()
+
+    def slow(req):
+        runs.append(req)
+        started.set()
+        time.sleep(0.6)
+        return func.HttpResponse(json.dumps({"result": True}), status_code=201, mimetype="application/json")
+
+    answers = []
+    worker = threading.Thread(target=lambda: answers.append(idempotency.idempotent(first, slow)(keyed_request())))
+    worker.start()
+    started.wait()
+    time.sleep(0.3)
+
+    # Past the wait but inside the lease: refused, not run again
+    assert idempotency.idempotent(second, slow)(keyed_request()).status_code == 409
+    worker.join()
+    assert answers[0].status_code == 201
+
+    replayed = idempotency.idempotent(second, slow)(keyed_request())
+    assert replayed.status_code == 201
+    assert replayed.headers.get(idempotency.REPLAYED_HEADER) == "true"
+    assert len(runs) == 1
+
+
+def test_a_key_reused_for_another_body_is_refused():
+    keys = idempotency.IdempotencyKeys()
+    handler = idempotency.idempotent(keys, lambda req: func.HttpResponse("{}", status_code=200))
+
+    assert handler(keyed_request(body=b'{"a":1}')).status_code == 200
+    assert handler(keyed_request(body=b'{"a":2}')).status_code == 422
@@ -0,0 +1,187 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import function_app
+import function_app_async
+from conftest import lecture_fields
+
+
+# Container whose first patch of a lecture lets another write land first
+class RacingContainer:
+    def __init__(self, container, lecture_id: str, ops: list, times: int = 1):
+        self._container = container
+        self._lecture_id = lecture_id
+        self._ops = ops
+        self.left = times
+
+    def __getattr__(self, name):
+        return getattr(self._container, name)
+
+    def patch_item(self, item, *args, **kwargs):
+        if item == self._lecture_id and self.left:
+            self.left -= 1
+            self._container.patch_item(item=item, partition_key=item, patch_operations=self._ops)
+        return self._container.patch_item(item, *args, **kwargs)
+
+
+class AsyncRacingContainer(RacingContainer):
+    async def patch_item(self, item, *args, **kwargs):
+        if item == self._lecture_id and self.left:
+            self.left -= 1
+            await self._container.patch_item(item=item, partition_key=item, patch_operations=self._ops)
+        return await self._container.patch_item(item, *args, **kwargs)
+
+
+def make_lecture(call, lecturer: str, **overrides) -> dict:
+    status, body = call("lecture/make", lecture_fields(lecturer, **overrides))
+    assert status == 201, body
+    return body["lecture"]
+
+
+def read_lecture(lecture_id: str) -> dict:
+    return function_app.get_lecture_container().read_item(item=lecture_id, partition_key=lecture_id)
+
+
+def booked_ids(kind: str, key: str, date: str = "2026-11-02") -> list:
+    return [entry[2] for entry in function_app.booked_on(kind, key, date)]
+
+
+def test_patch_lecture_rebuilds_ops_after_a_concurrent_write(call, lecturer):
+    lecture = make_lecture(call, lecturer)
+    container = RacingContainer(
+        function_app.get_lecture_container(), lecture["id"],
+        [{"op": "add", "path": "/students/-", "value": "Bob"}]
+    )
+    seen = []
+
+    def add_amy(current):
+        seen.append(list(current["students"]))
+        return function_app.add_student_ops(current, "Amy")
+
+    assert function_app.patch_lecture(container, lecture["id"], add_amy) is None
+    assert seen == [[], ["Bob"]]
+    assert read_lecture(lecture["id"])["students"] == ["Bob", "Amy"]
+
+
+def test_patch_lecture_gives_up_when_every_attempt_loses(call, lecturer):
+    lecture = make_lecture(call, lecturer)
+    container = RacingContainer(
+        function_app.get_lecture_container(), lecture["id"],
+        [{"op": "set", "path": "/title", "value": "Renamed"}],
+        times=function_app.ROSTER_PATCH_RETRIES
+    )
+
+    err = function_app.patch_lecture(
+        container, lecture["id"], lambda current: function_app.add_student_ops(current, "Amy")
+    )
+    assert err.status_code == 409
+    assert read_lecture(lecture["id"])["students"] == []
+
+
+def test_concurrent_makes_claim_different_slots(call, lecturer):
+    days = [f"2026-11-{d:02d}" for d in range(2, 14)]
+    with ThreadPoolExecutor(max_workers=6) as pool:
+        results = list(pool.map(lambda day: call("lecture/make", lecture_fields(lecturer, date=day)), days))
+
+    assert [status for status, _ in results] == [201] * len(days)
+    assert len({body["id"] for _, body in results}) == len(days)
+
+
+def test_concurrent_makes_of_one_time_book_it_once(call, lecturer):
+    with ThreadPoolExecutor(max_workers=6) as pool:
+        results = list(pool.map(lambda _: call("lecture/make", lecture_fields(lecturer)), range(6)))
+
+    statuses = sorted(status for status, _ in results)
+    assert statuses == [201] + [409] * 5
+    assert len(booked_ids("lecturer", lecturer)) == 1
+
+
+def test_claim_stores_every_field_of_the_lecture(call, lecturer):
+    lecture = make_lecture(call, lecturer, duration=90)
+    stored = read_lecture(lecture["id"])
+
+    assert stored["duration"] == 90
+    assert stored["booking"]["end"] == "2026-11-02T11:30"
+    assert stored["building"] == "Hub"
+
+
+def test_lecture_reset_fits_in_one_patch():
+    assert len(function_app.lecture_reset_ops()) <= function_app.MAX_PATCH_OPERATIONS
+    with pytest.raises(ValueError):
+        function_app.set_field_ops({f"f{i}": i for i in range(function_app.MAX_PATCH_OPERATIONS + 1)})
+
+
+def test_lecture_end_clears_and_releases_the_booking(app_call, call, lecturer):
+    lecture = make_lecture(call, lecturer)
+
+    status, _ = app_call("lecture/end", {"id": lecture["id"]})
+    assert status == 200
+
+    stored = read_lecture(lecture["id"])
+    assert stored["booking"] is None
+    assert stored["title"] == "" and stored["lecturer"] == ""
+    assert booked_ids("lecturer", lecturer) == []
+    assert booked_ids("building", "Hub") == []
+
+    # The time and the slot are free again
+    again = make_lecture(call, lecturer)
+    assert again["id"] == lecture["id"]
+
+
+def test_set_lecturer_moves_within_its_own_time(app_call, call, lecturer):
+    lecture = make_lecture(call, lecturer)
+
+    status, body = app_call("lecture/setLecturer", {
+        "id": lecture["id"], "lecturer": lecturer, "date": "2026-11-02", "time": "10:30", "duration": 60
+    })
+    assert status == 200, body
+
+    assert booked_ids("lecturer", lecturer) == [body["booking"]["id"]]
+    assert booked_ids("building", "Hub") == [body["booking"]["id"]]
+    assert read_lecture(lecture["id"])["booking"] == body["booking"]
+
+
+def test_set_lecturer_rebooks_when_the_building_changes_during_the_patch(request, app_call, call, lecturer, monkeypatch):
+    lecture = make_lecture(call, lecturer)
+    moved = [{"op": "set", "path": "/building", "value": "Annex"}]
+
+    if "async" in request.node.callspec.id:
+        get_container = function_app_async.get_lecture_container_async
+
+        async def racing():
+            return AsyncRacingContainer(await get_container(), lecture["id"], moved)
+
+        monkeypatch.setattr(function_app_async, "get_lecture_container_async", racing)
+    else:
+        container = RacingContainer(function_app.get_lecture_container(), lecture["id"], moved)
+        monkeypatch.setattr(function_app, "get_lecture_container", lambda: container)
+
+    status, body = app_call("lecture/setLecturer", {
+        "id": lecture["id"], "lecturer": lecturer, "date": "2026-11-02", "time": "14:00"
+    })
+    monkeypatch.undo()
+    assert status == 200, body
+
+    stored = read_lecture(lecture["id"])
+    assert stored["building"] == "Annex"
+    assert stored["booking"]["building"] == "Annex"
+    assert booked_ids("building", "Annex") == [stored["booking"]["id"]]
+    # Neither the original booking nor the one made for the first read is left behind
+    assert booked_ids("building", "Hub") == []
+    assert booked_ids("lecturer", lecturer) == [stored["booking"]["id"]]
+
+
+def test_set_lecturer_refuses_a_lecture_past_midnight(call, lecturer):
+    lecture = make_lecture(call, lecturer)
+
+    status, body = call("lecture/setLecturer", {
+        "id": lecture["id"], "lecturer": lecturer, "date": "2026-11-02", "time": "23:30"
+    })
+    assert status == 400
+    assert body["msg"] == "lecture must end on the same day"
+
+    status, _ = call("lecture/setLecturer", {
+        "id": lecture["id"], "lecturer": lecturer, "date": "2026-11-02", "time": "23:15", "duration": 30
+    })
+    assert status == 200
@@ -0,0 +1,63 @@
+import base64
+import json
+import time
+
+import pytest
+
+import session_tokens
+
+
+@pytest.fixture(autouse=True)
+def token_keys(monkeypatch):
+    monkeypatch.setenv("SessionTokenKeys", "k2:new-secret,k1:old-secret")
+
+
+def forged(claims: dict, secret: bytes = b"new-secret") -> str:
+    payload = base64.urlsafe_b64encode(json.dumps(claims).encode()).rstrip(b"=").decode()
+    return f"{payload}.{session_tokens._sign(secret, payload)}"
+
+
+def valid_claims(**overrides) -> dict:
+    claims = {"kid": "k2", "id": "l1", "name": "Dr Alwash", "role": "lecturer",
+              "modules": ["COMP1"], "iat": int(time.time()), "exp": int(time.time()) + 60}
+    claims.update(overrides)
+    return claims
+
+
+def test_issued_tokens_verify():
+    claims = session_tokens.verify_token(session_tokens.issue_token("l1", "Dr Alwash", "lecturer", ["COMP1"]))
+    assert claims["kid"] == "k2"
+    assert claims["modules"] == ["COMP1"]
+
+
+def test_tokens_of_a_rotated_out_key_still_verify_until_dropped(monkeypatch):
+    token = forged(valid_claims(kid="k1"), b"old-secret")
+    assert session_tokens.verify_token(token) is not None
+
+    monkeypatch.setenv("SessionTokenKeys", "k2:new-secret")
+    assert session_tokens.verify_token(token) is None
+
+
+@pytest.mark.parametrize("overrides", [
+    {"kid": ["k2"]},
+    {"kid": {"k2": 1}},
+    {"exp": "never"},
+    {"exp": int(time.time()) - 1},
+    {"name": 7},
+    {"role": None},
+    {"modules": "COMP1"},
+    {"modules": [1, 2]},
+])
+def test_mistyped_or_expired_claims_are_refused(overrides):
+    assert session_tokens.verify_token(forged(valid_claims(**overrides))) is None
+
+
+@pytest.mark.parametrize("token", ["", "a.b.c", "not base64!.sig", "e30.sig", "e30.sïg"])
+def test_malformed_tokens_are_refused(token):
+    assert session_tokens.verify_token(token) is None
+
+
+def test_a_changed_payload_is_refused():
+    payload, signature = session_tokens.issue_token("l1", "Dr Alwash", "lecturer", []).split(".")
+    other = forged(valid_claims(role="admin")).split(".")[0]
+    assert session_tokens.verify_token(f"{other}.{signature}") is None
@@ -0,0 +1,308 @@
+# Throttling: retries for throttled backend calls and admission control for HTTP requests.
+# Cosmos answers 429 once a container's provisioned RU/s are used up, with the wait it wants
+# in the x-ms-retry-after-ms header. The retrying container proxies repeat such calls after
+# that wait (or an exponential backoff when there is none), with jitter so throttled callers
+# don't all come back at once. Every request gets a retry budget (number of retries and total
+# seconds of waiting) shared by all its calls, so a saturated container costs a request at
+# most that much before the 429 is passed on. Only 429s are retried: not-found, conflicts and
+# transport errors reach the handler unchanged.
+# The admission controller is a process-wide token bucket in front of the routes. Throttles
+# that used up a request's budget lower its rate and each second without one raises it back,
+# so while the database is overloaded requests are turned away early with 429 and Retry-After
+# instead of adding more load to it.
+import asyncio
+import contextvars
+import functools
+import json
+import math
+import random
+import threading
+import time
+
+import azure.functions as func
+from azure.cosmos.exceptions import CosmosHttpResponseError
+
+from metrics import ITERATOR_OPERATIONS, POINT_OPERATIONS
+
+RETRY_AFTER_HEADER = "x-ms-retry-after-ms"
+
+
+def is_throttle(e: Exception) -> bool:
+    return isinstance(e, CosmosHttpResponseError) and e.status_code == 429
+
+
+# Wait the server asked for, in seconds, or None
+def retry_after(e: Exception):
+    try:
+        return int((getattr(e, "headers", None) or {}).get(RETRY_AFTER_HEADER)) / 1000
+    except (TypeError, ValueError):
+        return None
+
+
+# Retries left to one request; shared by the threads and tasks the request fans out to
+class RetryBudget:
+    def __init__(self, retries: int, wait: float):
+        self.retries = retries
+        self.wait = wait
+        self._lock = threading.Lock()
+
+    # Takes one retry of the given wait, False when the budget can't cover it
+    def take(self, seconds: float) -> bool:
+        with self._lock:
+            if self.retries <= 0 or seconds > self.wait:
+                return False
+            self.retries -= 1
+            self.wait -= seconds
+            return True
+
+
+# Budget of the request running in this context; None outside a request
+_current_budget = contextvars.ContextVar("retry_budget", default=None)
+
+
+class RetryPolicy:
+    def __init__(self, retries: int = 3, max_wait: float = 2.0, base: float = 0.05, cap: float = 1.0):
+        self.retries = retries
+        self.max_wait = max_wait
+        self.base = base
+        self.cap = cap
+        self.admission = None
+        self._lock = threading.Lock()
+        self.throttled = 0
+        self.retried = 0
+        self.exhausted = 0
+
+    def budget(self) -> RetryBudget:
+        return RetryBudget(self.retries, self.max_wait)
+
+    # Seconds to wait before retry number attempt (0-based): at least the server's hint,
+    # plus a random share of the exponential backoff
+    def delay(self, attempt: int, e: Exception) -> float:
+        backoff = min(self.cap, self.base * 2 ** attempt)
+        hint = retry_after(e)
+        if hint is None:
+            return random.uniform(backoff / 2, backoff)
+        return hint + random.uniform(0, backoff)
+
+    # Wait before retrying e, or None when it must be raised
+    def next_wait(self, attempt: int, e: Exception, budget: RetryBudget):
+        if not is_throttle(e):
+            return None
+        seconds = self.delay(attempt, e)
+        with self._lock:
+            self.throttled += 1
+            if budget.take(seconds):
+                self.retried += 1
+                return seconds
+            self.exhausted += 1
+        if self.admission is not None:
+            self.admission.throttled()
+        return None
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"throttled": self.throttled, "retried": self.retried, "exhausted": self.exhausted}
+
+    def _current(self) -> RetryBudget:
+        return _current_budget.get() or self.budget()
+
+    def call(self, method, *args, **kwargs):
+        budget = self._current()
+        attempt = 0
+        while True:
+            try:
+                return method(*args, **dict(kwargs))
+            except Exception as e:
+                seconds = self.next_wait(attempt, e, budget)
+                if seconds is None:
+                    raise
+            time.sleep(seconds)
+            attempt += 1
+
+    # Lazy results are retried only while nothing has been handed to the caller yet
+    def iterate(self, method, *args, **kwargs):
+        budget = self._current()
+        attempt = 0
+        while True:
+            started = False
+            try:
+                for item in method(*args, **dict(kwargs)):
+                    started = True
+                    yield item
+                return
+            except Exception as e:
+                seconds = None if started else self.next_wait(attempt, e, budget)
+                if seconds is None:
+                    raise
+            time.sleep(seconds)
+            attempt += 1
+
+    async def call_async(self, method, *args, **kwargs):
+        budget = self._current()
+        attempt = 0
+        while True:
+            try:
+                return await method(*args, **dict(kwargs))
+            except Exception as e:
+                seconds = self.next_wait(attempt, e, budget)
+                if seconds is None:
+                    raise
+            await asyncio.sleep(seconds)
+            attempt += 1
+
+    async def iterate_async(self, method, *args, **kwargs):
+        budget = self._current()
+        attempt = 0
+        while True:
+            started = False
+            try:
+                async for item in method(*args, **dict(kwargs)):
+                    started = True
+                    yield item
+                return
+            except Exception as e:
+                seconds = None if started else self.next_wait(attempt, e, budget)
+                if seconds is None:
+                    raise
+            await asyncio.sleep(seconds)
+            attempt += 1
+
+
+# Sync container client proxy retrying throttled calls; anything else passes straight through
+class RetryingContainer:
+    def __init__(self, container, policy: RetryPolicy):
+        self.container = container
+        self.id = container.id
+        self._policy = policy
+
+    def __getattr__(self, name):
+        attr = getattr(self.container, name)
+        if name in POINT_OPERATIONS:
+            return functools.partial(self._policy.call, attr)
+        if name in ITERATOR_OPERATIONS:
+            return functools.partial(self._policy.iterate, attr)
+        return attr
+
+
+# Async (azure.cosmos.aio) container client proxy
+class AsyncRetryingContainer(RetryingContainer):
+    def __getattr__(self, name):
+        attr = getattr(self.container, name)
+        if name in POINT_OPERATIONS:
+            return functools.partial(self._policy.call_async, attr)
+        if name in ITERATOR_OPERATIONS:
+            return functools.partial(self._policy.iterate_async, attr)
+        return attr
+
+
+# Token bucket of rate requests a second and burst capacity. The rate is cut by decrease
+# (at most once a second) when the backend throttles past the retry budget, and grows back
+# by recover of the configured rate for every second without a throttle. rate 0 admits all.
+class AdmissionController:
+    def __init__(self, rate: float, burst: float, floor: float = 0.1,
+                 decrease: float = 0.7, recover: float = 0.05, exempt=()):
+        self.max_rate = rate
+        self.rate = rate
+        self.burst = burst
+        self.floor = floor
+        self.decrease = decrease
+        self.recover = recover
+        self.exempt = set(exempt)
+        self._lock = threading.Lock()
+        self._tokens = burst
+        self._updated = time.monotonic()
+        self._last_throttle = 0.0
+        self.admitted = 0
+        self.shed = 0
+
+    def _refill(self, now: float):
+        elapsed = now - self._updated
+        self._updated = now
+        if now - self._last_throttle >= 1:
+            self.rate = min(self.max_rate, self.rate + self.max_rate * self.recover * elapsed)
+        self._tokens = min(self.burst, self._tokens + self.rate * elapsed)
+
+    # Takes a token: 0 when admitted, otherwise the seconds until one is available
+    def acquire(self) -> float:
+        if not self.max_rate:
+            return 0.0
+        with self._lock:
+            self._refill(time.monotonic())
+            if self._tokens >= 1:
+                self._tokens -= 1
+                self.admitted += 1
+                return 0.0
+            self.shed += 1
+            return (1 - self._tokens) / self.rate
+
+    def throttled(self):
+        if not self.max_rate:
+            return
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            if now - self._last_throttle >= 1:
+                self.rate = max(self.max_rate * self.floor, self.rate * self.decrease)
+                self._last_throttle = now
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "rate": round(self.rate, 2),
+                "maxRate": self.max_rate,
+                "tokens": round(self._tokens, 2),
+                "admitted": self.admitted,
+                "shed": self.shed,
+            }
+
+
+def busy_response(seconds: float) -> func.HttpResponse:
+    return func.HttpResponse(
+        json.dumps({"result": False, "msg": "server busy, try again later"}),
+        status_code=429,
+        mimetype="application/json",
+        headers={"Retry-After": str(max(1, math.ceil(seconds)))}
+    )
+
+
+# Wraps a route handler: sheds the request when the bucket is empty, gives it a retry budget,
+# and turns a 429 that escaped the handler into a 429 response for the client
+def admit(route: str, fn, admission: AdmissionController, policy: RetryPolicy):
+    if admission is None or route in admission.exempt:
+        return fn
+
+    def refused(e):
+        return busy_response(retry_after(e) or 1)
+
+    if asyncio.iscoroutinefunction(fn):
+        @functools.wraps(fn)
+        async def async_handler(*args, **kwargs):
+            wait = admission.acquire()
+            if wait:
+                return busy_response(wait)
+            token = _current_budget.set(policy.budget())
+            try:
+                return await fn(*args, **kwargs)
+            except CosmosHttpResponseError as e:
+                if not is_throttle(e):
+                    raise
+                return refused(e)
+            finally:
+                _current_budget.reset(token)
+        return async_handler
+
+    @functools.wraps(fn)
+    def handler(*args, **kwargs):
+        wait = admission.acquire()
+        if wait:
+            return busy_response(wait)
+        token = _current_budget.set(policy.budget())
+        try:
+            return fn(*args, **kwargs)
+        except CosmosHttpResponseError as e:
+            if not is_throttle(e):
+                raise
+            return refused(e)
+        finally:
+            _current_budget.reset(token)
+    return handler
@@ -0,0 +1,122 @@
+import atexit
+import logging
+import threading
+import time
+
+
+# Per-key write-behind buffer: add() queues an item and returns straight away, and a flusher
+# thread hands each key's queued items to flush(key, items) in one call once the key has
+# max_batch items or its oldest item is max_delay seconds old. Items of one key are flushed in
+# order, one flush at a time; a failed flush puts its items back to be retried on the next
+# tick. With coalesce only the newest item of a key is kept (e.g. full snapshots).
+# Queued items live in this process only: they are lost if it dies before the flush, and
+# other workers don't see them until then.
+class WriteBehindBuffer:
+    def __init__(self, flush, max_batch: int = 50, max_delay: float = 0.5,
+                 max_pending: int = 5000, coalesce: bool = False, name: str = "write-behind"):
+        self._flush = flush
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.max_pending = max_pending
+        self.coalesce = coalesce
+        self.name = name
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+        self._wake = threading.Event()
+        self._pending = {}      # key -> [items]
+        self._since = {}        # key -> monotonic time of its oldest queued item
+        self._flushing = {}     # key -> items of the flush in progress not written yet
+        self._thread = None
+        self.flushes = 0
+        self.flushed = 0
+        self.failures = 0
+        self.dropped = 0
+        atexit.register(self.flush_all)
+
+    def add(self, key, item):
+        with self._lock:
+            items = self._pending.setdefault(key, [])
+            if self.coalesce:
+                items.clear()
+            items.append(item)
+            self._since.setdefault(key, time.monotonic())
+            if len(items) > self.max_pending:
+                self.dropped += len(items) - self.max_pending
+                del items[:len(items) - self.max_pending]
+            full = len(items) >= self.max_batch
+            self._start()
+        if full:
+            self._wake.set()
+
+    # Items of key not written yet, oldest first
+    def pending(self, key) -> list:
+        with self._lock:
+            return self._flushing.get(key, []) + self._pending.get(key, [])
+
+    # Flush every key now on the calling thread, once flushes already running are done
+    def flush_all(self):
+        with self._lock:
+            while self._flushing:
+                self._idle.wait()
+            keys = list(self._pending)
+        for key in keys:
+            self._flush_key(key)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "keys": len(self._pending),
+                "pending": sum(len(items) for items in self._pending.values())
+                + sum(len(items) for items in self._flushing.values()),
+                "flushes": self.flushes,
+                "flushed": self.flushed,
+                "failures": self.failures,
+                "dropped": self.dropped,
+            }
+
+    def _start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.max_delay / 2)
+            self._wake.clear()
+            now = time.monotonic()
+            with self._lock:
+                due = [
+                    key for key, items in self._pending.items()
+                    if len(items) >= self.max_batch or now - self._since[key] >= self.max_delay
+                ]
+            for key in due:
+                self._flush_key(key)
+
+    def _flush_key(self, key):
+        with self._lock:
+            if key in self._flushing or not self._pending.get(key):
+                return
+            items = self._pending.pop(key)
+            del self._since[key]
+            self._flushing[key] = items
+
+        try:
+            while items:
+                chunk = items[:self.max_batch]
+                self._flush(key, chunk)
+                with self._lock:
+                    del items[:len(chunk)]
+                    self.flushes += 1
+                    self.flushed += len(chunk)
+        except Exception as e:
+            logging.error(f"{self.name} flush failed for {key}: {e}")
+            with self._lock:
+                self.failures += 1
+                newer = self._pending.get(key, [])
+                kept = newer[-1:] if self.coalesce and newer else items + newer
+                self._pending[key] = kept[-self.max_pending:]
+                self._since[key] = time.monotonic()
+        finally:
+            with self._lock:
+                del self._flushing[key]
+                self._idle.notify_all()
@@ -587,6 +587,19 @@ function connect() {
         }
     });
 
+    // Chat history, sent once on join
+    socket.on('chat:history', (data) => {
+        if (data.lectureTitle === app.currentLectureTitle) {
+            app.chatMessages = data.messages;
+            setTimeout(() => {
+                const chatContainer = document.getElementById('chat-messages');
+                if (chatContainer) {
+                    chatContainer.scrollTop = chatContainer.scrollHeight;
+                }
+            }, 100);
+        }
+    });
+
     // Module update
     socket.on('modules:update:result', (data) => {
         if (data.error) {